@@ -0,0 +1,264 @@
+# async_worker.py
+"""
+Asyncio-движок копи-трейдинга (COPY_EXECUTION_MODE=async).
+
+Вместо ThreadPoolExecutor(max_workers=20) все ордера подписчиков по одному сигналу
+выставляются конкурентно на одном event loop через ccxt.async_support
+(Binance USDT-M -> binanceusdm). Параллелизм ограничен семафором на биржу:
+ASYNC_COPY_CONCURRENCY (по умолчанию) и ASYNC_COPY_CONCURRENCY_<EXCHANGE> (переопределение).
+
+Разбор сигналов, расчет ratio и биллинг берутся из TradeCopier без изменений;
+синхронные вызовы БД уходят в asyncio.to_thread, чтобы не блокировать loop.
+"""
+import os
+import time
+import asyncio
+import ccxt
+
+from worker import TradeCopier, to_ccxt_symbol
+from market_snapshot import entry_quantity
+from fills import ccxt_fill_async
+from rate_limiter import use_priority, EXIT, ENTRY
+from client_pool import AsyncExchangeClientPool
+from database import (
+    get_user_decrypted_keys,
+    get_open_trade,
+    close_trade_in_db,
+    get_active_exchange_credentials,
+)
+
+ASYNC_COPY_CONCURRENCY = int(os.getenv("ASYNC_COPY_CONCURRENCY", "50"))
+
+
+def exchange_concurrency(exchange_id: str) -> int:
+    """Max simultaneous in-flight user tasks for one exchange."""
+    return int(os.getenv(f"ASYNC_COPY_CONCURRENCY_{exchange_id.upper()}", ASYNC_COPY_CONCURRENCY))
+
+
+class AsyncTradeCopier(TradeCopier):
+    def __init__(self, bot_instance=None, shard=None):
+        super().__init__(bot_instance, shard)
+        self.clients = AsyncExchangeClientPool(active_loader=get_active_exchange_credentials)
+        self.loop = None
+        self._limits = {}
+        self._inflight = set()
+
+    # --- CONSUMER ---
+    def start_consuming(self, queue):
+        print("--- [Worker: ASYNC ENGINE] Started ---")
+        asyncio.run(self._consume(queue))
+        print("--- [Worker] Stopped ---")
+
+    async def _consume(self, queue):
+        self.loop = asyncio.get_running_loop()
+        try:
+            while True:
+                event_data = await asyncio.to_thread(queue.get)
+                if event_data is None:
+                    self._task_done(queue, None)
+                    break
+                futures = None
+                try:
+                    # process_signal синхронный (баланс мастера, SQLite) -> в поток;
+                    # фан-аут он отдает обратно на loop через executor=self.loop
+                    futures = await asyncio.to_thread(self.process_signal, event_data, self.loop)
+                except Exception as e:
+                    print(f"❌ Worker Error: {e}")
+                finally:
+                    self._task_done(queue, futures)
+        finally:
+            if self._inflight:
+                await asyncio.gather(*[asyncio.wrap_future(f) for f in list(self._inflight)], return_exceptions=True)
+            await self.clients.close_all()
+
+    def _schedule(self, coro, loop):
+        fut = asyncio.run_coroutine_threadsafe(coro, loop)
+        self._inflight.add(fut)
+        fut.add_done_callback(self._inflight.discard)
+        return fut
+
+    def _limit(self, exchange_id: str, is_exit: bool = False) -> asyncio.Semaphore:
+        # Выходы получают свой семафор и не ждут в очереди за фан-аутом входов
+        key = (exchange_id, is_exit)
+        sem = self._limits.get(key)
+        if sem is None:
+            sem = self._limits[key] = asyncio.Semaphore(exchange_concurrency(exchange_id))
+        return sem
+
+    # --- PARALLEL EXECUTORS (executor == event loop) ---
+    def execute_trade_parallel(self, symbol, side, percentage_used, executor, strategy='bro-bot', is_reduce_only=False):
+        connections = self._active_connections(strategy)
+        print(f"⚡ [ASYNC WORKER] Executing ({strategy}) for {len(connections)} connections...")
+        is_exit = self._is_exit_signal(strategy, side, is_reduce_only)
+        if is_exit: self._mark_close(symbol)
+        generation = self._close_generation.get(symbol, 0)
+        # Выходам фильтры лота не нужны: на loop сразу, без REST-тикеров по биржам
+        snapshots = {} if is_exit else self._resolve_snapshots(connections, symbol, strategy)
+        return [self._schedule(self._fan_out(
+            [self._execute_single_user_async(c, symbol, side, percentage_used, strategy, is_reduce_only,
+                                             snapshots.get(c['exchange_name'].lower()), generation) for c in connections],
+            f"{strategy} {side.upper()} {symbol}",
+        ), executor)]
+
+    def close_all_positions_parallel(self, symbol, executor):
+        connections = self._active_connections('ratner')
+        print(f"⚡ [ASYNC WORKER] Closing concurrently for {len(connections)} connections...")
+        self._mark_close(symbol)
+        return [self._schedule(self._fan_out(
+            [self._close_single_user_async(c, symbol) for c in connections],
+            f"CLOSE ALL {symbol}",
+        ), executor)]
+
+    async def _fan_out(self, coros, label):
+        started = time.monotonic()
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        print(f"⏱ [ASYNC WORKER] {label}: {len(results)} users in {time.monotonic() - started:.2f}s ({failed} failed)")
+
+    # --- PER USER ---
+    async def _execute_single_user_async(self, conn, symbol, side, percentage_used, strategy, is_reduce_only, snapshot=None, generation=None):
+        user_id = conn['user_id']
+        keys = conn if conn.get('secret') else await asyncio.to_thread(get_user_decrypted_keys, user_id, conn['exchange_name'])
+        if not keys: return
+        exchange_id = keys.get('exchange', 'binance').lower()
+
+        risk_pct = conn.get('risk_pct')
+        if risk_pct is None: risk_pct = 1.0
+        target_entry_usd = self._target_entry_usd(strategy, conn.get('reserved_amount') or 0.0, percentage_used, risk_pct)
+
+        open_trade = await asyncio.to_thread(get_open_trade, user_id, symbol)
+        if is_reduce_only and not open_trade:
+            print(f"   ⚠️ User {user_id}: Ignoring ReduceOnly signal (no open position).")
+            return
+        is_closing = bool(open_trade and open_trade['side'] != side)
+        is_exit = is_closing or self._is_exit_signal(strategy, side, is_reduce_only)
+        use_priority(EXIT if is_exit else ENTRY)
+
+        async with self._limit(exchange_id, is_exit):
+            # Пока ждали семафор, по символу могло прийти закрытие -> вход устарел
+            if not is_exit and self._is_stale_entry(symbol, generation):
+                print(f"   ⏭ User {user_id}: {symbol} entry dropped (superseded by a close).")
+                return
+            try:
+                if strategy == 'cgt':
+                    if exchange_id != 'okx': return
+                    client = await self.clients.get(user_id, keys, 'spot')
+                    await self._execute_spot(client, user_id, symbol, side, target_entry_usd, snapshot)
+                else:
+                    client = await self.clients.get(user_id, keys)
+                    await self._execute_futures(client, exchange_id, user_id, symbol, side, target_entry_usd,
+                                                is_closing or is_reduce_only, open_trade, snapshot, keys)
+            except Exception as e:
+                print(f"   ❌ User {user_id} {exchange_id} Error: {e}")
+                self.clients.report_error(user_id, exchange_id, e)
+                if strategy != 'cgt':
+                    await asyncio.to_thread(self.leverage.forget, user_id, exchange_id, symbol)
+
+    async def _execute_spot(self, client, user_id, symbol, side, target_entry_usd, snapshot=None):
+        price = snapshot['price'] if snapshot else (await client.fetch_ticker(symbol))['last']
+
+        if side == 'buy':
+            if target_entry_usd < 2: return # Min order size check
+            amount_coin = entry_quantity(snapshot, target_entry_usd) if snapshot else target_entry_usd / price
+            if amount_coin == 0: return
+            print(f"   🚀 User {user_id} [OKX]: BUY {amount_coin:.6f} {symbol} (${target_entry_usd:.2f})")
+            order = await client.create_order(symbol, 'market', 'buy', amount_coin, params={'tdMode': 'cash'})
+            exec_p, exec_q = await ccxt_fill_async(client, symbol, order, price, amount_coin)
+            await asyncio.to_thread(self._record_entry, user_id, symbol, side, exec_p, exec_q, 'okx')
+            print(f"   ✅ User {user_id} [OKX] FILLED: {exec_q} @ {exec_p}")
+
+        elif side == 'sell':
+            bal = await client.fetch_balance()
+            base_currency = symbol.split('/')[0]
+            coin_bal = float(bal[base_currency]['free']) if base_currency in bal else 0
+            if coin_bal <= 0: return
+
+            print(f"   🔻 User {user_id} [OKX]: SELL ALL {coin_bal:.6f} {symbol}")
+            order = await client.create_order(symbol, 'market', 'sell', coin_bal, params={'tdMode': 'cash'})
+            exit_price, _ = await ccxt_fill_async(client, symbol, order, price, coin_bal)
+
+            open_trade_spot = await asyncio.to_thread(get_open_trade, user_id, symbol)
+            pnl, fee = None, 0.0
+            if open_trade_spot:
+                pnl, fee = await asyncio.to_thread(self._handle_pnl_and_billing, user_id, symbol, open_trade_spot['entry_price'], exit_price, open_trade_spot['quantity'], 'buy')
+            await asyncio.to_thread(self._record_close, user_id, symbol, exit_price, pnl, fee, 'okx')
+            print(f"   ✅ User {user_id} [OKX] SOLD ALL")
+
+    async def _execute_futures(self, client, exchange_id, user_id, symbol, side, target_entry_usd, is_exit, open_trade, snapshot=None, keys=None):
+        ccxt_sym = to_ccxt_symbol(symbol)
+        price = snapshot['price'] if snapshot else float((await client.fetch_ticker(ccxt_sym))['last'])
+
+        if not is_exit:
+            # ENTRY
+            target_leverage = 4 if exchange_id == 'bingx' else 20
+            await self.leverage.ensure_async(user_id, exchange_id, symbol, target_leverage, keys,
+                                             lambda: client.set_leverage(target_leverage, ccxt_sym))
+
+            if snapshot:
+                qty = entry_quantity(snapshot, target_entry_usd)
+            else:
+                try:
+                    qty = float(client.amount_to_precision(ccxt_sym, target_entry_usd / price))
+                except ccxt.InvalidOrder:
+                    qty = 0
+            if qty == 0: return
+
+            print(f"   🚀 User {user_id} [{exchange_id}]: {side.upper()} {qty} (${target_entry_usd:.2f})")
+            params = {}
+            if exchange_id in ['bingx', 'bybit']:
+                params['positionSide'] = 'LONG' if side == 'buy' else 'SHORT'
+
+            order = await client.create_order(ccxt_sym, 'market', side, qty, params=params)
+            exec_p, exec_q = await ccxt_fill_async(client, ccxt_sym, order, price, qty)
+
+            await asyncio.to_thread(self._safe_db_write, user_id, symbol, side, exec_p, exec_q, False, open_trade, exchange_id)
+            print(f"   ✅ User {user_id} [{exchange_id}] ENTRY FILLED")
+            return
+
+        # EXIT / CLOSE ALL
+        positions = await client.fetch_positions([ccxt_sym])
+        pos = next((p for p in positions if p['symbol'] == ccxt_sym), None)
+        if not pos or float(pos['contracts'] or 0) <= 0: return
+
+        pos_amt = float(pos['contracts'])
+        print(f"   🔻 User {user_id} [{exchange_id}]: CLOSE ALL {pos_amt}")
+        params = {'reduceOnly': True}
+        if exchange_id in ['bingx', 'bybit'] and open_trade:
+            params['positionSide'] = 'LONG' if open_trade['side'] == 'buy' else 'SHORT'
+
+        order = await client.create_order(ccxt_sym, 'market', side, pos_amt, params=params)
+        exit_p, _ = await ccxt_fill_async(client, ccxt_sym, order, price, pos_amt)
+        await asyncio.to_thread(self._record_close, user_id, symbol, exit_p, None, 0.0, exchange_id)
+        print(f"   ✅ User {user_id} [{exchange_id}] CLOSED")
+
+    async def _close_single_user_async(self, conn, symbol):
+        user_id = conn['user_id']
+        use_priority(EXIT)
+        keys = conn if conn.get('secret') else await asyncio.to_thread(get_user_decrypted_keys, user_id, conn['exchange_name'])
+        if not keys: return
+        exchange_id = keys.get('exchange', 'binance').lower()
+
+        async with self._limit(exchange_id, is_exit=True):
+            try:
+                client = await self.clients.get(user_id, keys)
+                ccxt_sym = to_ccxt_symbol(symbol)
+
+                positions = await client.fetch_positions([ccxt_sym])
+                target = next((p for p in positions if float(p['contracts'] or 0) > 0), None)
+                if target:
+                    amt = float(target['contracts'])
+                    side = 'sell' if target['side'] == 'long' else 'buy'
+                    order = await client.create_order(ccxt_sym, 'market', side, amt, params={'reduceOnly': True})
+                    print(f"   👉 User {user_id}: Closed {amt}")
+                    exit_p, _ = await ccxt_fill_async(client, ccxt_sym, order, None, amt)
+                    exit_p = exit_p or float((await client.fetch_ticker(ccxt_sym))['last'])
+                    op = await asyncio.to_thread(get_open_trade, user_id, symbol)
+                    pnl, fee = None, 0.0
+                    if op:
+                        pnl, fee = await asyncio.to_thread(self._handle_pnl_and_billing, user_id, symbol, op['entry_price'], exit_p, op['quantity'], op['side'])
+                    await asyncio.to_thread(self._record_close, user_id, symbol, exit_p, pnl, fee, exchange_id)
+                else:
+                    await asyncio.to_thread(close_trade_in_db, user_id, symbol)
+            except Exception as e:
+                print(f"   ❌ User {user_id} Close Error: {e}")
+                self.clients.report_error(user_id, exchange_id, e)
@@ -0,0 +1,109 @@
+# balance_service.py
+"""
+Балансы бирж пользователя для бота и веб-аппа (/api/data).
+
+Раньше my_exchanges_command ходил на биржи по очереди (4 биржи = 4 последовательных
+REST запроса) и повторял все на каждое нажатие. Здесь:
+
+- все биржи пользователя запрашиваются параллельно (расшифровка ключей - в пуле потоков базы);
+- одновременные запросы одного аккаунта склеиваются в один запрос к бирже;
+- результат живет BALANCE_CACHE_TTL секунд (ошибка - BALANCE_ERROR_TTL), ключ кэша
+  включает API key, так что после смены ключей старый баланс не отдается;
+- последний удачный баланс сохраняется в базе (exchange_balances): веб-апп сразу
+  показывает его через last_known(), а свежие цифры догружает revalidate() в фоне.
+"""
+import os
+import time
+import asyncio
+
+from database import get_user_decrypted_keys, run_db, save_last_balance
+from exchange_utils import fetch_exchange_balance_safe
+
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "15"))
+BALANCE_ERROR_TTL = float(os.getenv("BALANCE_ERROR_TTL", "5"))
+
+
+class BalanceService:
+    def __init__(self, ttl: float = BALANCE_CACHE_TTL, error_ttl: float = BALANCE_ERROR_TTL):
+        self.ttl = ttl
+        self.error_ttl = min(error_ttl, ttl)
+        self._cache = {}      # (user_id, exchange, api_key) -> (fetched_at, balance|None, wall time)
+        self._inflight = {}   # (user_id, exchange, api_key) -> asyncio.Task
+
+    def _fresh(self, key):
+        cached = self._cache.get(key)
+        if not cached:
+            return False, None
+        fetched_at, balance, _ = cached
+        ttl = self.ttl if balance is not None else self.error_ttl
+        return time.monotonic() - fetched_at < ttl, balance
+
+    async def get(self, user_id: int, exchange_name: str, keys: dict = None):
+        """USDT balance of one connected exchange (None if keys are missing or the exchange failed)."""
+        exchange_name = exchange_name.lower()
+        if keys is None:
+            keys = await run_db(get_user_decrypted_keys, user_id, exchange_name)
+        if not keys or not keys.get('secret'):
+            return None
+
+        key = (user_id, exchange_name, keys['apiKey'])
+        fresh, balance = self._fresh(key)
+        if fresh:
+            return balance
+
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(self._fetch(key, keys))
+            self._inflight[key] = task
+        # shield: отмена одного ожидающего (закрыли веб-апп) не отменяет запрос остальным
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, keys):
+        try:
+            balance = await fetch_exchange_balance_safe(key[1], keys['apiKey'], keys['secret'], keys.get('password'))
+            self._cache[key] = (time.monotonic(), balance, time.time())
+            if balance is not None:
+                save_last_balance(key[0], key[1], key[2], balance, time.time())
+            return balance
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+
+    async def get_all(self, user_id: int, exchanges: list) -> dict:
+        """{exchange_name: balance|None} for the user's exchanges, fetched concurrently."""
+        names = [ex['exchange_name'] if isinstance(ex, dict) else ex for ex in exchanges]
+        results = await asyncio.gather(*(self.get(user_id, name) for name in names), return_exceptions=True)
+        return {name: (None if isinstance(res, BaseException) else res) for name, res in zip(names, results)}
+
+    def last_known(self, user_id: int, exchanges: list, stored: dict = None) -> dict:
+        """
+        {exchange_name: (balance|None, updated_at|None, fresh)} without touching the exchanges.
+        Memory cache first, then rows of get_last_balances() (only if saved for the same API key).
+        """
+        stored = stored or {}
+        now, result = time.time(), {}
+        for ex in exchanges:
+            name, api_key = ex['exchange_name'], ex['api_key']
+            cached = self._cache.get((user_id, name, api_key))
+            if cached:
+                fresh, balance = self._fresh((user_id, name, api_key))
+                result[name] = (balance, cached[2], fresh)
+                continue
+            row = stored.get(name)
+            if row and row[0] == api_key:
+                result[name] = (row[1], row[2], now - row[2] < self.ttl)
+            else:
+                result[name] = (None, None, False)
+        return result
+
+    async def revalidate(self, user_id: int, exchanges: list) -> dict:
+        """Refreshes stale balances (coalesced with running fetches) and returns last_known()."""
+        await self.get_all(user_id, exchanges)
+        return self.last_known(user_id, exchanges)
+
+    def invalidate(self, user_id: int, exchange_name: str = None):
+        for key in [k for k in self._cache if k[0] == user_id and (exchange_name is None or k[1] == exchange_name.lower())]:
+            self._cache.pop(key, None)
+
+
+balance_service = BalanceService()
@@ -3,7 +3,6 @@ import json
 from urllib.parse import urlencode
 import re
 import asyncio
-import pandas as pd
 import requests
 import concurrent.futures
 import time
@@ -17,14 +16,14 @@ from telegram import InputMediaPhoto
 from database import * 
 from database import set_copytrading_status 
 from database import check_analysis_limit
-from chart_analyzer import find_candlesticks, candlesticks_to_ohlc
-from core_analyzer import fetch_data, compute_features, generate_decisive_signal, generate_signal
-from llm_explainer import get_explanation
-import ccxt
-from binance.um_futures import UMFutures
+# Анализаторы (cv2, pandas, pandas_ta, ccxt, openai) импортируются в хендлерах при первом использовании
 from exchange_utils import fetch_exchange_balance_safe
+from balance_service import balance_service
+from pnl_engine import pnl_report, format_usd
+from rate_limiter import set_process_role
 
 load_dotenv()
+set_process_role('bot')
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 BSCSCAN_API_KEY = os.getenv("BSCSCAN_API_KEY")
 WALLET_ADDRESS = os.getenv("YOUR_WALLET_ADDRESS")
@@ -200,6 +199,8 @@ def blocking_chart_analysis(file_path: str, risk_settings: dict, progress_callba
             progress_callback(get_text(user_id, "msg_analyzing_chart"))
         time.sleep(5)
         
+        from chart_analyzer import find_candlesticks
+        from core_analyzer import fetch_data, compute_features, generate_decisive_signal
         candlesticks, chart_info = find_candlesticks(file_path)
         
         print(f"LOG: GPT Vision Raw Info: {chart_info}")
@@ -551,6 +552,21 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Calculate Total Trading Capital from all active connections
     total_capital = sum(ex['reserved_amount'] for ex in confirm_exchanges if ex['is_active'])
 
+    # PnL из готовых агрегатов; цены открытых позиций ждем не дольше 2 секунд
+    pnl = await asyncio.to_thread(pnl_report, get_user_view(user_id), 2)
+    win_rate = pnl['all']['wins'] / pnl['all']['trades'] * 100 if pnl['all']['trades'] else 0
+    pnl_text = (
+        f"{get_text(user_id, 'pnl_realized')} {format_usd(pnl['all']['realized'])} "
+        f"({get_text(user_id, 'pnl_today')} {format_usd(pnl['today']['realized'])})\n"
+    )
+    if pnl['positions']:
+        pnl_text += (
+            f"{get_text(user_id, 'pnl_unrealized')} {format_usd(pnl['unrealized'])} "
+            f"({get_text(user_id, 'pnl_open_positions', count=len(pnl['positions']))})\n"
+        )
+    if pnl['all']['trades']:
+        pnl_text += f"{get_text(user_id, 'pnl_win_rate', rate=f'{win_rate:.0f}', trades=pnl['all']['trades'])}\n"
+
         
     bot_username = (await context.bot.get_me()).username
     referral_link = f"https://t.me/{bot_username}?start={profile['ref_code']}"
@@ -564,7 +580,8 @@ async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{get_text(user_id, 'status')} {status_emoji}\n"
         f"{get_text(user_id, 'subscription')} {expiry_text}\n"
         f"{get_text(user_id, 'token_balance')} {profile['balance']:.2f} 🪙\n"
-        f"{get_text(user_id, 'trading_balance')} ${total_capital:,.2f}\n\n"
+        f"{get_text(user_id, 'trading_balance')} ${total_capital:,.2f}\n"
+        f"{pnl_text}\n"
         f"{get_text(user_id, 'referral_link')}\n"
         f"<code>{referral_link}</code>\n\n"
         f"{get_text(user_id, 'invite_earn')}\n"
@@ -601,23 +618,13 @@ async def my_exchanges_command(update: Update, context: ContextTypes.DEFAULT_TYP
     # Send "Checking balances..." message first
     status_msg = await update.message.reply_text(get_text(user_id, "msg_checking_balances"))
 
+    # Все биржи параллельно (и из короткого кэша, общего с веб-аппом)
+    balances = await balance_service.get_all(user_id, exchanges)
+
     for ex in exchanges:
-        # Decrypt keys
-        keys = get_user_decrypted_keys(user_id, ex['exchange_name'])
-        
         # Check connection & Fetch Balance
-        real_usdt_bal = None
-        is_connected = False
-        
-        if keys:
-            try:
-                # Run sync CCXT/Binance calls in thread
-                real_usdt_bal = await fetch_exchange_balance_safe(
-                    ex['exchange_name'], keys['apiKey'], keys['secret'], keys['password']
-                )
-                if real_usdt_bal is not None: is_connected = True
-            except Exception as e:
-                print(f"Check failed for {ex['exchange_name']}: {e}")
+        real_usdt_bal = balances.get(ex['exchange_name'])
+        is_connected = real_usdt_bal is not None
 
         # Combine Flags
         db_active = ex['is_active']
@@ -741,7 +748,7 @@ async def edit_reserve_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data['editing_strategy'] = strategy
 
     # Live Balance Check
-    balance = await fetch_exchange_balance_safe(exchange_name, keys['apiKey'], keys['secret'], keys.get('password'))
+    balance = await balance_service.get(user_id, exchange_name, keys)
     
     await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg_checking.message_id)
     
@@ -2004,6 +2011,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         thinking_message = await update.message.reply_text(get_text(user_id, "msg_aladdin_thinking"), parse_mode=ParseMode.HTML)
         lang = get_user_language(user_id)
+        from llm_explainer import get_explanation
         explanation = get_explanation(analysis_context, lang=lang)
         await thinking_message.edit_text(explanation, parse_mode=ParseMode.MARKDOWN)
     # --- Проверка на TxHash ---
@@ -2224,6 +2232,7 @@ async def explain_analysis_handler(update: Update, context: ContextTypes.DEFAULT
     thinking_message = await query.message.reply_text(get_text(user_id, "msg_aladdin_thinking"), parse_mode=ParseMode.HTML)
     
     lang = get_user_language(user_id)
+    from llm_explainer import get_explanation
     explanation = await asyncio.to_thread(get_explanation, analysis_context, lang=lang)
     
     await thinking_message.edit_text(explanation, parse_mode=ParseMode.MARKDOWN)
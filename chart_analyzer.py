@@ -127,12 +127,10 @@
 
 
 # chart_analyzer.py (v-OpenRouter - Correct Headers)
-import cv2
-import numpy as np
 import base64
 import json
 import os
-from openai import OpenAI
+import functools
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -140,9 +138,14 @@ load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
-# Настраиваем клиент с правильными заголовками твоего бота
-if OPENROUTER_API_KEY:
-    client = OpenAI(
+# Клиент с правильными заголовками твоего бота; openai и cv2 грузим при первом анализе
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """OpenRouter client, created on first use (None without API key)."""
+    if not OPENROUTER_API_KEY:
+        return None
+    from openai import OpenAI
+    return OpenAI(
         base_url=OPENROUTER_BASE_URL,
         api_key=OPENROUTER_API_KEY,
         default_headers={
@@ -150,11 +153,10 @@ if OPENROUTER_API_KEY:
             "X-Title": "BlackAladin",
         }
     )
-else:
-    client = None
 
 def analyze_chart_with_gpt(image_path: str) -> dict | None:
     """Использует GPT-4o через OpenRouter для распознавания тикера."""
+    client = get_client()
     if not client:
         print("WARNING: OpenRouter API key not found.")
         return None
@@ -214,6 +216,8 @@ def find_candlesticks(image_path: str):
     chart_info = analyze_chart_with_gpt(image_path)
     
     # 2. Ищем свечи (для подстраховки)
+    import cv2
+    import numpy as np
     image = cv2.imread(image_path)
     if image is None: return [], chart_info
     
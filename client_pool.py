@@ -0,0 +1,282 @@
+# client_pool.py
+"""
+Реестр долгоживущих клиентов бирж для копи-трейдинга.
+
+Раньше TradeCopier создавал новый UMFutures / ccxt клиент на каждый сигнал
+для каждого подписчика: новый TLS, повторный load_markets и никакого общего
+rate-limit состояния. Здесь клиенты живут между сигналами и переиспользуются.
+
+Ключ реестра: (user_id, exchange_name, market_type, fingerprint ключей).
+- Спот и фьючерсный клиенты одного подключения живут рядом (OKX: cgt и bro-bot).
+- Смена ключей в user_exchanges -> новый fingerprint -> новый клиент, старые (всех типов рынка) выбрасываются.
+- Неактивные / удаленные подключения вычищаются при периодической синхронизации.
+- Клиенты без обращений дольше CLIENT_POOL_IDLE_TTL секунд закрываются.
+- Наружу отдаются через limited(): все вызовы идут через общий rate limiter.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import ccxt
+import ccxt.async_support as ccxt_async
+from binance.um_futures import UMFutures
+from binance.error import ClientError
+
+from rate_limiter import limited, rate_limiter
+
+BINANCE_FAPI_URL = "https://fapi.binance.com"
+
+CLIENT_POOL_IDLE_TTL = int(os.getenv("CLIENT_POOL_IDLE_TTL", "900"))        # 15 минут
+CLIENT_POOL_SYNC_INTERVAL = int(os.getenv("CLIENT_POOL_SYNC_INTERVAL", "60"))
+
+# В async-режиме Binance USDT-M фьючерсы идут через ccxt.async_support
+ASYNC_EXCHANGE_CLASSES = {'binance': 'binanceusdm'}
+
+# Binance error codes meaning "this API key is dead" (invalid / revoked / no permissions)
+BINANCE_AUTH_ERROR_CODES = {-2014, -2015, -1022}
+
+
+def key_fingerprint(keys: dict) -> str:
+    """Short, non-reversible fingerprint of the credentials a client was built with."""
+    raw = "|".join([
+        keys.get('apiKey') or '',
+        keys.get('secret') or '',
+        keys.get('password') or '',
+    ])
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+
+def build_exchange_client(exchange_id: str, keys: dict, market_type: str = 'future'):
+    """Creates a warmed client: Binance via UMFutures, everything else via CCXT with markets preloaded."""
+    if exchange_id == 'binance':
+        return UMFutures(key=keys['apiKey'], secret=keys['secret'], base_url=BINANCE_FAPI_URL)
+
+    ex_class = getattr(ccxt, exchange_id)
+    config = {
+        'apiKey': keys['apiKey'],
+        'secret': keys['secret'],
+        'options': {'defaultType': market_type},
+        'enableRateLimit': True,
+    }
+    if keys.get('password'):
+        config['password'] = keys['password']
+    client = ex_class(config)
+    client.load_markets()
+    return client
+
+
+async def build_async_exchange_client(exchange_id: str, keys: dict, market_type: str = 'future'):
+    """Async twin of build_exchange_client (ccxt.async_support for every exchange, Binance included)."""
+    ex_class = getattr(ccxt_async, ASYNC_EXCHANGE_CLASSES.get(exchange_id, exchange_id))
+    config = {
+        'apiKey': keys['apiKey'],
+        'secret': keys['secret'],
+        'options': {'defaultType': market_type},
+        'enableRateLimit': True,
+    }
+    if keys.get('password'):
+        config['password'] = keys['password']
+    client = ex_class(config)
+    try:
+        await client.load_markets()
+    except Exception:
+        await client.close()
+        raise
+    return client
+
+
+def _dispose_client(client):
+    session = getattr(client, 'session', None)
+    if session is not None:
+        try: session.close()
+        except: pass
+
+
+def is_auth_error(error) -> bool:
+    """True if the error means the key is revoked/invalid and the cached client must be dropped."""
+    if isinstance(error, (ccxt.AuthenticationError, ccxt.PermissionDenied)):
+        return True
+    if isinstance(error, ClientError):
+        return getattr(error, 'error_code', None) in BINANCE_AUTH_ERROR_CODES
+    return False
+
+
+class ExchangeClientPool:
+    """
+    Thread-safe registry of per-connection exchange clients.
+
+    `active_loader` is a callable returning the current active user_exchanges rows
+    (dicts with user_id / exchange_name); it is used to evict revoked connections.
+    """
+
+    def __init__(self, active_loader=None, idle_ttl: int = CLIENT_POOL_IDLE_TTL, sync_interval: int = CLIENT_POOL_SYNC_INTERVAL):
+        self.active_loader = active_loader
+        self.idle_ttl = idle_ttl
+        self.sync_interval = sync_interval
+        self._clients = {}      # (user_id, exchange, market_type, fingerprint) -> [client, last_used]
+        self._key_locks = {}    # same key -> Lock (чтобы два потока не грели один клиент дважды)
+        self._lock = threading.Lock()
+        self._last_maintenance = time.monotonic()
+
+    def get(self, user_id: int, keys: dict, market_type: str = 'future'):
+        """Returns a cached (rate-limited) client for this connection, building it on first use."""
+        exchange_id = (keys.get('exchange') or 'binance').lower()
+        return limited(self._get_raw(user_id, exchange_id, keys, market_type), exchange_id, user_id)
+
+    def _get_raw(self, user_id, exchange_id, keys, market_type):
+        fp = key_fingerprint(keys)
+        key = (user_id, exchange_id, market_type, fp)
+
+        self._maybe_maintain()
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry:
+                entry[1] = time.monotonic()
+                return entry[0]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Кто-то мог успеть создать клиент, пока мы ждали
+            with self._lock:
+                entry = self._clients.get(key)
+                if entry:
+                    entry[1] = time.monotonic()
+                    return entry[0]
+
+            client = build_exchange_client(exchange_id, keys, market_type)
+
+            with self._lock:
+                # Ключи сменились -> старые клиенты этого подключения больше не нужны
+                stale = [k for k in self._clients if k[0] == user_id and k[1] == exchange_id and k[3] != fp]
+                for k in stale:
+                    self._dispose(self._clients.pop(k)[0])
+                    self._key_locks.pop(k, None)
+                self._clients[key] = [client, time.monotonic()]
+            return client
+
+    def invalidate(self, user_id: int, exchange_name: str = None):
+        """Drops every cached client of a user (or of one user connection)."""
+        exchange_name = exchange_name.lower() if exchange_name else None
+        with self._lock:
+            doomed = [k for k in self._clients if k[0] == user_id and (exchange_name is None or k[1] == exchange_name)]
+            for k in doomed:
+                self._dispose(self._clients.pop(k)[0])
+                self._key_locks.pop(k, None)
+
+    def report_error(self, user_id: int, exchange_name: str, error):
+        """Evicts the connection's client when the exchange says its key is no longer valid."""
+        rate_limiter.report_error(exchange_name.lower(), error)
+        if is_auth_error(error):
+            print(f"   🔑 User {user_id} [{exchange_name}]: key rejected, dropping cached client.")
+            self.invalidate(user_id, exchange_name)
+
+    def retain(self, active_connections):
+        """Evicts clients whose (user_id, exchange_name) is no longer an active connection."""
+        alive = {(c['user_id'], (c['exchange_name'] or '').lower()) for c in active_connections}
+        with self._lock:
+            doomed = [k for k in self._clients if (k[0], k[1]) not in alive]
+            for k in doomed:
+                self._dispose(self._clients.pop(k)[0])
+                self._key_locks.pop(k, None)
+        return len(doomed)
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            doomed = [k for k, (_, last_used) in self._clients.items() if last_used < cutoff]
+            for k in doomed:
+                self._dispose(self._clients.pop(k)[0])
+                self._key_locks.pop(k, None)
+        return len(doomed)
+
+    def _dispose(self, client):
+        _dispose_client(client)
+
+    def _maintenance_due(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_maintenance < self.sync_interval:
+                return False
+            self._last_maintenance = now
+            return True
+
+    def _maybe_maintain(self):
+        if self._maintenance_due():
+            self._maintain()
+
+    def _maintain(self):
+        evicted = self.evict_idle()
+        if self.active_loader:
+            try:
+                evicted += self.retain(self.active_loader())
+            except Exception as e:
+                print(f"⚠️ Client pool sync failed: {e}")
+        if evicted:
+            print(f"♻️ Client pool: evicted {evicted} idle/revoked clients ({len(self)} alive).")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+
+class AsyncExchangeClientPool(ExchangeClientPool):
+    """
+    Same registry for the asyncio engine: clients come from ccxt.async_support and are
+    created/used on one event loop. Eviction may be triggered from any thread; closing
+    is always scheduled back onto the owning loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = None
+        self._async_key_locks = {}
+
+    async def get(self, user_id: int, keys: dict, market_type: str = 'future'):
+        exchange_id = (keys.get('exchange') or 'binance').lower()
+        return limited(await self._get_raw_async(user_id, exchange_id, keys, market_type), exchange_id, user_id)
+
+    async def _get_raw_async(self, user_id, exchange_id, keys, market_type):
+        self._loop = asyncio.get_running_loop()
+        fp = key_fingerprint(keys)
+        key = (user_id, exchange_id, market_type, fp)
+
+        if self._maintenance_due():
+            # active_loader ходит в SQLite -> не блокируем event loop
+            await asyncio.to_thread(self._maintain)
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry:
+                entry[1] = time.monotonic()
+                return entry[0]
+        key_lock = self._async_key_locks.setdefault(key, asyncio.Lock())
+
+        async with key_lock:
+            with self._lock:
+                entry = self._clients.get(key)
+                if entry:
+                    entry[1] = time.monotonic()
+                    return entry[0]
+
+            client = await build_async_exchange_client(exchange_id, keys, market_type)
+
+            with self._lock:
+                stale = [k for k in self._clients if k[0] == user_id and k[1] == exchange_id and k[3] != fp]
+                for k in stale:
+                    self._dispose(self._clients.pop(k)[0])
+                self._clients[key] = [client, time.monotonic()]
+            return client
+
+    def _dispose(self, client):
+        if self._loop and not self._loop.is_closed():
+            asyncio.run_coroutine_threadsafe(client.close(), self._loop)
+
+    async def close_all(self):
+        with self._lock:
+            clients = [entry[0] for entry in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            try: await client.close()
+            except: pass
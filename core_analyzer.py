@@ -307,11 +307,8 @@
 # core_analyzer.py (v-FINAL - OpenRouter/DeepSeek & Risk Reward)
 import os
 import math
-import pandas as pd
-import pandas_ta as ta
-import ccxt
 import json
-from openai import OpenAI
+import functools
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -320,8 +317,13 @@ load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
-if OPENROUTER_API_KEY:
-    client = OpenAI(
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """OpenRouter client, created on first use (None without API key)."""
+    if not OPENROUTER_API_KEY:
+        return None
+    from openai import OpenAI
+    return OpenAI(
         base_url=OPENROUTER_BASE_URL,
         api_key=OPENROUTER_API_KEY,
         default_headers={
@@ -329,11 +331,14 @@ if OPENROUTER_API_KEY:
             "X-Title": "BlackAladin",
         }
     )
-else:
-    client = None
 
-# Используем обычный ccxt (синхронный), так как запускаем в потоке
-exchange = ccxt.binance()
+# pandas / pandas_ta / ccxt тяжелые при импорте -> грузим при первом анализе, а не при старте бота
+
+@functools.lru_cache(maxsize=1)
+def get_exchange():
+    # Используем обычный ccxt (синхронный), так как запускаем в потоке
+    import ccxt
+    return ccxt.binance()
 
 def format_price(price):
     """Умное форматирование цены."""
@@ -359,9 +364,10 @@ def get_general_market_sentiment() -> float:
     return 0.0
 
 def fetch_data(symbol="BTC/USDT", timeframe="1h", limit=200):
+    import pandas as pd
     print(f"Fetching {symbol} {timeframe} data...")
     try:
-        bars = exchange.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
+        bars = get_exchange().fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
         df = pd.DataFrame(bars, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
         df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
         return df
@@ -370,6 +376,7 @@ def fetch_data(symbol="BTC/USDT", timeframe="1h", limit=200):
         return pd.DataFrame()
 
 def compute_features(df):
+    import pandas_ta  # noqa: F401  регистрирует df.ta
     if df.empty: return df
     
     # Индикаторы
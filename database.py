@@ -4,6 +4,13 @@ import uuid
 import os
 import json
 import time
+import types
+import threading
+import asyncio
+import functools
+import queue
+import atexit
+import concurrent.futures
 from datetime import datetime, timedelta
 from typing import Literal
 from cryptography.fernet import Fernet 
@@ -40,48 +47,239 @@ def decrypt_data(encrypted_data: str) -> str:
         print(f"❌ Decryption failed: {e}")
         return None
 
-# --- ЯДРО БАЗЫ ДАННЫХ (ЗАЩИТА ОТ БЛОКИРОВОК) ---
+# --- ПУЛ СОЕДИНЕНИЙ ---
+# Одно закрепленное соединение на поток (WAL, synchronous=NORMAL, mmap, busy_timeout, кэш
+# подготовленных выражений) вместо connect()/close() на каждый вызов.
+SQLITE_BUSY_TIMEOUT = 30                   # секунд ждать блокировку вместо мгновенного "database is locked"
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHED_STATEMENTS = 256
 
-def execute_write_query(query, params=()):
+_thread_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, timeout=SQLITE_BUSY_TIMEOUT, cached_statements=SQLITE_CACHED_STATEMENTS)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE};")
+    return conn
+
+def ensure_schema():
+    """Runs pending migrations once per process, on the first connection (not at import)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            initialize_db()
+            _schema_ready = True
+
+def _open_connection():
+    ensure_schema()
+    return _connect()
+
+class PooledConnection:
     """
-    Выполняет запись в базу (INSERT/UPDATE/DELETE).
-    Если база занята (Locked), делает 5 попыток с паузой.
+    Per-call handle on the thread's pinned connection with the sqlite3.Connection API the helpers use.
+    row_factory is per handle (not leaked to the next caller); close() rolls back what this handle
+    left uncommitted, exactly like closing a private connection used to.
     """
-    max_retries = 5
-    for i in range(max_retries):
-        conn = None
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._outer_tx = conn.in_transaction
+        self.row_factory = None
+
+    def cursor(self):
+        cursor = self._conn.cursor()
+        cursor.row_factory = self.row_factory
+        return cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+    def close(self):
+        if self._conn is not None and not self._outer_tx and self._conn.in_transaction:
+            self._conn.rollback()
+        self._conn = None
+
+    def __del__(self):
+        try: self.close()
+        except Exception: pass
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+def get_connection() -> PooledConnection:
+    """Handle on this thread's pinned connection (opened on first use)."""
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is None:
+        conn = _thread_local.conn = _open_connection()
+    return PooledConnection(conn)
+
+# --- ASYNC ДОСТУП (FastAPI / asyncio) ---
+# Синхронные функции модуля (sqlite3 + Fernet) нельзя звать прямо из event loop:
+# один медленный запрос или ожидание писателя останавливает все остальные запросы.
+# run_db выполняет их в отдельном пуле потоков (у каждого потока свое закрепленное соединение).
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
+_db_executor = None
+_db_executor_lock = threading.Lock()
+
+def get_db_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        with _db_executor_lock:
+            if _db_executor is None:
+                _db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _db_executor
+
+async def run_db(fn, *args, **kwargs):
+    """Awaitable call of a blocking database function on the DB executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(fn, *args, **kwargs))
+
+# --- ЯДРО БАЗЫ ДАННЫХ (ОДИН ПИСАТЕЛЬ) ---
+# Все записи идут через один поток-писатель: он забирает накопившиеся в очереди записи
+# и фиксирует их одним COMMIT (group commit). Никаких "database is locked" между 20 потоками
+# фан-аута и никаких молча потерянных записей: каждый вызов получает свой Future.
+WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "200"))
+WRITE_BATCH_WINDOW = float(os.getenv("DB_WRITE_BATCH_WINDOW", "0.005"))  # сек. подождать соседей по батчу
+
+class DatabaseWriter:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def in_writer(self) -> bool:
+        return getattr(self._local, 'active', False)
+
+    def submit(self, op) -> concurrent.futures.Future:
+        """
+        Queues a write. op is (query, params) or a callable(cursor) that runs inside the
+        writer's transaction (read-modify-write without races). The future resolves after COMMIT.
+        """
+        future = concurrent.futures.Future()
+        if self.in_writer():
+            # Вложенная запись из callable: мы уже внутри транзакции писателя
+            try: future.set_result(self._apply(self._local.cursor, op))
+            except Exception as e: future.set_exception(e)
+            return future
+        self._ensure_started()
+        self._queue.put((op, future))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, daemon=True, name="db-writer")
+                    self._thread.start()
+
+    def _apply(self, cursor, op):
+        if callable(op):
+            return op(cursor)
+        query, params = op
+        cursor.execute(query, params)
+        return cursor.rowcount
+
+    def _run(self):
+        conn = _open_connection()
+        conn.isolation_level = None  # транзакциями управляем сами
+        cursor = self._local.cursor = conn.cursor()
+        self._local.active = True
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_WINDOW
+            while len(batch) < WRITE_BATCH_MAX:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._commit_batch(conn, cursor, batch)
+
+    def _commit_batch(self, conn, cursor, batch):
+        results = []
         try:
-            conn = sqlite3.connect(DB_NAME)
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            conn.commit()
-            return # Успех
-        except sqlite3.OperationalError as e:
-            if "locked" in str(e):
-                # База занята, ждем и пробуем снова
-                time.sleep(0.1)
-                continue
-            else:
-                # Другая ошибка SQL
-                print(f"❌ SQL Error: {e}")
-                raise e
+            cursor.execute("BEGIN IMMEDIATE")
+            for op, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                # SAVEPOINT: ошибка одной записи откатывает только ее, а не весь батч
+                cursor.execute("SAVEPOINT item")
+                try:
+                    results.append((future, self._apply(cursor, op), None))
+                    cursor.execute("RELEASE item")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO item")
+                    cursor.execute("RELEASE item")
+                    print(f"❌ SQL Error: {e}")
+                    results.append((future, None, e))
+            cursor.execute("COMMIT")
         except Exception as e:
-            print(f"❌ General DB Error: {e}")
-            raise e
-        finally:
-            if conn: conn.close()
-    
-    print(f"❌ CRITICAL: Database locked after {max_retries} retries. Query failed.")
+            print(f"❌ CRITICAL: Write batch of {len(batch)} failed: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            for op, future in batch:
+                if future.running():
+                    future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None: future.set_exception(error)
+            else: future.set_result(result)
+
+    def flush(self, timeout: float = None):
+        """Waits until everything queued so far is committed."""
+        self.submit(lambda cursor: None).result(timeout)
+
+db_writer = DatabaseWriter()
+atexit.register(lambda: db_writer._thread and db_writer._thread.is_alive() and db_writer.flush(timeout=10))
+
+def submit_write(query, params=()) -> concurrent.futures.Future:
+    """Queues a write without waiting; the future resolves once it is durable."""
+    return db_writer.submit((query, params))
+
+def run_in_writer(fn):
+    """Runs fn(cursor) inside the writer's transaction and returns its result after COMMIT."""
+    return db_writer.submit(fn).result()
 
-def initialize_db():
-    conn = sqlite3.connect(DB_NAME)
-    
-    # !!! ВКЛЮЧАЕМ РЕЖИМ WAL (Write-Ahead Logging) !!!
-    # Это позволяет читать базу, пока в нее идет запись.
-    conn.execute("PRAGMA journal_mode=WAL;")
-    
-    cursor = conn.cursor()
-    
+def execute_write_query(query, params=()):
+    """
+    Выполняет запись в базу (INSERT/UPDATE/DELETE) через поток-писатель.
+    Возвращает rowcount после COMMIT; ошибки SQL пробрасываются вызывающему.
+    """
+    return db_writer.submit((query, params)).result()
+
+# --- СХЕМА И МИГРАЦИИ ---
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется один раз
+# (в своей транзакции), поэтому при старте процесса с актуальной базой - одно чтение PRAGMA.
+
+def _add_column(cursor, table: str, column: str, ddl: str):
+    if column not in {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}:
+        print(f"🔄 Adding '{column}' column to {table}...")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+def _migration_1_baseline(cursor):
+    """Tables as they were before versioning (idempotent for databases created by older code)."""
     # Таблица пользователей
     cursor.execute("""
        CREATE TABLE IF NOT EXISTS users (
@@ -94,25 +292,25 @@ def initialize_db():
             referral_code TEXT UNIQUE,
             token_balance REAL DEFAULT 0,
             is_copytrading_enabled BOOLEAN DEFAULT 1,
-            
+        
             account_balance REAL DEFAULT 1000.0,
             risk_per_trade_pct REAL DEFAULT 1.0,
             exchange_name TEXT,
             api_key_public TEXT,
             api_secret_encrypted TEXT,
             api_passphrase_encrypted TEXT,
-                   
+               
             selected_strategy TEXT DEFAULT 'bro-bot', -- bro-bot или cgt
             daily_analysis_count INTEGER DEFAULT 0,
             last_analysis_date TEXT,
             language_code TEXT DEFAULT 'en'
         )
     """)
-    
+
     cursor.execute("CREATE TABLE IF NOT EXISTS used_tx_hashes (tx_hash TEXT PRIMARY KEY)")
     cursor.execute("CREATE TABLE IF NOT EXISTS withdrawals (request_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, wallet_address TEXT, request_date TEXT, status TEXT DEFAULT 'pending')")
     cursor.execute("CREATE TABLE IF NOT EXISTS promo_codes (code TEXT PRIMARY KEY, duration_days INTEGER, is_used INTEGER DEFAULT 0, used_by_user_id INTEGER, activation_date TEXT)")
-    
+
     # Таблица сделок
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS copied_trades (
@@ -145,7 +343,7 @@ def initialize_db():
             UNIQUE(user_id, exchange_name)
         )
     """)
-    
+
     # Таблица транзакций (Top Up)
     cursor.execute("""
        CREATE TABLE IF NOT EXISTS transactions (
@@ -159,132 +357,258 @@ def initialize_db():
        )
     """)
 
+    # Колонки, добавленные после первых версий схемы (базы, созданные до миграций)
+    _add_column(cursor, "user_exchanges", "risk_pct", "REAL DEFAULT 1.0")
+    _add_column(cursor, "users", "exchange_name", "TEXT")
+    _add_column(cursor, "copied_trades", "open_date", "TEXT")
+    _add_column(cursor, "users", "selected_strategy", "TEXT DEFAULT 'bro-bot'")
+    _add_column(cursor, "users", "daily_analysis_count", "INTEGER DEFAULT 0")
+    _add_column(cursor, "users", "last_analysis_date", "TEXT")
+    _add_column(cursor, "users", "api_passphrase_encrypted", "TEXT")
+    _add_column(cursor, "users", "language_code", "TEXT DEFAULT 'en'")
+
     # --- MIGRATION: LEGACY USERS to USER_EXCHANGES ---
     # migrate legacy keys from 'users' table to 'user_exchanges' ---
     # This ensures existing users continue copying without needing to reconnect.
     try:
         cursor.execute("SELECT user_id, exchange_name, api_key_public, api_secret_encrypted, api_passphrase_encrypted, selected_strategy FROM users WHERE api_key_public IS NOT NULL AND api_key_public != ''")
         legacy_users = cursor.fetchall()
-        
+    
         for u in legacy_users:
             uid, ex_name, pub, sec, pas, strat = u
             if not ex_name: ex_name = 'binance' # Default
-            
+        
             # Use safe INSERT OR IGNORE to avoid duplicates if migration ran before
             cursor.execute("""
                 INSERT OR IGNORE INTO user_exchanges (user_id, exchange_name, api_key, api_secret_encrypted, passphrase_encrypted, strategy, created_at)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             """, (uid, ex_name.lower(), pub, sec, pas, strat, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            
+        
         if legacy_users:
             print(f"🔄 Migrated {len(legacy_users)} legacy users to 'user_exchanges'.")
-            
+        
     except Exception as e:
         print(f"⚠️ Limit migration warning: {e}")
 
-    # --- MIGRATION: ADD RISK_PCT COLUMN TO USER_EXCHANGES IF MISSING ---
-    try:
-        cursor.execute("SELECT risk_pct FROM user_exchanges LIMIT 1")
-    except sqlite3.OperationalError as err:
-        print("🔄 Adding 'risk_pct' column to user_exchanges...")
-        cursor.execute("ALTER TABLE user_exchanges ADD COLUMN risk_pct REAL DEFAULT 1.0;")
-        conn.commit()
-        print(f"✅ Migration successful. Added risk_pct.")
-    except Exception as err:
-        print(f"⚠️ Migration warning: {err}")
-
-    conn.commit()
-    
-    # Миграции (на случай, если таблица старая)
-    try: cursor.execute("ALTER TABLE users ADD COLUMN exchange_name TEXT")
-    except: pass
-    try: cursor.execute("ALTER TABLE copied_trades ADD COLUMN open_date TEXT")
-    except: pass
-    try: cursor.execute("ALTER TABLE users ADD COLUMN selected_strategy TEXT DEFAULT 'bro-bot'")
-    except: pass
-    try: cursor.execute("ALTER TABLE users ADD COLUMN daily_analysis_count INTEGER DEFAULT 0")
-    except: pass
-    try: cursor.execute("ALTER TABLE users ADD COLUMN last_analysis_date TEXT")
-    except: pass
-    try: cursor.execute("ALTER TABLE users ADD COLUMN api_passphrase_encrypted TEXT")
-    except: pass
-    try: cursor.execute("ALTER TABLE users ADD COLUMN language_code TEXT DEFAULT 'en'")
-    except: pass
-    
-    # Init Transactions Table (for migration)
-    try:
+    # Уже примененные настройки бирж (плечо) по (user, exchange, symbol) -> не шлем set_leverage повторно
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS exchange_settings (
+            user_id INTEGER,
+            exchange_name TEXT,
+            symbol TEXT,
+            setting TEXT, -- 'leverage'
+            value TEXT,
+            key_fingerprint TEXT, -- ключи сменились -> настройка считается неизвестной
+            updated_at REAL,
+            PRIMARY KEY (user_id, exchange_name, symbol, setting)
+        )
+    """)
+
+    # Журнал движений токенов (двойная запись, только INSERT). users.token_balance - его материализация.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ledger (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            txn_id TEXT NOT NULL, -- сумма amount по одному txn_id всегда 0
+            account TEXT NOT NULL, -- 'user:<id>' или счет платформы (LEDGER_*)
+            user_id INTEGER,
+            amount REAL NOT NULL,
+            kind TEXT NOT NULL, -- 'fee', 'referral', 'deposit', 'withdrawal', 'opening'
+            ref TEXT,
+            created_at TEXT
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(user_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_txn ON ledger(txn_id)")
+    # Балансы, накопленные до журнала, заносим одной проводкой "opening"
+    if not cursor.execute("SELECT 1 FROM ledger LIMIT 1").fetchone():
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         cursor.execute("""
-           CREATE TABLE IF NOT EXISTS transactions (
-                tx_hash TEXT PRIMARY KEY,
-                user_id INTEGER,
-                amount REAL,
-                currency TEXT,
-                from_address TEXT,
-                status TEXT,
-                created_at TEXT
-           )
-        """)
-    except: pass
-
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized successfully (WAL Mode ON).")
+            INSERT INTO ledger (txn_id, account, user_id, amount, kind, ref, created_at)
+            SELECT 'opening', 'user:' || user_id, user_id, token_balance, 'opening', NULL, ? FROM users WHERE token_balance != 0
+        """, (now,))
+        cursor.execute("""
+            INSERT INTO ledger (txn_id, account, user_id, amount, kind, ref, created_at)
+            SELECT 'opening', ?, NULL, -SUM(token_balance), 'opening', NULL, ? FROM users HAVING SUM(token_balance) != 0
+        """, (LEDGER_OPENING, now))
+
+def _migration_2_hot_indexes(cursor):
+    """Indexes for the worker, scanner and admin queries."""
+    # Воркер: активные подключения по стратегии (get_active_exchange_*), далее JOIN по users.user_id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_exchanges_active ON user_exchanges(is_active, strategy, user_id)")
+    # copied_trades: get_open_trade / record_trade_entry уже идут по UNIQUE(user_id, symbol, status)
+    # Рефералы / MLM и админка (referral_code уже проиндексирован через UNIQUE)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_status_join ON users(status, join_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_status_expiry ON users(status, subscription_expiry)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals(status, request_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id)")
+
+def _migration_3_last_balances(cursor):
+    """Last known exchange balances for the WebApp (stale-while-revalidate)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS exchange_balances (
+            user_id INTEGER NOT NULL,
+            exchange_name TEXT NOT NULL,
+            api_key TEXT NOT NULL,
+            balance REAL NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (user_id, exchange_name)
+        )
+    """)
+
+def _migration_4_pnl(cursor):
+    """Closed-trade history (exit price, realised PnL, fees), fills journal and PnL rollups."""
+    # UNIQUE(user_id, symbol, status) допускал одну закрытую сделку на символ: второе закрытие
+    # падало и позиция оставалась "open". Уникальной остается только открытая позиция.
+    cursor.execute("""
+        CREATE TABLE copied_trades_v2 (
+            trade_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            side TEXT NOT NULL,
+            avg_entry_price REAL DEFAULT 0,
+            total_quantity REAL DEFAULT 0,
+            open_date TEXT,
+            status TEXT DEFAULT 'open',
+            exchange_name TEXT,
+            strategy TEXT,
+            exit_price REAL,
+            realized_pnl REAL,
+            fees REAL DEFAULT 0,
+            close_date TEXT
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO copied_trades_v2 (trade_id, user_id, symbol, side, avg_entry_price, total_quantity, open_date, status)
+        SELECT trade_id, user_id, symbol, side, avg_entry_price, total_quantity, open_date, status FROM copied_trades
+    """)
+    cursor.execute("DROP TABLE copied_trades")
+    cursor.execute("ALTER TABLE copied_trades_v2 RENAME TO copied_trades")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_copied_trades_open ON copied_trades(user_id, symbol) WHERE status = 'open'")
+
+    # Каждый вход / усреднение / закрытие (история без пересчета из copied_trades)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trade_fills (
+            fill_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trade_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            exchange_name TEXT,
+            strategy TEXT,
+            symbol TEXT NOT NULL,
+            side TEXT NOT NULL,
+            kind TEXT NOT NULL, -- open / add / close
+            price REAL,
+            qty REAL,
+            realized_pnl REAL,
+            fee REAL DEFAULT 0,
+            created_at TEXT
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trade_fills_user ON trade_fills(user_id, fill_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trade_fills_trade ON trade_fills(trade_id)")
+
+    # Инкрементальные агрегаты: period = 'all' или день 'YYYY-MM-DD'
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pnl_rollups (
+            user_id INTEGER NOT NULL,
+            exchange_name TEXT NOT NULL,
+            strategy TEXT NOT NULL,
+            period TEXT NOT NULL,
+            realized_pnl REAL DEFAULT 0,
+            fees REAL DEFAULT 0,
+            volume REAL DEFAULT 0,
+            trades INTEGER DEFAULT 0,
+            wins INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, exchange_name, strategy, period)
+        ) WITHOUT ROWID
+    """)
+
+MIGRATIONS = [
+    _migration_1_baseline,
+    _migration_2_hot_indexes,
+    _migration_3_last_balances,
+    _migration_4_pnl,
+]
+
+def initialize_db():
+    conn = _connect()
+    conn.isolation_level = None  # транзакциями управляем сами
+    cursor = conn.cursor()
+    try:
+        if cursor.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+            return
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            # BEGIN IMMEDIATE: бот, сервер и воркер стартуют одновременно - мигрирует только один
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if cursor.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    cursor.execute("ROLLBACK")
+                    continue
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+                cursor.execute("COMMIT")
+                print(f"✅ DB migration {version} ({migration.__name__}) applied.")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        cursor.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+
+# Язык пользователя читается на каждый get_text -> кэш в памяти процесса.
+# save_user_language обновляет кэш сразу; смена языка из другого процесса (веб-апп)
+# подхватывается по истечении USER_LANGUAGE_CACHE_TTL.
+USER_LANGUAGE_CACHE_TTL = float(os.getenv("USER_LANGUAGE_CACHE_TTL", "300"))
+_user_languages = {}   # user_id -> (loaded_at, lang)
 
 def save_user_language(user_id: int, lang_code: str):
     """Сохраняет выбранный язык пользователя."""
     execute_write_query("UPDATE users SET language_code = ? WHERE user_id = ?", (lang_code, user_id))
+    _user_languages[user_id] = (time.monotonic(), lang_code)
 
 def get_user_language(user_id: int) -> str:
     """Возвращает код языка пользователя (по умолчанию 'en')."""
-    conn = sqlite3.connect(DB_NAME)
+    cached = _user_languages.get(user_id)
+    if cached and time.monotonic() - cached[0] < USER_LANGUAGE_CACHE_TTL:
+        return cached[1]
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT language_code FROM users WHERE user_id = ?", (user_id,))
     res = cursor.fetchone()
     conn.close()
-    return res[0] if res and res[0] else 'en'
+    lang = res[0] if res and res[0] else 'en'
+    if res:  # неизвестного пользователя не кэшируем (его еще могут создать)
+        _user_languages[user_id] = (time.monotonic(), lang)
+    return lang
 
 # --- ФУНКЦИИ КОПИ-ТРЕЙДИНГА (БЕЗОПАСНЫЕ) ---
 
 def check_analysis_limit(user_id: int, limit: int = 5) -> bool:
-    """Проверяет и обновляет дневной лимит анализов."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
+    """Проверяет и обновляет дневной лимит анализов (одно условное UPDATE в потоке-писателе)."""
     today = datetime.now().strftime("%Y-%m-%d")
-    
-    cursor.execute("SELECT daily_analysis_count, last_analysis_date FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    
-    current_count = 0
-    last_date = ""
-    
-    if row:
-        current_count = row[0] if row[0] else 0
-        last_date = row[1] if row[1] else ""
-    
-    # Если наступил новый день, сбрасываем счетчик
-    if last_date != today:
-        cursor.execute("UPDATE users SET daily_analysis_count = 1, last_analysis_date = ? WHERE user_id = ?", (today, user_id))
-        conn.commit()
-        conn.close()
-        return True
-    
-    # Если день тот же, проверяем лимит
-    if current_count < limit:
-        cursor.execute("UPDATE users SET daily_analysis_count = daily_analysis_count + 1 WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
-        return True
-    else:
-        conn.close()
-        return False
+
+    def consume(cursor):
+        # Новый день -> счетчик с 1, тот же день -> +1, только пока не достигнут лимит
+        cursor.execute("""
+            UPDATE users
+            SET daily_analysis_count = CASE WHEN last_analysis_date = ? THEN COALESCE(daily_analysis_count, 0) + 1 ELSE 1 END,
+                last_analysis_date = ?
+            WHERE user_id = ? AND (last_analysis_date IS NOT ? OR COALESCE(daily_analysis_count, 0) < ?)
+        """, (today, today, user_id, today, limit))
+        if cursor.rowcount:
+            return True
+        # Пользователя без строки в users не ограничиваем (как и раньше)
+        return cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is None
+
+    return run_in_writer(consume)
 
 def set_user_strategy(user_id: int, strategy: str):
     """Сохраняет выбранную стратегию (bro-bot или cgt)."""
     execute_write_query("UPDATE users SET selected_strategy = ? WHERE user_id = ?", (strategy, user_id))
+    invalidate_user_view(user_id)
 
 def get_user_strategy(user_id: int):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT selected_strategy FROM users WHERE user_id = ?", (user_id,))
     res = cursor.fetchone()
@@ -293,7 +617,7 @@ def get_user_strategy(user_id: int):
 
 def get_user_risk_profile(user_id: int) -> float:
     """Returns risk per trade percentage (e.g. 1.0 for 1%)."""
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT risk_per_trade_pct FROM users WHERE user_id = ?", (user_id,))
     res = cursor.fetchone()
@@ -306,7 +630,7 @@ def get_user_risk_profile(user_id: int) -> float:
 def get_users_for_copytrade(strategy: str = None) -> list:
     # LEGACY: Returns lists of user_ids. 
     # Used by checks, but worker should migrate to get_active_exchange_connections
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     if strategy:
         cursor.execute("SELECT user_id FROM users WHERE api_key_public IS NOT NULL AND api_key_public != '' AND is_copytrading_enabled = 1 AND selected_strategy = ?", (strategy,))
@@ -316,9 +640,99 @@ def get_users_for_copytrade(strategy: str = None) -> list:
     conn.close()
     return user_ids
 
+# --- КЭШ РАСШИФРОВАННЫХ КЛЮЧЕЙ (горячий путь воркера) ---
+# Список активных подключений стратегии + расшифрованные ключи живут в памяти процесса.
+# Записи через функции этого модуля сбрасывают кэш сразу, записи из других процессов
+# (бот / сервер) подхватываются по истечении CREDENTIALS_CACHE_TTL.
+CREDENTIALS_CACHE_TTL = float(os.getenv("CREDENTIALS_CACHE_TTL", "30"))
+
+_credentials_lock = threading.Lock()
+_credentials_by_strategy = {}   # strategy|None -> (loaded_at, [connection dicts])
+_decrypted_secrets = {}         # (user_id, exchange_name) -> (secret_enc, pass_enc, secret, password)
+
+
+def _decrypt_cached(user_id, exchange_name, secret_enc, pass_enc):
+    """Fernet-decrypts a key pair only if its ciphertext changed since the last call."""
+    cache_key = (user_id, exchange_name)
+    with _credentials_lock:
+        hit = _decrypted_secrets.get(cache_key)
+    if hit and hit[0] == secret_enc and hit[1] == pass_enc:
+        return hit[2], hit[3]
+
+    secret = decrypt_data(secret_enc)
+    password = decrypt_data(pass_enc) if pass_enc else None
+    with _credentials_lock:
+        _decrypted_secrets[cache_key] = (secret_enc, pass_enc, secret, password)
+    return secret, password
+
+
+def invalidate_credentials_cache(user_id: int = None):
+    """
+    Drops cached connection lists. Pass user_id when the user's keys were replaced/removed
+    to also forget their decrypted secrets (a changed ciphertext is re-decrypted anyway).
+    """
+    with _credentials_lock:
+        _credentials_by_strategy.clear()
+        if user_id is not None:
+            for k in [k for k in _decrypted_secrets if k[0] == user_id]:
+                del _decrypted_secrets[k]
+
+
+def get_active_exchange_credentials(strategy: str = None) -> list:
+    """
+    Bulk loader: all active connections of a strategy with DECRYPTED keys, in one query.
+    Dicts carry both connection fields (user_id, exchange_name, reserved_amount, risk_pct, strategy)
+    and key fields (exchange, apiKey, secret, password) so they can be passed where `keys` is expected.
+    Served from the process-local cache while fresh.
+    """
+    now = time.monotonic()
+    with _credentials_lock:
+        cached = _credentials_by_strategy.get(strategy)
+    if cached and now - cached[0] < CREDENTIALS_CACHE_TTL:
+        return cached[1]
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    query = """
+        SELECT ue.user_id, ue.exchange_name, ue.reserved_amount, ue.risk_pct, ue.strategy,
+               ue.api_key, ue.api_secret_encrypted, ue.passphrase_encrypted
+        FROM user_exchanges ue
+        JOIN users u ON ue.user_id = u.user_id
+        WHERE ue.is_active = 1 AND u.is_copytrading_enabled = 1 AND u.token_balance > 0
+    """
+    params = []
+    if strategy:
+        query += " AND ue.strategy = ?"
+        params.append(strategy)
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    conn.close()
+
+    connections = []
+    for uid, ex_name, reserved, risk_pct, strat, pub, sec_enc, pass_enc in rows:
+        if not sec_enc: continue
+        secret, password = _decrypt_cached(uid, ex_name, sec_enc, pass_enc)
+        if not secret: continue
+        connections.append({
+            "user_id": uid,
+            "exchange_name": ex_name,
+            "reserved_amount": reserved or 0.0,
+            "risk_pct": risk_pct,
+            "strategy": strat,
+            "exchange": ex_name,
+            "apiKey": pub,
+            "secret": secret,
+            "password": password,
+        })
+
+    with _credentials_lock:
+        _credentials_by_strategy[strategy] = (now, connections)
+    return connections
+
+
 def get_active_exchange_connections(strategy: str = None) -> list:
     """Returns list of dicts: {user_id, exchange_name, reserved_amount, strategy}"""
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -365,13 +779,75 @@ def save_user_api_keys(user_id: int, exchange: str, public_key: str, secret_key:
 
 # database.py
 
-def get_referral_counts(user_id: int) -> dict:
-    conn = sqlite3.connect(DB_NAME)
+# --- READ-MODEL ПОЛЬЗОВАТЕЛЯ (хендлеры бота / веб-аппа) ---
+# Профиль, статус, биржи и число рефералов собираются одним заходом в базу и живут в
+# памяти процесса. Писатели этого модуля сбрасывают вид пользователя сразу
+# (invalidate_user_view), записи других процессов (биллинг воркера) - по USER_VIEW_CACHE_TTL.
+USER_VIEW_CACHE_TTL = float(os.getenv("USER_VIEW_CACHE_TTL", "30"))
+_user_views = {}   # user_id -> (loaded_at, view)
+
+def _load_user_view(user_id: int) -> dict | None:
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users WHERE referrer_id = ?", (user_id,))
-    l1_ids = [row[0] for row in cursor.fetchall()]
-    l1_count = len(l1_ids)
-    return {"l1": l1_count}
+    cursor.execute("""
+        SELECT u.join_date, u.status, u.subscription_expiry, u.referral_code, u.token_balance, u.account_balance,
+               u.risk_per_trade_pct, u.referrer_id, u.selected_strategy, u.is_copytrading_enabled,
+               (SELECT COUNT(*) FROM users r WHERE r.referrer_id = u.user_id) AS l1
+        FROM users u WHERE u.user_id = ?
+    """, (user_id,))
+    user = cursor.fetchone()
+    if not user:
+        conn.close()
+        return None
+    cursor.execute("SELECT * FROM user_exchanges WHERE user_id = ? AND is_active = 1", (user_id,))
+    exchanges = [dict(r) for r in cursor.fetchall()]
+    # PnL: готовые агрегаты (все время + сегодня) и открытые позиции для mark-to-market
+    cursor.execute("""
+        SELECT exchange_name, strategy, period, realized_pnl, fees, volume, trades, wins
+        FROM pnl_rollups WHERE user_id = ? AND period IN ('all', ?)
+    """, (user_id, datetime.now().strftime("%Y-%m-%d")))
+    pnl_rollups = [dict(r) for r in cursor.fetchall()]
+    cursor.execute("""
+        SELECT symbol, side, avg_entry_price, total_quantity, exchange_name, strategy, open_date
+        FROM copied_trades WHERE user_id = ? AND status = 'open'
+    """, (user_id,))
+    open_trades = [dict(r) for r in cursor.fetchall()]
+    conn.close()
+    return {
+        "user_id": user_id,
+        "join_date": user["join_date"], "status": user["status"], "expiry": user["subscription_expiry"],
+        "ref_code": user["referral_code"], "balance": user["token_balance"] or 0,
+        "account_balance": user["account_balance"] or 1000, "risk_pct": user["risk_per_trade_pct"] or 1,
+        "referrer_id": user["referrer_id"], "strategy": user["selected_strategy"],
+        "copytrading_enabled": bool(user["is_copytrading_enabled"]),
+        "exchanges": exchanges,
+        "referrals": {"l1": user["l1"]},
+        "pnl_rollups": pnl_rollups,
+        "open_trades": open_trades,
+    }
+
+def get_user_view(user_id: int) -> dict | None:
+    """Complete cached view of a user (None if the user does not exist). Treat as read-only."""
+    cached = _user_views.get(user_id)
+    if cached and time.monotonic() - cached[0] < USER_VIEW_CACHE_TTL:
+        return cached[1]
+    loaded_at = time.monotonic()
+    view = _load_user_view(user_id)
+    if view is not None:
+        _user_views[user_id] = (loaded_at, view)
+    return view
+
+def invalidate_user_view(*user_ids):
+    """Drops cached views of the given users (all users when called without arguments)."""
+    if not user_ids:
+        _user_views.clear()
+    for user_id in user_ids:
+        _user_views.pop(user_id, None)
+
+def get_referral_counts(user_id: int) -> dict:
+    view = get_user_view(user_id)
+    return dict(view["referrals"]) if view else {"l1": 0}
 
 # def get_user_decrypted_keys(user_id: int):
 #     conn = sqlite3.connect(DB_NAME)
@@ -387,7 +863,7 @@ def get_referral_counts(user_id: int) -> dict:
 
 
 def get_user_decrypted_keys(user_id: int, exchange_name: str = None):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # 1. New Table Lookup
@@ -404,11 +880,12 @@ def get_user_decrypted_keys(user_id: int, exchange_name: str = None):
     if res:
         ex_name, pub, sec_enc, pass_enc, res_amt = res
         conn.close()
+        secret, password = _decrypt_cached(user_id, ex_name, sec_enc, pass_enc)
         return {
             "exchange": ex_name,
             "apiKey": pub,
-            "secret": decrypt_data(sec_enc),
-            "password": decrypt_data(pass_enc) if pass_enc else None,
+            "secret": secret,
+            "password": password,
             "reserved_amount": res_amt or 0.0
         }
 
@@ -464,57 +941,76 @@ def get_user_decrypted_keys(user_id: int, exchange_name: str = None):
 #         """, (user_id, symbol, side, price, quantity, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 #         print(f"   -> DB: Recorded NEW position for user {user_id}.")
 
-def record_trade_entry(user_id: int, symbol: str, side: str, price: float, quantity: float):
+def trade_pnl(side: str, entry_price: float, exit_price: float, quantity: float) -> float:
+    """PnL of a position opened on `side` at entry_price and valued at exit_price."""
+    return (exit_price - entry_price) * quantity if side == 'buy' else (entry_price - exit_price) * quantity
+
+def _trade_strategy(cursor, user_id: int, exchange: str):
+    if not exchange:
+        return None
+    row = cursor.execute("SELECT strategy FROM user_exchanges WHERE user_id = ? AND exchange_name = ?", (user_id, exchange)).fetchone()
+    return row[0] if row else None
+
+def _add_fill(cursor, trade_id, user_id, exchange, strategy, symbol, side, kind, price, qty, pnl=None, fee=0.0):
+    cursor.execute("""
+        INSERT INTO trade_fills (trade_id, user_id, exchange_name, strategy, symbol, side, kind, price, qty, realized_pnl, fee, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (trade_id, user_id, exchange, strategy, symbol, side, kind, price, qty, pnl, fee, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+def _add_rollup(cursor, user_id, exchange, strategy, pnl=0.0, fees=0.0, volume=0.0, trades=0, wins=0):
+    """Adds to the all-time and today's rollup rows of (user, exchange, strategy)."""
+    rows = [(user_id, exchange or '', strategy or '', period, pnl, fees, volume, trades, wins)
+            for period in ('all', datetime.now().strftime("%Y-%m-%d"))]
+    cursor.executemany("""
+        INSERT INTO pnl_rollups (user_id, exchange_name, strategy, period, realized_pnl, fees, volume, trades, wins)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, exchange_name, strategy, period) DO UPDATE SET
+            realized_pnl = realized_pnl + excluded.realized_pnl, fees = fees + excluded.fees,
+            volume = volume + excluded.volume, trades = trades + excluded.trades, wins = wins + excluded.wins
+    """, rows)
+
+def record_trade_entry(user_id: int, symbol: str, side: str, price: float, quantity: float, exchange: str = None):
     """
-    Записывает вход или усреднение.
-    Использует логику 'Попробуй вставить, если занято - обнови' (Upsert-like logic).
+    Записывает вход или усреднение (+ строка в trade_fills и объем в pnl_rollups).
+    Чтение и запись выполняются внутри транзакции писателя, поэтому гонки между
+    параллельными входами по одному символу больше нет.
     """
-    conn = sqlite3.connect(DB_NAME)
-    # Включаем WAL для скорости
-    conn.execute("PRAGMA journal_mode=WAL;") 
-    cursor = conn.cursor()
-    
-    try:
+    def _upsert(cursor):
         # 1. Сначала пробуем найти открытую сделку
-        cursor.execute("SELECT trade_id, avg_entry_price, total_quantity FROM copied_trades WHERE user_id = ? AND symbol = ? AND status = 'open'", (user_id, symbol))
+        cursor.execute("SELECT trade_id, avg_entry_price, total_quantity, exchange_name, strategy FROM copied_trades WHERE user_id = ? AND symbol = ? AND status = 'open'", (user_id, symbol))
         existing_trade = cursor.fetchone()
-        
+
         if existing_trade:
             # УСРЕДНЕНИЕ (DCA)
-            trade_id, old_price, old_qty = existing_trade
+            trade_id, old_price, old_qty, trade_exchange, strategy = existing_trade
             new_total_qty = old_qty + quantity
             # Формула средней цены: (СтараяЦена * СтароеКолво + НоваяЦена * НовоеКолво) / ОбщееКолво
             new_avg_price = ((old_price * old_qty) + (price * quantity)) / new_total_qty
-            
+
             cursor.execute("UPDATE copied_trades SET avg_entry_price = ?, total_quantity = ? WHERE trade_id = ?", (new_avg_price, new_total_qty, trade_id))
+            kind = 'add'
             print(f"   -> DB: Averaged position for user {user_id}. New Qty: {new_total_qty:.4f}")
         else:
             # НОВАЯ СДЕЛКА
-            # Используем INSERT OR IGNORE, чтобы не падать с ошибкой, если запись появилась за миллисекунду до этого
-            try:
-                cursor.execute("""
-                    INSERT INTO copied_trades (user_id, symbol, side, avg_entry_price, total_quantity, open_date, status)
-                    VALUES (?, ?, ?, ?, ?, ?, 'open')
-                """, (user_id, symbol, side, price, quantity, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-                print(f"   -> DB: Recorded NEW position for user {user_id}.")
-            except sqlite3.IntegrityError:
-                # Если сработал UNIQUE constraint, значит сделка УЖЕ есть (гонка данных).
-                # В этом случае мы рекурсивно вызываем сами себя, чтобы попасть в ветку "УСРЕДНЕНИЕ"
-                print(f"   -> DB: Race condition detected. Switching to Average mode.")
-                conn.close()
-                time.sleep(0.1)
-                record_trade_entry(user_id, symbol, side, price, quantity)
-                return
-
-        conn.commit()
+            trade_exchange, strategy = exchange, _trade_strategy(cursor, user_id, exchange)
+            cursor.execute("""
+                INSERT INTO copied_trades (user_id, symbol, side, avg_entry_price, total_quantity, open_date, status, exchange_name, strategy)
+                VALUES (?, ?, ?, ?, ?, ?, 'open', ?, ?)
+            """, (user_id, symbol, side, price, quantity, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), trade_exchange, strategy))
+            trade_id, kind = cursor.lastrowid, 'open'
+            print(f"   -> DB: Recorded NEW position for user {user_id}.")
+
+        _add_fill(cursor, trade_id, user_id, trade_exchange, strategy, symbol, side, kind, price, quantity)
+        _add_rollup(cursor, user_id, trade_exchange, strategy, volume=price * quantity)
+
+    try:
+        run_in_writer(_upsert)
+        invalidate_user_view(user_id)
     except Exception as e:
         print(f"❌ DB Record Error: {e}")
-    finally:
-        try: conn.close()
-        except: pass
 
 def get_open_trade(user_id: int, symbol: str):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT side, avg_entry_price, total_quantity FROM copied_trades WHERE user_id = ? AND symbol = ? AND status = 'open'", (user_id, symbol))
     result = cursor.fetchone()
@@ -522,18 +1018,72 @@ def get_open_trade(user_id: int, symbol: str):
     if not result: return None
     return {"side": result[0], "entry_price": result[1], "quantity": result[2]}
 
-def close_trade_in_db(user_id: int, symbol: str):
+def close_trade_in_db(user_id: int, symbol: str, exit_price: float = None, pnl: float = None, fee: float = 0.0, exchange: str = None):
+    """
+    Закрывает открытую сделку, сохраняя цену выхода, реализованный PnL и комиссию,
+    и добавляет результат в pnl_rollups. PnL без явного значения считается от средней
+    цены входа (None, если цена выхода неизвестна - такая сделка в агрегаты не попадает).
+    Возвращает PnL (None, если открытой сделки не было).
+    """
+    def _close(cursor):
+        cursor.execute("SELECT trade_id, side, avg_entry_price, total_quantity, exchange_name, strategy FROM copied_trades WHERE user_id = ? AND symbol = ? AND status = 'open'", (user_id, symbol))
+        trade = cursor.fetchone()
+        if not trade:
+            return None
+        trade_id, side, entry_price, quantity, trade_exchange, strategy = trade
+        trade_exchange = trade_exchange or exchange
+        strategy = strategy or _trade_strategy(cursor, user_id, trade_exchange)
+        realized = pnl
+        if realized is None and exit_price:
+            realized = trade_pnl(side, entry_price, exit_price, quantity)
+
+        cursor.execute("""
+            UPDATE copied_trades SET status = 'closed', exit_price = ?, realized_pnl = ?, fees = ?, close_date = ?,
+                                     exchange_name = ?, strategy = ?
+            WHERE trade_id = ?
+        """, (exit_price, realized, fee, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), trade_exchange, strategy, trade_id))
+        _add_fill(cursor, trade_id, user_id, trade_exchange, strategy, symbol, 'sell' if side == 'buy' else 'buy', 'close',
+                  exit_price, quantity, realized, fee)
+        if realized is not None:
+            _add_rollup(cursor, user_id, trade_exchange, strategy, pnl=realized, fees=fee,
+                        volume=(exit_price or 0) * quantity, trades=1, wins=int(realized > 0))
+        return realized
+
+    realized = run_in_writer(_close)
+    invalidate_user_view(user_id)
+    print(f"   -> DB: Closed position for user {user_id}.")
+    return realized
+
+def get_exchange_settings() -> list:
+    """All remembered exchange-side settings (used to warm the worker's leverage cache)."""
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, exchange_name, symbol, setting, value, key_fingerprint, updated_at FROM exchange_settings")
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+def save_exchange_setting(user_id: int, exchange_name: str, symbol: str, setting: str, value: str, key_fingerprint: str, updated_at: float):
     execute_write_query(
-        "UPDATE copied_trades SET status = 'closed' WHERE user_id = ? AND symbol = ? AND status = 'open'", 
-        (user_id, symbol)
+        """INSERT OR REPLACE INTO exchange_settings (user_id, exchange_name, symbol, setting, value, key_fingerprint, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (user_id, exchange_name, symbol, setting, value, key_fingerprint, updated_at)
     )
-    print(f"   -> DB: Closed position for user {user_id}.")
+
+def delete_exchange_settings(user_id: int, exchange_name: str, symbol: str = None):
+    if symbol:
+        execute_write_query("DELETE FROM exchange_settings WHERE user_id = ? AND exchange_name = ? AND symbol = ?", (user_id, exchange_name, symbol))
+    else:
+        execute_write_query("DELETE FROM exchange_settings WHERE user_id = ? AND exchange_name = ?", (user_id, exchange_name))
 
 def set_copytrading_status(user_id: int, is_enabled: bool):
     execute_write_query(
         "UPDATE users SET is_copytrading_enabled = ? WHERE user_id = ?", 
         (1 if is_enabled else 0, user_id)
     )
+    invalidate_credentials_cache()
+    invalidate_user_view(user_id)
     status = "ENABLED" if is_enabled else "DISABLED"
     print(f"COPY TRADING for user {user_id} has been {status}.")
 
@@ -543,7 +1093,7 @@ def set_copytrading_status(user_id: int, is_enabled: bool):
 def get_referrer_upline(user_id: int, levels: int = 3) -> list:
     chain = []
     current_id = user_id
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     
     for _ in range(levels):
@@ -561,37 +1111,129 @@ def get_referrer_upline(user_id: int, levels: int = 3) -> list:
     conn.close()
     return chain
 
-def deduct_performance_fee(user_id: int, fee_amount: float) -> float:
-    # 1. Списываем (Безопасная запись)
-    execute_write_query(
-        "UPDATE users SET token_balance = token_balance - ? WHERE user_id = ?", 
-        (fee_amount, user_id)
+# --- ЖУРНАЛ ТОКЕНОВ (ДВОЙНАЯ ЗАПИСЬ) ---
+LEDGER_FEES = 'platform:fees'
+LEDGER_DEPOSITS = 'platform:deposits'
+LEDGER_WITHDRAWALS = 'platform:withdrawals'
+LEDGER_OPENING = 'platform:opening'
+REFERRAL_PERCENTAGES = [0.20, 0.07, 0.03]  # доля комиссии для уровней 1-3
+
+def _user_account(user_id: int) -> str:
+    return f"user:{user_id}"
+
+def _post_ledger(cursor, kind: str, entries: list, ref: str = None) -> str:
+    """
+    Writes one balanced transaction: entries = [(account, user_id, amount), ...] summing to 0.
+    Balances of user accounts are moved in the same transaction. Call only inside run_in_writer.
+    """
+    if abs(sum(amount for _, _, amount in entries)) > 1e-9:
+        raise ValueError(f"Unbalanced ledger transaction {kind}: {entries}")
+    txn_id = uuid.uuid4().hex
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.executemany(
+        "INSERT INTO ledger (txn_id, account, user_id, amount, kind, ref, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(txn_id, account, uid, amount, kind, ref, now) for account, uid, amount in entries]
     )
-    
-    # 2. Получаем новый баланс (Чтение)
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT token_balance FROM users WHERE user_id = ?", (user_id,))
-    res = cursor.fetchone()
-    conn.close()
-    
+    cursor.executemany(
+        "UPDATE users SET token_balance = token_balance + ? WHERE user_id = ?",
+        [(amount, uid) for _, uid, amount in entries if uid is not None]
+    )
+    return txn_id
+
+def _upline(cursor, user_id: int, levels: int) -> list:
+    chain, current_id = [], user_id
+    for _ in range(levels):
+        res = cursor.execute("SELECT referrer_id FROM users WHERE user_id = ?", (current_id,)).fetchone()
+        if not res or not res[0] or res[0] in chain or res[0] == user_id:
+            break
+        chain.append(res[0])
+        current_id = res[0]
+    return chain
+
+def bill_performance_fee(user_id: int, fee_amount: float, ref: str = None) -> tuple[float, list]:
+    """
+    Списывает комиссию и раздает реферальные награды одной проводкой.
+    Returns (new_balance, [(level, referrer_id, reward), ...]).
+    """
+    def _bill(cursor):
+        upline = _upline(cursor, user_id, len(REFERRAL_PERCENTAGES))
+        rewards = [(i + 1, rid, fee_amount * REFERRAL_PERCENTAGES[i]) for i, rid in enumerate(upline)]
+        entries = [(_user_account(user_id), user_id, -fee_amount)]
+        entries += [(_user_account(rid), rid, reward) for _, rid, reward in rewards]
+        entries.append((LEDGER_FEES, None, fee_amount - sum(r for _, _, r in rewards)))
+        _post_ledger(cursor, 'fee', entries, ref)
+        res = cursor.execute("SELECT token_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return (res[0] if res else 0), rewards
+
+    new_balance, rewards = run_in_writer(_bill)
+    invalidate_user_view(user_id, *(rid for _, rid, _ in rewards))
+    if new_balance <= 0 or rewards: invalidate_credentials_cache()
+    print(f"   -> BILLING: Deducted {fee_amount:.2f}. New balance: {new_balance:.2f}")
+    return new_balance, rewards
+
+def deduct_performance_fee(user_id: int, fee_amount: float) -> float:
+    """Fee without referral split (whole amount to the platform)."""
+    def _deduct(cursor):
+        _post_ledger(cursor, 'fee', [(_user_account(user_id), user_id, -fee_amount), (LEDGER_FEES, None, fee_amount)])
+        return cursor.execute("SELECT token_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+
+    res = run_in_writer(_deduct)
+    invalidate_user_view(user_id)
     new_balance = res[0] if res else 0
+    if new_balance <= 0: invalidate_credentials_cache()
     print(f"   -> BILLING: Deducted {fee_amount:.2f}. New balance: {new_balance:.2f}")
     return new_balance
 
+def get_ledger_entries(user_id: int, limit: int = 50) -> list:
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute("SELECT txn_id, amount, kind, ref, created_at FROM ledger WHERE user_id = ? ORDER BY entry_id DESC LIMIT ?", (user_id, limit))
+    rows = [dict(r) for r in cursor.fetchall()]
+    conn.close()
+    return rows
+
 def get_all_users_with_keys() -> list:
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id FROM users WHERE api_key_public IS NOT NULL AND api_key_public != ''")
     users = [row[0] for row in cursor.fetchall()]
     conn.close()
     return users
 
-def credit_tokens_from_payment(user_id: int, amount_usd: float):
-    execute_write_query(
-        "UPDATE users SET token_balance = token_balance + ? WHERE user_id = ?", 
-        (amount_usd, user_id)
-    )
+def is_topup_recorded(tx_hash: str) -> bool:
+    conn = get_connection()
+    res = conn.cursor().execute("SELECT 1 FROM transactions WHERE tx_hash = ?", (tx_hash,)).fetchone()
+    conn.close()
+    return res is not None
+
+def record_topup(tx_hash: str, user_id: int, amount: float, from_address: str) -> bool:
+    """
+    Записывает on-chain пополнение и начисляет токены одной транзакцией.
+    False, если этот tx_hash уже засчитан (в т.ч. параллельным запросом).
+    """
+    def _record(cursor):
+        try:
+            cursor.execute("""
+                INSERT INTO transactions (tx_hash, user_id, amount, currency, from_address, status, created_at)
+                VALUES (?, ?, ?, 'USDT', ?, 'success', ?)
+            """, (tx_hash, user_id, amount, from_address, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        except sqlite3.IntegrityError:
+            return False
+        _post_ledger(cursor, 'deposit', [(_user_account(user_id), user_id, amount), (LEDGER_DEPOSITS, None, -amount)], f"bsc:{tx_hash}")
+        return True
+
+    ok = run_in_writer(_record)
+    if ok:
+        invalidate_credentials_cache()
+        invalidate_user_view(user_id)
+        print(f"💰 Credited {amount} tokens to user {user_id}.")
+    return ok
+
+def credit_tokens_from_payment(user_id: int, amount_usd: float, ref: str = None):
+    run_in_writer(lambda cursor: _post_ledger(cursor, 'deposit', [(_user_account(user_id), user_id, amount_usd), (LEDGER_DEPOSITS, None, -amount_usd)], ref))
+    invalidate_credentials_cache()
+    invalidate_user_view(user_id)
     print(f"💰 Credited {amount_usd} tokens to user {user_id}.")
 
 # --- ОСТАЛЬНЫЕ ФУНКЦИИ (АДАПТИРОВАННЫЕ ПОД НОВЫЙ СТИЛЬ) ---
@@ -599,7 +1241,7 @@ def credit_tokens_from_payment(user_id: int, amount_usd: float):
 UserStatus = Literal["pending_payment", "active", "expired"]
 
 def add_user(user_id: int, username: str = None, referrer_id: int = None) -> bool:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
+    conn = get_connection(); cursor = conn.cursor()
     cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
     if not cursor.fetchone():
         join_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -610,30 +1252,30 @@ def add_user(user_id: int, username: str = None, referrer_id: int = None) -> boo
             "INSERT INTO users (user_id, username, join_date, referrer_id, referral_code, status, account_balance, risk_per_trade_pct) VALUES (?, ?, ?, ?, ?, 'active', 1000.0, 1.0)", 
             (user_id, username, join_date, referrer_id, ref_code)
         )
+        if referrer_id: invalidate_user_view(referrer_id)  # у реферера +1 в счетчике
         return True
     else:
         conn.close()
         return False
 
 def get_user_status(user_id: int) -> UserStatus | None:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-    cursor.execute("SELECT status FROM users WHERE user_id = ?", (user_id,)); result = cursor.fetchone()
-    conn.close(); return result[0] if result else None
+    view = get_user_view(user_id)
+    return view["status"] if view else None
 
 def activate_user(user_id: int):
     execute_write_query("UPDATE users SET status = 'active' WHERE user_id = ?", (user_id,))
+    invalidate_user_view(user_id)
 
 def activate_user_subscription(user_id: int, duration_days: int = 30) -> int | None:
     expiry = (datetime.now() + timedelta(days=duration_days)).strftime("%Y-%m-%d")
     execute_write_query("UPDATE users SET status = 'active', subscription_expiry = ? WHERE user_id = ?", (expiry, user_id))
-    
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-    cursor.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,)); referrer = cursor.fetchone()
-    conn.close(); return referrer[0] if referrer else None
+    invalidate_user_view(user_id)
+    view = get_user_view(user_id)
+    return view["referrer_id"] if view else None
 
 
 def get_all_active_user_ids() -> list[int]:
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id FROM users WHERE status = 'active'")
     user_ids = [row[0] for row in cursor.fetchall()]
@@ -641,20 +1283,19 @@ def get_all_active_user_ids() -> list[int]:
     return user_ids
 
 def get_user_profile(user_id: int) -> dict | None:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
-    cursor.execute("SELECT join_date, status, subscription_expiry, referral_code, token_balance, account_balance, risk_per_trade_pct FROM users WHERE user_id = ?", (user_id,))
-    res = cursor.fetchone(); conn.close()
-    if not res: return None
-    return {"join_date": res[0], "status": res[1], "expiry": res[2], "ref_code": res[3], "balance": res[4] or 0, "account_balance": res[5] or 1000, "risk_pct": res[6] or 1}
+    view = get_user_view(user_id)
+    if not view: return None
+    return {k: view[k] for k in ("join_date", "status", "expiry", "ref_code", "balance", "account_balance", "risk_pct")}
 
 def get_user_risk_settings(user_id: int) -> dict:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
+    conn = get_connection(); cursor = conn.cursor()
     cursor.execute("SELECT account_balance, risk_per_trade_pct FROM users WHERE user_id = ?", (user_id,))
     res = cursor.fetchone(); conn.close()
     return {"balance": res[0], "risk_pct": res[1]} if res else {"balance": 1000, "risk_pct": 1}
 
 def update_user_risk_settings(user_id: int, balance: float, risk_pct: float):
     execute_write_query("UPDATE users SET account_balance = ?, risk_per_trade_pct = ? WHERE user_id = ?", (balance, risk_pct, user_id))
+    invalidate_user_view(user_id)
 
 # --- MULTI-EXCHANGE MANAGEMENT ---
 
@@ -666,7 +1307,7 @@ def save_user_exchange(user_id: int, exchange: str, api_key: str, secret_key: st
     
     # Upsert logic (INSERT OR REPLACE) - но лучше проверить, чтобы не затереть reserved_amount если он есть
     # Поэтому делаем INSERT ON CONFLICT DO UPDATE
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
+    conn = get_connection(); cursor = conn.cursor()
     
     # Проверяем, есть ли запись
     cursor.execute("SELECT id FROM user_exchanges WHERE user_id = ? AND exchange_name = ?", (user_id, exchange))
@@ -687,10 +1328,11 @@ def save_user_exchange(user_id: int, exchange: str, api_key: str, secret_key: st
         """, (user_id, exchange, api_key, encrypted_secret, encrypted_pass, strategy, created_at))
     
     conn.close()
+    invalidate_credentials_cache(user_id)
 
 def get_user_exchanges(user_id: int) -> list[dict]:
     """Возвращает список всех подключенных бирж пользователя."""
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM user_exchanges WHERE user_id = ? AND is_active = 1", (user_id,))
@@ -705,10 +1347,12 @@ def get_user_exchanges(user_id: int) -> list[dict]:
 def update_exchange_reserve(user_id: int, exchange: str, reserve_amount: float):
     """Обновляет сумму резерва для конкретной биржи."""
     execute_write_query("UPDATE user_exchanges SET reserved_amount = ? WHERE user_id = ? AND exchange_name = ?", (reserve_amount, user_id, exchange))
+    invalidate_credentials_cache()
 
 def delete_user_exchange(user_id: int, exchange: str):
     """Удаляет (или помечает неактивной) биржу."""
     execute_write_query("UPDATE user_exchanges SET is_active = 0 WHERE user_id = ? AND exchange_name = ?", (user_id, exchange))
+    invalidate_credentials_cache(user_id)
 
 # Backwards compatibility wrapper (if needed for old single-exchange calls, though we should refactor them too)
 def save_user_api_keys(user_id: int, exchange: str, api_key: str, secret_key: str, passphrase: str = None):
@@ -729,7 +1373,7 @@ def save_user_exchange(user_id: int, exchange: str, api_key: str, secret_key: st
     
     # Upsert logic (INSERT OR REPLACE) - но лучше проверить, чтобы не затереть reserved_amount если он есть
     # Поэтому делаем INSERT ON CONFLICT DO UPDATE
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
+    conn = get_connection(); cursor = conn.cursor()
     
     # Проверяем, есть ли запись
     cursor.execute("SELECT id FROM user_exchanges WHERE user_id = ? AND exchange_name = ?", (user_id, exchange))
@@ -750,32 +1394,65 @@ def save_user_exchange(user_id: int, exchange: str, api_key: str, secret_key: st
         """, (user_id, exchange, api_key, encrypted_secret, encrypted_pass, strategy, created_at))
     
     conn.close()
+    invalidate_credentials_cache(user_id)
+    invalidate_user_view(user_id)
+
+def upsert_user_exchange(user_id: int, exchange: str, api_key: str, secret_key: str, passphrase: str = None, strategy: str = 'bro-bot', reserve: float = 0.0):
+    """Подключение из веб-аппа: ключи, стратегия и резерв одной записью (is_active = 1)."""
+    encrypted_secret = encrypt_data(secret_key)
+    encrypted_pass = encrypt_data(passphrase) if passphrase else None
+    execute_write_query("""
+        INSERT INTO user_exchanges (user_id, exchange_name, api_key, api_secret_encrypted, passphrase_encrypted, strategy, reserved_amount, is_active, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 1, datetime('now'))
+        ON CONFLICT(user_id, exchange_name) DO UPDATE SET
+        api_key=excluded.api_key,
+        api_secret_encrypted=excluded.api_secret_encrypted,
+        passphrase_encrypted=excluded.passphrase_encrypted,
+        strategy=excluded.strategy,
+        reserved_amount=excluded.reserved_amount,
+        is_active=1
+    """, (user_id, exchange, api_key, encrypted_secret, encrypted_pass, strategy, reserve))
+    invalidate_credentials_cache(user_id)
+    invalidate_user_view(user_id)
 
 def get_user_exchanges(user_id: int) -> list[dict]:
     """Возвращает список всех подключенных бирж пользователя."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM user_exchanges WHERE user_id = ? AND is_active = 1", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    
-    exchanges = []
-    for row in rows:
-        exchanges.append(dict(row))
-    return exchanges
+    view = get_user_view(user_id)
+    return [dict(ex) for ex in view["exchanges"]] if view else []
 
 def update_exchange_reserve(user_id: int, exchange: str, reserve_amount: float):
     """Обновляет сумму резерва для конкретной биржи."""
     execute_write_query("UPDATE user_exchanges SET reserved_amount = ? WHERE user_id = ? AND exchange_name = ?", (reserve_amount, user_id, exchange))
+    invalidate_credentials_cache()
+    invalidate_user_view(user_id)
+
+def get_last_balances(user_id: int) -> dict:
+    """{exchange_name: (api_key, balance, fetched_at)} - last balances seen on the exchanges."""
+    conn = get_connection()
+    rows = conn.cursor().execute(
+        "SELECT exchange_name, api_key, balance, fetched_at FROM exchange_balances WHERE user_id = ?", (user_id,)
+    ).fetchall()
+    conn.close()
+    return {r[0]: (r[1], r[2], r[3]) for r in rows}
+
+def save_last_balance(user_id: int, exchange: str, api_key: str, balance: float, fetched_at: float):
+    # Без ожидания коммита: это только кэш для следующего открытия веб-аппа
+    submit_write(
+        "INSERT OR REPLACE INTO exchange_balances (user_id, exchange_name, api_key, balance, fetched_at) VALUES (?, ?, ?, ?, ?)",
+        (user_id, exchange, api_key, balance, fetched_at)
+    )
 
 def update_exchange_risk(user_id: int, exchange: str, risk_pct: float):
     """Обновляет риск на сделку для конкретной биржи."""
     execute_write_query("UPDATE user_exchanges SET risk_pct = ? WHERE user_id = ? AND exchange_name = ?", (risk_pct, user_id, exchange))
+    invalidate_credentials_cache()
+    invalidate_user_view(user_id)
 
 def delete_user_exchange(user_id: int, exchange: str):
     """Удаляет (или помечает неактивной) биржу."""
     execute_write_query("DELETE FROM user_exchanges WHERE user_id = ? AND exchange_name = ?", (user_id, exchange))
+    invalidate_credentials_cache(user_id)
+    invalidate_user_view(user_id)
 
 # Backwards compatibility wrapper (if needed for old single-exchange calls, though we should refactor them too)
 def save_user_api_keys(user_id: int, exchange: str, api_key: str, secret_key: str, passphrase: str = None):
@@ -787,30 +1464,31 @@ def save_user_api_keys(user_id: int, exchange: str, api_key: str, secret_key: st
 
 
 def credit_referral_tokens(user_id: int, amount: float):
-    execute_write_query("UPDATE users SET token_balance = token_balance + ? WHERE user_id = ?", (amount, user_id))
+    run_in_writer(lambda cursor: _post_ledger(cursor, 'referral', [(_user_account(user_id), user_id, amount), (LEDGER_FEES, None, -amount)]))
+    invalidate_user_view(user_id)
 
 def get_referrer(user_id: int) -> int | None:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
+    conn = get_connection(); cursor = conn.cursor()
     cursor.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,)); res = cursor.fetchone()
     conn.close(); return res[0] if res else None
 def get_users_with_api_keys() -> list:
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id FROM users WHERE api_key_public IS NOT NULL AND api_key_public != ''")
     user_ids = [row[0] for row in cursor.fetchall()]
     conn.close()
     return user_ids
 def is_tx_hash_used(tx_hash: str) -> bool:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); cursor.execute("SELECT tx_hash FROM used_tx_hashes WHERE tx_hash = ?", (tx_hash,)); res = cursor.fetchone(); conn.close(); return res is not None
+    conn = get_connection(); cursor = conn.cursor(); cursor.execute("SELECT tx_hash FROM used_tx_hashes WHERE tx_hash = ?", (tx_hash,)); res = cursor.fetchone(); conn.close(); return res is not None
 
 def mark_tx_hash_as_used(tx_hash: str):
     execute_write_query("INSERT OR IGNORE INTO used_tx_hashes (tx_hash) VALUES (?)", (tx_hash,))
 
 def get_user_by_referral_code(code: str) -> int | None:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); cursor.execute("SELECT user_id FROM users WHERE referral_code = ?", (code,)); res = cursor.fetchone(); conn.close(); return res[0] if res else None
+    conn = get_connection(); cursor = conn.cursor(); cursor.execute("SELECT user_id FROM users WHERE referral_code = ?", (code,)); res = cursor.fetchone(); conn.close(); return res[0] if res else None
 
 def validate_and_use_promo_code(code: str, user_id: int) -> int | None:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); cursor.execute("SELECT duration_days FROM promo_codes WHERE code = ? AND is_used = 0", (code.upper(),)); res = cursor.fetchone()
+    conn = get_connection(); cursor = conn.cursor(); cursor.execute("SELECT duration_days FROM promo_codes WHERE code = ? AND is_used = 0", (code.upper(),)); res = cursor.fetchone()
     if not res: conn.close(); return None
     date = datetime.now().strftime("%Y-%m-%d %H:%M:%S"); 
     conn.close()
@@ -819,15 +1497,17 @@ def validate_and_use_promo_code(code: str, user_id: int) -> int | None:
     return res[0]
 
 def create_withdrawal_request(user_id: int, amount: float, wallet: str) -> bool:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); cursor.execute("SELECT token_balance FROM users WHERE user_id = ?", (user_id,)); res = cursor.fetchone()
-    conn.close()
-    
-    if not res or amount > res[0]: return False
-    
-    # Тут две операции, в идеале нужна транзакция, но для SQLite retry тоже норм
-    execute_write_query("UPDATE users SET token_balance = token_balance - ? WHERE user_id = ?", (amount, user_id))
-    execute_write_query("INSERT INTO withdrawals (user_id, amount, wallet_address, request_date) VALUES (?, ?, ?, ?)", (user_id, amount, wallet, datetime.now().strftime("%Y-%m-%d")))
-    return True
+    def _withdraw(cursor):
+        # Проверка баланса, списание и заявка - одна транзакция писателя
+        res = cursor.execute("SELECT token_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if not res or amount <= 0 or amount > res[0]: return False
+        cursor.execute("INSERT INTO withdrawals (user_id, amount, wallet_address, request_date) VALUES (?, ?, ?, ?)", (user_id, amount, wallet, datetime.now().strftime("%Y-%m-%d")))
+        _post_ledger(cursor, 'withdrawal', [(_user_account(user_id), user_id, -amount), (LEDGER_WITHDRAWALS, None, amount)], f"withdrawal:{cursor.lastrowid}")
+        return True
+
+    ok = run_in_writer(_withdraw)
+    invalidate_user_view(user_id)
+    return ok
 
 def generate_promo_codes(count: int, duration_days: int) -> list[str]:
     codes = []
@@ -838,16 +1518,17 @@ def generate_promo_codes(count: int, duration_days: int) -> list[str]:
     return codes
 
 def check_and_expire_subscriptions():
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); today = datetime.now().strftime("%Y-%m-%d"); cursor.execute("SELECT user_id FROM users WHERE status = 'active' AND subscription_expiry < ?", (today,)); exp = [r[0] for r in cursor.fetchall()]
+    conn = get_connection(); cursor = conn.cursor(); today = datetime.now().strftime("%Y-%m-%d"); cursor.execute("SELECT user_id FROM users WHERE status = 'active' AND subscription_expiry < ?", (today,)); exp = [r[0] for r in cursor.fetchall()]
     conn.close()
     
     if exp: 
         for u in exp:
             execute_write_query("UPDATE users SET status = 'expired' WHERE user_id = ?", (u,))
+        invalidate_user_view(*exp)
     return exp
 
 def get_admin_stats():
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor()
+    conn = get_connection(); cursor = conn.cursor()
     total = cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]; active = cursor.execute("SELECT COUNT(*) FROM users WHERE status = 'active'").fetchone()[0]
     pending = cursor.execute("SELECT COUNT(*) FROM users WHERE status = 'pending_payment'").fetchone()[0]; tokens = cursor.execute("SELECT SUM(token_balance) FROM users").fetchone()[0] or 0
     w_count = cursor.execute("SELECT COUNT(*) FROM withdrawals WHERE status = 'pending'").fetchone()[0]; w_sum = cursor.execute("SELECT SUM(amount) FROM withdrawals WHERE status = 'pending'").fetchone()[0] or 0
@@ -855,32 +1536,60 @@ def get_admin_stats():
     conn.close(); return {"total_users": total, "active_users": active, "pending_payment": pending, "total_tokens": tokens, "pending_withdrawals_count": w_count, "pending_withdrawals_sum": w_sum, "total_promo_codes": p_total, "used_promo_codes": p_used, "available_promo_codes": p_total-p_used}
 
 def get_active_users_report(limit=20):
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); cursor.execute("SELECT user_id, username, token_balance FROM users WHERE status = 'active' ORDER BY join_date DESC LIMIT ?", (limit,)); users = cursor.fetchall(); report = []
+    conn = get_connection(); cursor = conn.cursor(); cursor.execute("SELECT user_id, username, token_balance FROM users WHERE status = 'active' ORDER BY join_date DESC LIMIT ?", (limit,)); users = cursor.fetchall(); report = []
     for u in users:
         l1 = cursor.execute("SELECT COUNT(*) FROM users WHERE referrer_id = ?", (u[0],)).fetchone()[0]
         report.append({"user_id": u[0], "username": u[1], "balance": u[2], "referrals": {"l1": l1, "l2": 0}})
     conn.close(); return report
 
 def get_pending_withdrawals():
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); cursor.execute("SELECT request_id, user_id, amount, wallet_address, request_date FROM withdrawals WHERE status = 'pending' ORDER BY request_id ASC"); res = cursor.fetchall(); conn.close(); return res
+    conn = get_connection(); cursor = conn.cursor(); cursor.execute("SELECT request_id, user_id, amount, wallet_address, request_date FROM withdrawals WHERE status = 'pending' ORDER BY request_id ASC"); res = cursor.fetchall(); conn.close(); return res
+
+# --- ЛОКАЛИЗАЦИЯ ---
+# locales/<lang>.json читаются один раз за процесс в неизменяемый каталог:
+# key -> (text, нужен ли format). Строки без шаблонных полей отдаются как есть.
+LOCALES_DIR = os.path.join(BASE_DIR, "locales")
+DEFAULT_LANGUAGE = 'en'
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+def _compile_catalogue(translations: dict):
+    # Строки без фигурных скобок не трогаем format(); со скобками ({поле} или {{ }}) - как раньше
+    compiled = {key: (text, '{' in text or '}' in text) for key, text in translations.items() if isinstance(text, str)}
+    return types.MappingProxyType(compiled)
+
+def get_catalogue(lang: str):
+    """Parsed locale (falls back to English for unknown languages); loaded once per process."""
+    catalogue = _catalogues.get(lang)
+    if catalogue is not None:
+        return catalogue
+    file_path = os.path.join(LOCALES_DIR, f"{lang}.json")
+    # Запасной каталог берем ДО блокировки: Lock не реентерабельный
+    fallback = None
+    if not os.path.exists(file_path) and lang != DEFAULT_LANGUAGE:
+        fallback = get_catalogue(DEFAULT_LANGUAGE)
+    with _catalogues_lock:
+        if lang not in _catalogues:
+            if fallback is not None:
+                _catalogues[lang] = fallback
+            elif os.path.exists(file_path):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    _catalogues[lang] = _compile_catalogue(json.load(f))
+            else:
+                _catalogues[lang] = types.MappingProxyType({})
+        return _catalogues[lang]
 
-# Запуск инициализации при импорте
-initialize_db()
 def get_text(user_id: int, key: str, lang: str = None, **kwargs) -> str:
     """Retrieves translated text for a user."""
     if not lang:
         lang = get_user_language(user_id)
-    
+
     try:
-        file_path = os.path.join("locales", f"{lang}.json")
-        if not os.path.exists(file_path):
-            file_path = os.path.join("locales", "en.json")
-            
-        with open(file_path, 'r', encoding='utf-8') as f:
-            translations = json.load(f)
-            
-        text = translations.get(key, translations.get(key, key))
-        return text.format(**kwargs)
+        entry = get_catalogue(lang).get(key) or get_catalogue(DEFAULT_LANGUAGE).get(key)
+        if entry is None:
+            return key
+        text, needs_format = entry
+        return text.format(**kwargs) if needs_format else text
     except Exception as e:
         print(f"Error in get_text: {e}")
         return key
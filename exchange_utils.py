@@ -2,34 +2,39 @@ import asyncio
 import ccxt
 from binance.um_futures import UMFutures
 
+from rate_limiter import limited, priority, rate_limiter, READ
+
 async def fetch_exchange_balance_safe(exchange_name, api_key, secret, passphrase=None):
     """Helper to fetch USDT balance safely via thread."""
     exchange_name = exchange_name.lower()
-    
+
     def _fetch():
         try:
-            if exchange_name == 'binance':
-                c = UMFutures(key=api_key, secret=secret, base_url="https://fapi.binance.com")
-                acc = c.account()
-                # Use 'walletBalance' (Total)
-                return float(next((a['walletBalance'] for a in acc['assets'] if a['asset']=='USDT'), 0))
-            elif exchange_name == 'okx':
-                ex = ccxt.okx({'apiKey': api_key, 'secret': secret, 'password': passphrase, 'options': {'defaultType': 'spot'}})
-                bal = ex.fetch_balance()
-                return float(bal['USDT']['total']) # Total
-            else: # bybit, bingx
-                ex_class = getattr(ccxt, exchange_name)
-                # Ensure correct options for futures
-                options = {'defaultType': 'future'}
-                if exchange_name == 'bingx': options['defaultType'] = 'swap' # Standardize if using ccxt
-                
-                ex = ex_class({'apiKey': api_key, 'secret': secret, 'options': options})
-                bal = ex.fetch_balance() # Type might be needed for some
-                return float(bal['USDT']['total']) # Total
+            # Чтения баланса (бот / веб-апп) делят с воркером общий лимит биржи, но уступают ордерам
+            with priority(READ):
+                if exchange_name == 'binance':
+                    c = limited(UMFutures(key=api_key, secret=secret, base_url="https://fapi.binance.com"), exchange_name)
+                    acc = c.account()
+                    # Use 'walletBalance' (Total)
+                    return float(next((a['walletBalance'] for a in acc['assets'] if a['asset']=='USDT'), 0))
+                elif exchange_name == 'okx':
+                    ex = limited(ccxt.okx({'apiKey': api_key, 'secret': secret, 'password': passphrase, 'options': {'defaultType': 'spot'}}), exchange_name)
+                    bal = ex.fetch_balance()
+                    return float(bal['USDT']['total']) # Total
+                else: # bybit, bingx
+                    ex_class = getattr(ccxt, exchange_name)
+                    # Ensure correct options for futures
+                    options = {'defaultType': 'future'}
+                    if exchange_name == 'bingx': options['defaultType'] = 'swap' # Standardize if using ccxt
+
+                    ex = limited(ex_class({'apiKey': api_key, 'secret': secret, 'options': options}), exchange_name)
+                    bal = ex.fetch_balance() # Type might be needed for some
+                    return float(bal['USDT']['total']) # Total
         except Exception as e:
             print(f"Fetch Error ({exchange_name}): {e}")
+            rate_limiter.report_error(exchange_name, e)
             return None
-            
+
     return await asyncio.to_thread(_fetch)
 
 async def validate_exchange_credentials(exchange_name, api_key, secret, passphrase=None):
@@ -0,0 +1,78 @@
+# fills.py
+"""
+Подтверждение исполнения маркет-ордеров без фиксированных sleep.
+
+1. Binance: ордер шлется с newOrderRespType=RESULT -> avgPrice/executedQty приходят в ответе.
+2. CCXT: если биржа вернула average/filled прямо в create_order - берем их.
+3. Иначе короткий опрос fetch_order/query_order с растущей паузой, не дольше FILL_CONFIRM_TIMEOUT.
+   Не дождались -> возвращаем (fallback_price, requested qty) как раньше делал код с тикером.
+"""
+import os
+import time
+import asyncio
+
+FILL_CONFIRM_TIMEOUT = float(os.getenv("FILL_CONFIRM_TIMEOUT", "2.0"))
+FILL_POLL_DELAYS = (0.05, 0.1, 0.2, 0.4, 0.8)
+
+BINANCE_DONE_STATUSES = {'FILLED', 'CANCELED', 'EXPIRED', 'REJECTED'}
+
+
+def _poll_delays(timeout: float):
+    """Backoff schedule capped by the total timeout (last delay repeats)."""
+    spent, i = 0.0, 0
+    while spent < timeout:
+        delay = min(FILL_POLL_DELAYS[min(i, len(FILL_POLL_DELAYS) - 1)], timeout - spent)
+        yield delay
+        spent += delay
+        i += 1
+
+
+def _binance_result(resp):
+    if resp and resp.get('status') in BINANCE_DONE_STATUSES and float(resp.get('executedQty') or 0) > 0:
+        return float(resp.get('avgPrice') or 0), float(resp['executedQty'])
+    return None
+
+
+def _ccxt_result(order):
+    if order and order.get('status') == 'closed' and order.get('filled'):
+        return order.get('average'), float(order['filled'])
+    return None
+
+
+def binance_fill(client, symbol, resp, fallback_price, fallback_qty, timeout=FILL_CONFIRM_TIMEOUT):
+    """(avg_price, executed_qty) for a UMFutures market order sent with newOrderRespType='RESULT'."""
+    result = _binance_result(resp)
+    for delay in ([] if result else _poll_delays(timeout)):
+        time.sleep(delay)
+        result = _binance_result(client.query_order(symbol=symbol, orderId=resp['orderId']))
+        if result: break
+    if not result:
+        print(f"   ⚠️ {symbol} order {resp.get('orderId')}: fill not confirmed in {timeout}s, using last price.")
+        return fallback_price, fallback_qty
+    return result[0] or fallback_price, result[1]
+
+
+def ccxt_fill(client, symbol, order, fallback_price, fallback_qty, timeout=FILL_CONFIRM_TIMEOUT):
+    """(avg_price, filled) for a CCXT market order; polls fetch_order only if the response had no fills."""
+    result = _ccxt_result(order)
+    for delay in ([] if result else _poll_delays(timeout)):
+        time.sleep(delay)
+        result = _ccxt_result(client.fetch_order(order['id'], symbol))
+        if result: break
+    if not result:
+        print(f"   ⚠️ {symbol} order {order.get('id')}: fill not confirmed in {timeout}s, using last price.")
+        return fallback_price, fallback_qty
+    return result[0] or fallback_price, result[1]
+
+
+async def ccxt_fill_async(client, symbol, order, fallback_price, fallback_qty, timeout=FILL_CONFIRM_TIMEOUT):
+    """Async twin of ccxt_fill for ccxt.async_support clients."""
+    result = _ccxt_result(order)
+    for delay in ([] if result else _poll_delays(timeout)):
+        await asyncio.sleep(delay)
+        result = _ccxt_result(await client.fetch_order(order['id'], symbol))
+        if result: break
+    if not result:
+        print(f"   ⚠️ {symbol} order {order.get('id')}: fill not confirmed in {timeout}s, using last price.")
+        return fallback_price, fallback_qty
+    return result[0] or fallback_price, result[1]
@@ -0,0 +1,103 @@
+# leverage_state.py
+"""
+Кэш уже примененного плеча по (user, exchange, symbol).
+
+Раньше на каждый вход воркер слал change_leverage / set_leverage (подписанный REST,
+почти всегда ничего не меняющий). Теперь запрос уходит только если целевое значение
+отличается от запомненного, ключи сменились или запись старше LEVERAGE_STATE_TTL
+(плечо могли поменять руками на бирже). Состояние хранится в exchange_settings,
+поэтому переживает рестарт воркера.
+"""
+import os
+import time
+import asyncio
+import threading
+
+from client_pool import key_fingerprint
+from database import get_exchange_settings, save_exchange_setting, delete_exchange_settings
+
+LEVERAGE_STATE_TTL = int(os.getenv("LEVERAGE_STATE_TTL", str(24 * 60 * 60)))
+
+# Биржа ответила "уже стоит такое плечо" -> это тоже подтверждение состояния
+ALREADY_APPLIED_MARKERS = ("not modified", "110043", "no need to change")
+
+
+def _already_applied(error) -> bool:
+    msg = str(error).lower()
+    return any(m in msg for m in ALREADY_APPLIED_MARKERS)
+
+
+class LeverageState:
+    def __init__(self, ttl: int = LEVERAGE_STATE_TTL):
+        self.ttl = ttl
+        self._state = None      # (user_id, exchange, symbol, setting) -> (value, fingerprint, updated_at)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._state is None:
+                try:
+                    rows = get_exchange_settings()
+                except Exception as e:
+                    print(f"⚠️ Leverage state not loaded: {e}")
+                    rows = []
+                self._state = {
+                    (r['user_id'], r['exchange_name'], r['symbol'], r['setting']): (r['value'], r['key_fingerprint'], r['updated_at'])
+                    for r in rows
+                }
+            return self._state
+
+    def is_current(self, user_id, exchange_id, symbol, value, keys, setting='leverage') -> bool:
+        entry = self._load().get((user_id, exchange_id, symbol, setting))
+        if not entry:
+            return False
+        known_value, fp, updated_at = entry
+        return (known_value == str(value)
+                and fp == key_fingerprint(keys)
+                and time.time() - (updated_at or 0) < self.ttl)
+
+    def remember(self, user_id, exchange_id, symbol, value, keys, setting='leverage'):
+        fp, now = key_fingerprint(keys), time.time()
+        state = self._load()
+        with self._lock:
+            state[(user_id, exchange_id, symbol, setting)] = (str(value), fp, now)
+        try:
+            save_exchange_setting(user_id, exchange_id, symbol, setting, str(value), fp, now)
+        except Exception as e:
+            print(f"⚠️ Leverage state not persisted for user {user_id}: {e}")
+
+    def forget(self, user_id, exchange_id, symbol=None):
+        """Drops remembered settings (e.g. after an order error) so the next entry re-applies them."""
+        state = self._load()
+        with self._lock:
+            for k in [k for k in state if k[0] == user_id and k[1] == exchange_id and (symbol is None or k[2] == symbol)]:
+                del state[k]
+        try:
+            delete_exchange_settings(user_id, exchange_id, symbol)
+        except Exception as e:
+            print(f"⚠️ Leverage state not cleared for user {user_id}: {e}")
+
+    # --- APPLY ---
+    def ensure(self, user_id, exchange_id, symbol, leverage, keys, apply):
+        """Calls apply() only if the leverage is not known to be set already."""
+        if self.is_current(user_id, exchange_id, symbol, leverage, keys):
+            return
+        try:
+            apply()
+        except Exception as e:
+            if not _already_applied(e):
+                print(f"   ⚠️ User {user_id} [{exchange_id}]: leverage {leverage}x not set: {e}")
+                return
+        self.remember(user_id, exchange_id, symbol, leverage, keys)
+
+    async def ensure_async(self, user_id, exchange_id, symbol, leverage, keys, apply):
+        """Same as ensure() for the asyncio engine (apply returns an awaitable, DB writes go to a thread)."""
+        if await asyncio.to_thread(self.is_current, user_id, exchange_id, symbol, leverage, keys):
+            return
+        try:
+            await apply()
+        except Exception as e:
+            if not _already_applied(e):
+                print(f"   ⚠️ User {user_id} [{exchange_id}]: leverage {leverage}x not set: {e}")
+                return
+        await asyncio.to_thread(self.remember, user_id, exchange_id, symbol, leverage, keys)
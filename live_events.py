@@ -0,0 +1,66 @@
+# live_events.py
+"""
+Живые обновления веб-аппа через Server-Sent Events.
+
+Открытый веб-апп держит одно соединение GET /api/stream; сервер кладет события
+пользователя (свежие балансы и т.п.) в очереди его подписчиков. Все методы вызываются
+из event loop сервера. Медленный клиент не тормозит остальных: при переполнении
+его очереди самое старое событие выбрасывается.
+"""
+import os
+import json
+import asyncio
+
+LIVE_KEEPALIVE = float(os.getenv("LIVE_KEEPALIVE", "15"))
+LIVE_QUEUE_SIZE = 100
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class LiveEvents:
+    def __init__(self, keepalive: float = LIVE_KEEPALIVE):
+        self.keepalive = keepalive
+        self._subscribers = {}   # user_id -> set(asyncio.Queue)
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id: int) -> bool:
+        return bool(self._subscribers.get(user_id))
+
+    def publish(self, user_id: int, event: str, data) -> int:
+        """Queues an event for every open stream of the user; returns the number of streams."""
+        message = sse(event, data)
+        queues = self._subscribers.get(user_id, ())
+        for queue in queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+        return len(queues)
+
+    async def stream(self, user_id: int, first: str = None):
+        """SSE body for one client: optional initial message, then events and keep-alive comments."""
+        queue = self.subscribe(user_id)
+        try:
+            yield f"retry: 3000\n\n{first or ''}"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # прокси (и Telegram WebView) не рвут молчащее соединение
+        finally:
+            self.unsubscribe(user_id, queue)
+
+
+live_events = LiveEvents()
@@ -61,7 +61,7 @@
 
 # llm_explainer.py (v-OpenRouter - DeepSeek V3 with Correct Headers)
 import os
-from openai import OpenAI
+import functools
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -69,8 +69,13 @@ load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
-if OPENROUTER_API_KEY:
-    client = OpenAI(
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """OpenRouter client, created on first use (None without API key)."""
+    if not OPENROUTER_API_KEY:
+        return None
+    from openai import OpenAI
+    return OpenAI(
         base_url=OPENROUTER_BASE_URL,
         api_key=OPENROUTER_API_KEY,
         default_headers={
@@ -78,11 +83,10 @@ if OPENROUTER_API_KEY:
             "X-Title": "BlackAladin",
         }
     )
-else:
-    client = None
 
 def get_explanation(context: dict, lang: str = "en") -> str:
     """Генерирует объяснение используя DeepSeek через OpenRouter."""
+    client = get_client()
     if not client:
         return "Explanation feature is unavailable (API key is missing)."
 
@@ -0,0 +1,83 @@
+# load_test_server.py
+"""
+Нагрузочный тест веб-аппа: N одновременных пользователей открывают /api/data
+(и иногда меняют язык), на выходе - p50 / p95 / p99 задержки.
+
+    python load_test_server.py                                  # in-process (ASGI), без uvicorn
+    python load_test_server.py --url http://localhost:8000 -c 200 -n 5000
+    python load_test_server.py --user-ids 1-500                 # реальные id из базы
+"""
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+
+def percentile(samples: list, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def parse_ids(spec: str) -> list:
+    if "-" in spec:
+        lo, hi = spec.split("-", 1)
+        return list(range(int(lo), int(hi) + 1))
+    return [int(x) for x in spec.split(",")]
+
+
+async def user_session(client, user_ids, requests_left, latencies, errors, write_ratio):
+    while requests_left[0] > 0:
+        requests_left[0] -= 1
+        user_id = random.choice(user_ids)
+        started = time.perf_counter()
+        try:
+            if random.random() < write_ratio:
+                resp = await client.post("/api/language", json={"user_id": user_id, "language": random.choice(["en", "ru"])})
+            else:
+                resp = await client.get("/api/data", params={"user_id": user_id})
+            if resp.status_code >= 500:
+                errors.append(resp.status_code)
+        except Exception as e:
+            errors.append(type(e).__name__)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+
+async def run(args):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=30)
+    else:
+        from server import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://webapp", timeout=30)
+
+    user_ids = parse_ids(args.user_ids)
+    latencies, errors, requests_left = [], [], [args.requests]
+    started = time.perf_counter()
+    async with client:
+        await asyncio.gather(*(
+            user_session(client, user_ids, requests_left, latencies, errors, args.write_ratio) for _ in range(args.concurrency)
+        ))
+    elapsed = time.perf_counter() - started
+
+    print(f"requests: {len(latencies)}  concurrency: {args.concurrency}  errors: {len(errors)}  "
+          f"throughput: {len(latencies) / elapsed:.0f} req/s")
+    print(f"latency ms  p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  "
+          f"p99 {percentile(latencies, 99):.1f}  max {max(latencies, default=0):.1f}  mean {statistics.fmean(latencies) if latencies else 0:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent WebApp users against /api/data")
+    parser.add_argument("--url", help="running server (default: in-process ASGI app)")
+    parser.add_argument("-c", "--concurrency", type=int, default=100)
+    parser.add_argument("-n", "--requests", type=int, default=2000)
+    parser.add_argument("--user-ids", default="1-100")
+    parser.add_argument("--write-ratio", type=float, default=0.05, help="share of POST /api/language requests")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
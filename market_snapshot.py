@@ -0,0 +1,95 @@
+# market_snapshot.py
+"""
+Общий снимок рынка на один сигнал.
+
+Цена, шаг лота и min-notional для (биржа, символ) одинаковы для всех подписчиков,
+поэтому воркер запрашивает их ОДИН раз на сигнал и раздает снимок каждой задаче
+пользователя вместо N вызовов fetch_ticker / ticker_price / amount_to_precision.
+
+Публичные данные берутся через неаутентифицированные CCXT клиенты, так что вызовы
+не тратят лимиты ключей подписчиков (IP-бюджет - через общий rate limiter). Шаг лота и минимумы - из локального каталога
+symbol_filters (сеть на сигнал нужна только для цены).
+"""
+import time
+import threading
+from decimal import Decimal, ROUND_DOWN
+import ccxt
+
+from symbol_filters import get_catalogue
+from rate_limiter import limited
+
+# Публичные клиенты для фьючерсов: Binance USDT-M торгуется через UMFutures, но данные те же
+PUBLIC_EXCHANGE_CLASSES = {('binance', 'future'): 'binanceusdm'}
+
+
+def quantize_amount(qty: float, step: float) -> float:
+    """Floors qty to the exchange lot step (never rounds up past the user's budget)."""
+    if not step:
+        return qty
+    d_step = Decimal(str(step))
+    return float((Decimal(str(qty)) / d_step).to_integral_value(rounding=ROUND_DOWN) * d_step)
+
+
+def entry_quantity(snapshot: dict, usd_amount: float) -> float:
+    """Lot-step-floored quantity for a USDT budget; 0 if it falls under the exchange minimums."""
+    qty = quantize_amount(usd_amount / snapshot['price'], snapshot['amount_step'])
+    if qty < snapshot['min_qty'] or qty * snapshot['price'] < snapshot['min_notional']:
+        return 0.0
+    return qty
+
+
+class MarketSnapshots:
+    """Resolves per-signal snapshots through long-lived public clients (one per exchange/market type)."""
+
+    def __init__(self, catalogue=None):
+        self.catalogue = catalogue or get_catalogue()
+        self._public = {}
+        self._lock = threading.Lock()
+
+    def _public_client(self, exchange_id: str, market_type: str):
+        key = (exchange_id, market_type)
+        with self._lock:
+            client = self._public.get(key)
+            if client is None:
+                ex_class = getattr(ccxt, PUBLIC_EXCHANGE_CLASSES.get(key, exchange_id))
+                client = limited(ex_class({'options': {'defaultType': market_type}, 'enableRateLimit': True}), exchange_id)
+                self._public[key] = client
+        return client
+
+    def with_price(self, exchange_id: str, symbol: str, ccxt_symbol: str, price: float, market_type: str = 'future'):
+        """Snapshot from the filters catalogue plus an already known price (None if the symbol is unknown)."""
+        filters = self.catalogue.get(exchange_id, symbol, market_type)
+        if not filters:
+            return None
+        return {
+            "exchange": exchange_id,
+            "symbol": symbol,
+            "ccxt_symbol": ccxt_symbol,
+            "price": float(price),
+            "amount_step": filters['step_size'],
+            "tick_size": filters['tick_size'],
+            "min_qty": filters['min_qty'] or 0.0,
+            "min_notional": filters['min_notional'] or 0.0,
+            "max_leverage": filters['max_leverage'],
+            "fetched_at": time.time(),
+        }
+
+    def resolve(self, exchange_id: str, symbol: str, ccxt_symbol: str, market_type: str = 'future'):
+        """
+        Returns {exchange, symbol, ccxt_symbol, price, amount_step, tick_size, min_qty, min_notional, max_leverage, fetched_at}
+        or None if the public data could not be fetched (callers then fall back to per-user calls).
+        """
+        try:
+            ticker = self._public_client(exchange_id, market_type).fetch_ticker(ccxt_symbol)
+            snapshot = self.with_price(exchange_id, symbol, ccxt_symbol, ticker['last'], market_type)
+            if snapshot is None:
+                print(f"⚠️ No symbol filters for {exchange_id} {symbol}, falling back to per-user precision.")
+            return snapshot
+        except Exception as e:
+            print(f"⚠️ Snapshot failed for {exchange_id} {symbol}: {e}")
+            return None
+
+    def resolve_for(self, connections, symbol: str, ccxt_symbol: str, market_type: str = 'future') -> dict:
+        """One snapshot per distinct exchange among the signal's connections: {exchange_id: snapshot|None}."""
+        exchanges = {(c.get('exchange') or c['exchange_name']).lower() for c in connections}
+        return {ex: self.resolve(ex, symbol, ccxt_symbol, market_type) for ex in exchanges}
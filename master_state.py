@@ -0,0 +1,65 @@
+# master_state.py
+"""
+Состояние аккаунтов мастеров (USDT баланс) для расчета ratio сигналов.
+
+Раньше process_signal делал REST account()/fetch_balance() на каждый сигнал, а при
+ошибке молча подставлял 10000. Теперь баланс приходит из приватных стримов мастера
+(ACCOUNT_UPDATE / wallet) через тот же журнал сигналов, что и ордера, а REST нужен
+только для начального значения и редкой досинхронизации в фоне.
+
+Чтение snapshot() без блокировок: словарь целиком подменяется при каждом обновлении.
+Неизвестный баланс = None, вызывающий код сам решает, что делать (никаких заглушек).
+"""
+import os
+import time
+import threading
+
+MASTER_BALANCE_MAX_AGE = int(os.getenv("MASTER_BALANCE_MAX_AGE", "300"))
+ACCOUNT_EVENT = 'ACCOUNT_UPDATE'
+
+
+def account_event(exchange: str, balance: float) -> dict:
+    """Signal-log event carrying a master balance update."""
+    return {'e': ACCOUNT_EVENT, 'master_exchange': exchange, 'balance': float(balance), 'E': time.time()}
+
+
+def usdt_from_account_update(msg: dict):
+    """USDT wallet balance from a Binance/BingX futures ACCOUNT_UPDATE payload (None if not present)."""
+    for b in (msg.get('a') or {}).get('B', []):
+        if b.get('a') == 'USDT':
+            return float(b.get('wb') or 0)
+    return None
+
+
+def usdt_from_bybit_wallet(msg: dict):
+    """USDT wallet balance from a Bybit v5 'wallet' stream message."""
+    for account in msg.get('data', []):
+        for coin in account.get('coin', []):
+            if coin.get('coin') == 'USDT':
+                return float(coin.get('walletBalance') or 0)
+    return None
+
+
+class MasterAccountState:
+    def __init__(self):
+        self._snapshot = {}     # exchange -> {'balance', 'updated_at', 'source'}
+        self._lock = threading.Lock()
+
+    def update(self, exchange: str, balance: float, source: str = 'ws', updated_at: float = None):
+        entry = {'balance': float(balance), 'updated_at': updated_at or time.time(), 'source': source}
+        with self._lock:
+            current = self._snapshot.get(exchange)
+            if current and current['updated_at'] > entry['updated_at']:
+                return  # устаревший апдейт (например, повтор из журнала)
+            self._snapshot = {**self._snapshot, exchange: entry}
+
+    def snapshot(self) -> dict:
+        return self._snapshot
+
+    def balance(self, exchange: str):
+        entry = self._snapshot.get(exchange)
+        return entry['balance'] if entry else None
+
+    def stale(self, exchanges, max_age: int = MASTER_BALANCE_MAX_AGE) -> list:
+        now, snap = time.time(), self._snapshot
+        return [ex for ex in exchanges if ex not in snap or now - snap[ex]['updated_at'] > max_age]
@@ -22,13 +22,30 @@ from pybit.unified_trading import WebSocket as BybitWS
 
 # --- Наш Воркер ---
 from worker import TradeCopier
+from signal_log import SignalQueue
+from signal_coalescer import SignalCoalescer
+from master_state import account_event, usdt_from_account_update, usdt_from_bybit_wallet
+from sharding import COPY_SHARDS, COPY_SHARD_INDEX, CONSUMER_PREFIX, shard_consumer, shard_consumers
+import multiprocessing
 
 import logging
 logging.basicConfig(level=logging.ERROR)
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-event_queue = Queue()
+# threads (ThreadPoolExecutor, по умолчанию) или async (asyncio-движок, см. async_worker.py)
+COPY_EXECUTION_MODE = os.getenv("COPY_EXECUTION_MODE", "threads").lower()
+# durable (журнал signal_log.db, переживает рестарт) или memory (старая in-process очередь)
+SIGNAL_QUEUE_MODE = os.getenv("SIGNAL_QUEUE", "durable").lower()
+# all = слушатели + воркер в одном процессе; listeners / worker = раздельные процессы (только с durable)
+TRACKER_ROLE = os.getenv("TRACKER_ROLE", "all").lower()
+SIGNAL_LAG_REPORT_INTERVAL = int(os.getenv("SIGNAL_LAG_REPORT_INTERVAL", "60"))
+event_queue = SignalQueue() if SIGNAL_QUEUE_MODE == "durable" else Queue()
+# Слушатели публикуют через склейку частичных исполнений (signal_coalescer.py), создается в start_listeners
+coalescer = None
+
+def publish(event):
+    coalescer.offer(event)
 
 def start_binance_listener():
     key = os.getenv("BINANCE_MASTER_KEY")
@@ -44,7 +61,10 @@ def start_binance_listener():
                 order_data = message.get('o', {})
                 order_data['master_exchange'] = 'binance'
                 order_data['ro'] = order_data.get('R', False) 
-                event_queue.put(order_data)
+                publish(order_data)
+            elif message.get('e') == 'ACCOUNT_UPDATE':
+                bal = usdt_from_account_update(message)
+                if bal is not None: publish(account_event('binance', bal))
         except: pass
 
     while True:
@@ -89,22 +109,31 @@ def start_bybit_listener():
                         's': order['symbol'],
                         'S': order['side'].upper(),
                         'o': order['orderType'].upper(),
-                        'X': 'FILLED',
+                        'X': 'PARTIALLY_FILLED' if order['orderStatus'] == 'PartiallyFilled' else 'FILLED',
                         'q': float(order['qty']),
                         'p': float(order['price'] or 0),
                         'ap': float(order['avgPrice'] or 0),
                         'ro': order.get('reduceOnly', False),
-                        'ot': 'LIMIT'
+                        'ot': 'LIMIT',
+                        'i': order.get('orderId'),
+                        'z': order.get('cumExecQty')
                     }
                     if order.get('stopOrderType'): norm['ot'] = 'STOP_MARKET'
-                    event_queue.put(norm)
+                    publish(norm)
                     print(f"🚀 Bybit Signal: {order['symbol']}")
         except: pass
 
+    def on_wallet(message):
+        try:
+            bal = usdt_from_bybit_wallet(message)
+            if bal is not None: publish(account_event('bybit', bal))
+        except: pass
+
     while True:
         try:
             ws = BybitWS(testnet=False, channel_type="private", api_key=key, api_secret=secret)
             ws.order_stream(callback=on_message)
+            ws.wallet_stream(callback=on_wallet)
             print("✅ Bybit Connected.")
             while True: time.sleep(60)
         except Exception as e:
@@ -190,6 +219,12 @@ def start_bingx_listener():
                 ws.close()
                 return
 
+            # Баланс мастера (для ratio в воркере)
+            if msg.get("e") == "ACCOUNT_UPDATE":
+                bal = usdt_from_account_update(msg)
+                if bal is not None: publish(account_event("bingx", bal))
+                return
+
             # 2. EVENT PARSING (BingX Futures)
             if msg.get("dataType") == "ORDER_UPDATE":
                 order = msg.get("data", {})
@@ -210,7 +245,7 @@ def start_bingx_listener():
                     elif raw_type == "MARKET":
                          orig_type = "MARKET"
 
-                    event_queue.put({
+                    publish({
                         "master_exchange": "bingx",
                         "s": symbol,
                         "S": side,
@@ -220,7 +255,9 @@ def start_bingx_listener():
                         "p": float(order.get("price") or 0),
                         "ap": float(order.get("avgPrice") or 0),
                         "ot": orig_type,
-                        'ro': order.get('reduceOnly', False)
+                        'ro': order.get('reduceOnly', False),
+                        'i': order.get('orderId'),
+                        'z': order.get('executedQty')
                     })
                     print(f"🚀 BingX Signal: {symbol} ({status})")
 
@@ -343,8 +380,15 @@ def start_okx_listener():
         print(f"⚠️ OKX History sync failed: {e}")
 
     # --- ЭТАП 2: РАБОТА (ЛОВИМ ТОЛЬКО НОВЫЕ) ---
+    # У OKX spot нет стрима в этом слушателе -> баланс мастера опрашиваем раз в 30с
+    last_balance_sync = 0
     while True:
         try:
+            if time.time() - last_balance_sync > 30:
+                last_balance_sync = time.time()
+                bal = okx.fetch_balance()
+                publish(account_event('okx', float(bal['USDT']['free']) if 'USDT' in bal else 0.0))
+
             orders = okx.fetch_closed_orders(limit=5) 
             
             for order in orders:
@@ -357,7 +401,7 @@ def start_okx_listener():
                     if len(last_processed_ids) > 100: last_processed_ids.clear()
 
                     if float(order['filled']) > 0:
-                        event_queue.put({
+                        publish({
                             'master_exchange': 'okx', 
                             'strategy': 'cgt',        
                             's': order['symbol'],     
@@ -368,7 +412,9 @@ def start_okx_listener():
                             'p': float(order['average'] or order['price'] or 0),
                             'ap': float(order['average'] or 0),
                             'ot': 'SPOT',
-                            'ro': False              
+                            'ro': False,
+                            'i': oid,
+                            'z': order['filled']
                         })
                         print(f"🚀 OKX Signal: {order['side']} {order['symbol']}")
 
@@ -383,14 +429,83 @@ def start_okx_listener():
 # MAIN
 # ==========================================
 def main():
-    print("\n--- [Master Tracker: MULTI-EXCHANGE HUB] Started ---")
+    print(f"\n--- [Master Tracker: MULTI-EXCHANGE HUB] Started (role={TRACKER_ROLE}, queue={SIGNAL_QUEUE_MODE}) ---")
     if not TELEGRAM_TOKEN: return
-    
+    if (TRACKER_ROLE != "all" or COPY_SHARDS > 1) and SIGNAL_QUEUE_MODE != "durable":
+        print("❌ TRACKER_ROLE=listeners/worker and COPY_SHARDS>1 require SIGNAL_QUEUE=durable.")
+        return
+
+    if TRACKER_ROLE in ("all", "worker"):
+        start_worker()
+    if TRACKER_ROLE in ("all", "listeners"):
+        start_listeners()
+
+    last_report = time.time()
+    try:
+        while True:
+            time.sleep(1)
+            if SIGNAL_QUEUE_MODE == "durable" and TRACKER_ROLE != "listeners" and time.time() - last_report >= SIGNAL_LAG_REPORT_INTERVAL:
+                last_report = time.time()
+                report_signal_lag()
+    except KeyboardInterrupt:
+        print("\n🛑 Stopped.")
+
+def build_copier(shard=None):
     bot = Bot(token=TELEGRAM_TOKEN)
-    copier = TradeCopier(bot_instance=bot)
+    if COPY_EXECUTION_MODE == "async":
+        from async_worker import AsyncTradeCopier
+        return AsyncTradeCopier(bot_instance=bot, shard=shard)
+    return TradeCopier(bot_instance=bot, shard=shard)
+
+def start_worker():
+    if SIGNAL_QUEUE_MODE == "durable":
+        # Все хосты/процессы сходятся к одному набору consumer'ов (смена COPY_SHARDS без потери сигналов)
+        event_queue.log.rebalance(shard_consumers(COPY_SHARDS), CONSUMER_PREFIX)
+
+    if COPY_SHARDS <= 1:
+        threading.Thread(target=build_copier().start_consuming, args=(event_queue,), daemon=True).start()
+        print(f"✅ Worker Thread: RUNNING ({COPY_EXECUTION_MODE})")
+    elif COPY_SHARD_INDEX is not None:
+        # Один шард в этом процессе (остальные - на других хостах)
+        index = int(COPY_SHARD_INDEX)
+        threading.Thread(target=run_shard, args=(index, COPY_SHARDS), daemon=True).start()
+        print(f"✅ Worker Shard {index}/{COPY_SHARDS}: RUNNING ({COPY_EXECUTION_MODE})")
+    else:
+        threading.Thread(target=supervise_shards, args=(COPY_SHARDS,), daemon=True).start()
+
+def run_shard(index, shard_count):
+    """Entry point of one shard: consumes the shared signal log, trades only its own users."""
+    queue = SignalQueue(consumer=shard_consumer(index, shard_count))
+    build_copier(shard=(index, shard_count)).start_consuming(queue)
+
+def supervise_shards(shard_count):
+    """Starts one process per shard and restarts any that die."""
+    ctx = multiprocessing.get_context("spawn")
+    procs = {}
+    while True:
+        for i in range(shard_count):
+            p = procs.get(i)
+            if p is None or not p.is_alive():
+                if p is not None:
+                    print(f"⚠️ Worker Shard {i}/{shard_count} exited (code {p.exitcode}), restarting...")
+                p = ctx.Process(target=run_shard, args=(i, shard_count), name=f"copier-shard-{i}", daemon=True)
+                p.start()
+                procs[i] = p
+                print(f"✅ Worker Shard {i}/{shard_count}: RUNNING pid={p.pid} ({COPY_EXECUTION_MODE})")
+        time.sleep(5)
+
+def report_signal_lag():
+    try:
+        for consumer, lag in sorted(event_queue.log.lags(CONSUMER_PREFIX).items()):
+            if lag["signals"]:
+                print(f"📊 Signal lag [{consumer}]: {lag['signals']} pending, oldest {lag['seconds']:.1f}s")
+        event_queue.log.trim()
+    except Exception as e:
+        print(f"⚠️ Signal lag check failed: {e}")
 
-    threading.Thread(target=copier.start_consuming, args=(event_queue,), daemon=True).start()
-    print("✅ Worker Thread: RUNNING")
+def start_listeners():
+    global coalescer
+    coalescer = SignalCoalescer(event_queue.put)
 
     #threading.Thread(target=start_binance_listener, daemon=True).start()
     
@@ -403,10 +518,5 @@ def main():
     if os.getenv("OKX_MASTER_KEY") and len(os.getenv("OKX_MASTER_KEY")) > 10:
         threading.Thread(target=start_okx_listener, daemon=True).start()
 
-    try:
-        while True: time.sleep(1)
-    except KeyboardInterrupt:
-        print("\n🛑 Stopped.")
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
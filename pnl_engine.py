@@ -0,0 +1,128 @@
+# pnl_engine.py
+"""
+PnL пользователя для веб-аппа (/api/data) и профиля в боте.
+
+- Реализованный PnL не пересчитывается из истории: close_trade_in_db сразу добавляет
+  результат сделки в pnl_rollups (за все время и за день, по бирже и стратегии),
+  а вид пользователя (get_user_view) держит эти строки и открытые позиции.
+- Нереализованный PnL - mark-to-market открытых позиций по общему фиду цен:
+  один публичный запрос mark price Binance USDT-M на все символы раз в PRICE_FEED_TTL
+  секунд на процесс, сколько бы пользователей ни смотрели. Спот OKX (BTC/USDT)
+  оценивается по той же цене BTCUSDT.
+"""
+import os
+import time
+import threading
+
+from database import trade_pnl
+from rate_limiter import limited, priority, READ
+
+PRICE_FEED_TTL = float(os.getenv("PRICE_FEED_TTL", "5"))
+
+
+def normalize_symbol(symbol: str) -> str:
+    """BTC/USDT:USDT, BTC/USDT, BTC-USDT -> BTCUSDT."""
+    return symbol.split(':')[0].replace('/', '').replace('-', '').upper()
+
+
+class PriceFeed:
+    """
+    Shared mark prices. prices() never waits for the network unless asked to:
+    a stale snapshot is returned as is while one background refresh runs.
+    """
+
+    def __init__(self, ttl: float = PRICE_FEED_TTL):
+        self.ttl = ttl
+        self._prices = {}
+        self._fetched_at = None
+        self._client = None
+        self._lock = threading.Lock()
+        self._refreshing = None   # threading.Event текущего обновления
+
+    def _fetch(self) -> dict:
+        if self._client is None:
+            import ccxt
+            self._client = limited(ccxt.binanceusdm({'enableRateLimit': True}), 'binance')
+        with priority(READ):
+            rows = self._client.fapiPublicGetPremiumIndex()
+        return {r['symbol']: float(r['markPrice']) for r in rows if r.get('markPrice')}
+
+    def _refresh(self, done: threading.Event):
+        try:
+            self._prices = self._fetch()
+        except Exception as e:
+            print(f"⚠️ Price feed refresh failed: {e}")
+        finally:
+            # После ошибки тоже ждем ttl: не дергаем биржу на каждый запрос, пока она недоступна
+            self._fetched_at = time.monotonic()
+            with self._lock:
+                self._refreshing = None
+            done.set()
+
+    def prices(self, wait: float = 0) -> dict:
+        """{BTCUSDT: mark price}; `wait` seconds to block for a refresh when the snapshot is stale."""
+        if self._fetched_at is not None and time.monotonic() - self._fetched_at < self.ttl:
+            return self._prices
+        with self._lock:
+            done = self._refreshing
+            if done is None:
+                done = self._refreshing = threading.Event()
+                threading.Thread(target=self._refresh, args=(done,), daemon=True).start()
+        if wait:
+            done.wait(wait)
+        return self._prices
+
+
+price_feed = PriceFeed()
+
+
+def format_usd(value: float) -> str:
+    """+$1,234.50 / -$12.00"""
+    return f"{'+' if value >= 0 else '-'}${abs(value):,.2f}"
+
+
+def summarize_rollups(rows: list) -> dict:
+    """Totals for 'all' and today plus the per exchange / strategy breakdown from pnl_rollups rows."""
+    empty = {"realized": 0.0, "fees": 0.0, "volume": 0.0, "trades": 0, "wins": 0}
+    totals = {"all": dict(empty), "today": dict(empty)}
+    by_exchange = []
+    for r in rows:
+        bucket = totals["all" if r['period'] == 'all' else "today"]
+        bucket["realized"] += r['realized_pnl']
+        bucket["fees"] += r['fees']
+        bucket["volume"] += r['volume']
+        bucket["trades"] += r['trades']
+        bucket["wins"] += r['wins']
+        if r['period'] == 'all':
+            by_exchange.append({
+                "exchange": r['exchange_name'], "strategy": r['strategy'], "realized": r['realized_pnl'],
+                "fees": r['fees'], "volume": r['volume'], "trades": r['trades'], "wins": r['wins'],
+            })
+    return {**totals, "by_exchange": sorted(by_exchange, key=lambda x: -x["realized"])}
+
+
+def mark_positions(open_trades: list, prices: dict) -> list:
+    """Open positions with mark price and unrealised PnL (None where the feed has no price)."""
+    positions = []
+    for t in open_trades:
+        mark = prices.get(normalize_symbol(t['symbol']))
+        positions.append({
+            "symbol": t['symbol'], "side": t['side'], "exchange": t['exchange_name'], "strategy": t['strategy'],
+            "entry": t['avg_entry_price'], "qty": t['total_quantity'], "mark": mark,
+            "unrealized": trade_pnl(t['side'], t['avg_entry_price'], mark, t['total_quantity']) if mark else None,
+        })
+    return positions
+
+
+def pnl_report(view: dict, wait: float = 0) -> dict:
+    """
+    Realised totals from the user's rollups + mark-to-market of open positions.
+    `unrealized` sums the priced positions; `priced` tells how many of them had a mark price.
+    """
+    if not view:
+        return {**summarize_rollups([]), "unrealized": 0.0, "positions": [], "priced": 0}
+    summary = summarize_rollups(view.get("pnl_rollups", []))
+    open_trades = view.get("open_trades", [])
+    positions = mark_positions(open_trades, price_feed.prices(wait) if open_trades else {})
+    priced = [p["unrealized"] for p in positions if p["unrealized"] is not None]
+    return {**summary, "unrealized": sum(priced), "positions": positions, "priced": len(priced)}
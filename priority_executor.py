@@ -0,0 +1,87 @@
+# priority_executor.py
+"""
+Пул потоков копировщика с приоритетами.
+
+Раньше закрытия (SL/TP, reduce-only) стояли в одном FIFO ThreadPoolExecutor(20) за
+большим фан-аутом входов. Здесь очередь - куча по (приоритет, порядок поступления):
+задачи EXIT берутся свободными потоками раньше любых ожидающих ENTRY.
+drop_pending(symbol) снимает еще не начатые входы по символу, для которого пришло закрытие.
+Каждая задача выполняется внутри priority(приоритет) rate limiter'а: уровень, выставленный
+задачей, сбрасывается по ее завершении и не переходит к следующей задаче потока.
+"""
+import heapq
+import itertools
+import threading
+import concurrent.futures
+
+from rate_limiter import ENTRY, priority
+
+
+class PriorityExecutor:
+    def __init__(self, max_workers: int = 20):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = [threading.Thread(target=self._run, daemon=True, name=f"copier-{i}") for i in range(max_workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, fn, /, *args, _priority: int = ENTRY, _symbol: str = None, **kwargs):
+        """
+        Queues fn(*args, **kwargs). `_priority` / `_symbol` are the scheduling arguments
+        (underscored so they never swallow fn's own priority= / symbol= kwargs).
+        """
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new tasks after shutdown")
+            heapq.heappush(self._heap, (_priority, next(self._seq), _symbol, future, fn, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def drop_pending(self, symbol: str, priority: int = ENTRY) -> int:
+        """Cancels queued (not yet started) tasks of the given priority for this symbol."""
+        dropped = 0
+        with self._cond:
+            for prio, _, sym, future, *_ in self._heap:
+                if prio == priority and sym == symbol and future.cancel():
+                    dropped += 1
+        return dropped
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(1 for item in self._heap if not item[3].cancelled())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap and not self._shutdown:
+                    self._cond.wait()
+                if not self._heap:
+                    return
+                level, _, _, future, fn, args, kwargs = heapq.heappop(self._heap)
+            if not future.set_running_or_notify_cancel():
+                continue  # снят drop_pending
+            try:
+                with priority(level):
+                    result = fn(*args, **kwargs)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self, wait: bool = True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(wait=True)
+        return False
+
@@ -0,0 +1,246 @@
+# rate_limiter.py
+"""
+Общий rate limiter запросов к биржам (на процесс).
+
+enableRateLimit в CCXT работает на один инстанс клиента, а UMFutures не ограничен вообще,
+поэтому фан-аут на сотни подписчиков мог упереться в IP-лимит и получить бан (418/429)
+- и тогда не проходили даже закрытия. Здесь:
+
+- IP-бюджет на биржу: token bucket по весам запросов (Binance считает weight, а не штуки).
+- Лимит ордеров на аккаунт (UID): отдельный bucket на (биржа, пользователь).
+- Приоритеты: EXIT < ENTRY < READ. Пока есть ожидающие выходы, входы и чтения на этой
+  бирже ждут, так что закрытия проходят первыми.
+- Биржа ответила 429/418 -> вся биржа на паузе Retry-After секунд.
+
+Общего состояния между процессами нет, поэтому IP-бюджет хоста делится по ролям процессов:
+bot.py и server.py (set_process_role) делят RATE_LIMIT_APP_SHARE бюджета поровну, остальное -
+копировщику: COPY_SHARDS=K шардов на одном хосте получают по 1/K этой части, шард на своем
+хосте (COPY_SHARD_INDEX) - всю. RATE_LIMIT_PROCESSES задает число процессов копировщика на IP явно.
+Лимит ордеров на аккаунт не делится: подписчик исполняется только в своем шарде.
+
+Клиенты оборачиваются через limited() - и с ключами подписчиков, и публичные (тикеры,
+exchangeInfo, load_markets, фид mark price); приоритет задается контекстом `with priority(EXIT):`
+(contextvars -> работает и для потоков, и для asyncio задач).
+"""
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+import ccxt
+from binance.error import ClientError
+
+from sharding import COPY_SHARDS, COPY_SHARD_INDEX
+
+EXIT, ENTRY, READ = 0, 1, 2
+
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.8"))
+RATE_LIMIT_PROCESSES = os.getenv("RATE_LIMIT_PROCESSES")
+RATE_LIMIT_APP_SHARE = float(os.getenv("RATE_LIMIT_APP_SHARE", "0.2"))
+# Процессы, которые ходят на биржи с того же IP, что и копировщик
+APP_PROCESSES = ('bot', 'server')
+
+# (weight, seconds) на IP и (orders, seconds) на аккаунт - по документации бирж
+EXCHANGE_LIMITS = {
+    'binance': {'ip': (2400, 60), 'order': (300, 10)},
+    'bybit': {'ip': (600, 5), 'order': (10, 1)},
+    'bingx': {'ip': (500, 10), 'order': (10, 1)},
+    'okx': {'ip': (120, 2), 'order': (60, 2)},
+}
+DEFAULT_LIMITS = {'ip': (50, 1), 'order': (10, 1)}
+
+# Вес вызова по имени метода клиента (UMFutures или CCXT); остальные = 1
+CALL_WEIGHTS = {
+    'account': 5, 'balance': 5, 'get_position_risk': 5,
+    'fetch_balance': 5, 'fetch_positions': 5, 'fetch_closed_orders': 5, 'load_markets': 10,
+    'fapiPublicGetPremiumIndex': 10,
+}
+ORDER_CALLS = {'new_order', 'cancel_order', 'create_order'}
+# Локальные методы CCXT (без сети) - не тратят бюджет
+LOCAL_CALLS = {'amount_to_precision', 'price_to_precision', 'cost_to_precision', 'market', 'market_id', 'close'}
+
+_current_priority = contextvars.ContextVar('rate_limit_priority', default=ENTRY)
+
+
+def use_priority(level: int):
+    """
+    Sets the priority for the rest of the current job. Only for code already scoped by
+    priority() (PriorityExecutor jobs) or running in its own asyncio task - otherwise the
+    level outlives the job on a reused thread.
+    """
+    _current_priority.set(level)
+
+
+@contextmanager
+def priority(level: int):
+    """Every limited call inside this block is scheduled with the given priority."""
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+_process_role = 'copier'
+
+
+def set_process_role(role: str):
+    """'copier' (default) or one of APP_PROCESSES; call at process start, before the first request."""
+    global _process_role
+    _process_role = role
+
+
+def _process_share() -> float:
+    # Все процессы хоста делят один IP -> каждому своя доля IP-бюджета
+    if _process_role in APP_PROCESSES:
+        return RATE_LIMIT_APP_SHARE / len(APP_PROCESSES)
+    if RATE_LIMIT_PROCESSES:
+        copiers = int(RATE_LIMIT_PROCESSES)
+    else:
+        copiers = 1 if COPY_SHARD_INDEX is not None else COPY_SHARDS
+    return (1.0 - RATE_LIMIT_APP_SHARE) / max(copiers, 1)
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, per_seconds: float):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    def __init__(self, headroom: float = RATE_LIMIT_HEADROOM):
+        self.headroom = headroom
+        self._lock = threading.Lock()
+        self._ip = {}           # exchange -> TokenBucket
+        self._orders = {}       # (exchange, uid) -> TokenBucket
+        self._waiting = {}      # (exchange, priority) -> count
+        self._blocked_until = {}
+
+    def _limits(self, exchange_id):
+        return EXCHANGE_LIMITS.get(exchange_id, DEFAULT_LIMITS)
+
+    def _ip_bucket(self, exchange_id):
+        bucket = self._ip.get(exchange_id)
+        if bucket is None:
+            cap, per = self._limits(exchange_id)['ip']
+            bucket = self._ip[exchange_id] = TokenBucket(max(cap * self.headroom * _process_share(), 1), per)
+        return bucket
+
+    def _order_bucket(self, exchange_id, uid):
+        bucket = self._orders.get((exchange_id, uid))
+        if bucket is None:
+            cap, per = self._limits(exchange_id)['order']
+            bucket = self._orders[(exchange_id, uid)] = TokenBucket(max(cap * self.headroom, 1), per)
+        return bucket
+
+    def _try_acquire(self, exchange_id, uid, weight, is_order, level) -> float:
+        """0 if granted, otherwise seconds to wait before retrying."""
+        with self._lock:
+            blocked = self._blocked_until.get(exchange_id, 0) - time.monotonic()
+            if blocked > 0:
+                return blocked
+            if any(self._waiting.get((exchange_id, p)) for p in range(level)):
+                return 0.01  # уступаем более срочным (выходам)
+            ip = self._ip_bucket(exchange_id)
+            orders = self._order_bucket(exchange_id, uid) if is_order else None
+            wait = max(ip.wait_time(weight), orders.wait_time(1) if orders else 0.0)
+            if wait:
+                return wait
+            ip.take(weight)
+            if orders: orders.take(1)
+            return 0.0
+
+    def _enter(self, exchange_id, level):
+        with self._lock:
+            self._waiting[(exchange_id, level)] = self._waiting.get((exchange_id, level), 0) + 1
+
+    def _leave(self, exchange_id, level):
+        with self._lock:
+            self._waiting[(exchange_id, level)] -= 1
+
+    def acquire(self, exchange_id, uid=None, weight=1, is_order=False, level=None):
+        level = _current_priority.get() if level is None else level
+        wait = self._try_acquire(exchange_id, uid, weight, is_order, level)
+        if not wait:
+            return
+        self._enter(exchange_id, level)
+        try:
+            while wait:
+                time.sleep(min(wait, 0.25))
+                wait = self._try_acquire(exchange_id, uid, weight, is_order, level)
+        finally:
+            self._leave(exchange_id, level)
+
+    async def acquire_async(self, exchange_id, uid=None, weight=1, is_order=False, level=None):
+        level = _current_priority.get() if level is None else level
+        wait = self._try_acquire(exchange_id, uid, weight, is_order, level)
+        if not wait:
+            return
+        self._enter(exchange_id, level)
+        try:
+            while wait:
+                await asyncio.sleep(min(wait, 0.25))
+                wait = self._try_acquire(exchange_id, uid, weight, is_order, level)
+        finally:
+            self._leave(exchange_id, level)
+
+    def report_error(self, exchange_id, error):
+        """Pauses the whole exchange when it says we are over the limit (429) or banned (418)."""
+        pause = None
+        if isinstance(error, ClientError) and error.status_code in (418, 429):
+            headers = getattr(error, 'header', None) or {}
+            pause = float(headers.get('Retry-After') or (120 if error.status_code == 418 else 10))
+        elif isinstance(error, (ccxt.RateLimitExceeded, ccxt.DDoSProtection)):
+            pause = 10.0
+        if pause:
+            with self._lock:
+                self._blocked_until[exchange_id] = max(self._blocked_until.get(exchange_id, 0), time.monotonic() + pause)
+            print(f"🚦 {exchange_id}: rate limit hit, pausing all requests for {pause:.0f}s.")
+
+
+rate_limiter = RateLimiter()
+
+
+class LimitedClient:
+    """Transparent proxy that passes every public method call through the shared limiter."""
+
+    def __init__(self, client, exchange_id, uid=None, limiter: RateLimiter = None):
+        self._client = client
+        self._exchange_id = exchange_id
+        self._uid = uid
+        self._limiter = limiter or rate_limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or name in LOCAL_CALLS or not callable(attr):
+            return attr
+        weight = CALL_WEIGHTS.get(name, 1)
+        is_order = name in ORDER_CALLS
+
+        if asyncio.iscoroutinefunction(attr):
+            async def limited_async(*args, **kwargs):
+                await self._limiter.acquire_async(self._exchange_id, self._uid, weight, is_order)
+                return await attr(*args, **kwargs)
+            return limited_async
+
+        def limited_call(*args, **kwargs):
+            self._limiter.acquire(self._exchange_id, self._uid, weight, is_order)
+            return attr(*args, **kwargs)
+        return limited_call
+
+
+def limited(client, exchange_id, uid=None):
+    return LimitedClient(client, exchange_id.lower(), uid)
@@ -1,17 +1,31 @@
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 import asyncio
 import os
-from database import get_user_exchanges, get_user_decrypted_keys, get_user_language, save_user_language, execute_write_query
-from exchange_utils import fetch_exchange_balance_safe, validate_exchange_credentials
+from contextlib import asynccontextmanager
+from database import get_user_exchanges, get_user_language, save_user_language, get_user_view, invalidate_user_view
+from exchange_utils import validate_exchange_credentials
+from balance_service import balance_service
+from live_events import live_events, sse
+from user_events import follow
+from pnl_engine import pnl_report
 from tx_verifier import verify_bsc_tx
-import sqlite3
-from database import DB_NAME
+from database import run_db, update_exchange_reserve, upsert_user_exchange, get_last_balances
+from rate_limiter import set_process_role
 
-app = FastAPI()
+set_process_role('server')
+
+@asynccontextmanager
+async def lifespan(app):
+    relay = asyncio.create_task(_relay_user_events())
+    yield
+    relay.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -45,75 +59,160 @@ class TopUpRequest(BaseModel):
 
 # --- API ---
 
-@app.get("/api/data")
-async def get_user_data(user_id: int):
-    """Returns total balance, connected exchanges list, current language, and internal token balance."""
-    exchanges = get_user_exchanges(user_id)
-    language = get_user_language(user_id)
-    
-    # Get internal token balance
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT token_balance FROM users WHERE user_id = ?", (user_id,))
-    res = cursor.fetchone()
-    token_balance = res[0] if res else 0.0
-    conn.close()
-    
+def _load_user_data(user_id: int):
+    return get_user_exchanges(user_id), get_user_language(user_id), get_user_view(user_id), get_last_balances(user_id)
+
+def _balances_payload(exchanges: list, known: dict) -> dict:
+    """Total + per-exchange list from balance_service.last_known() results."""
     total_balance = 0.0
-    ex_list = []
-    
-    # Process exchanges concurrently? For simplicity loop (concurrent better)
-    tasks = []
-    
+    ex_list, updated, stale = [], [], False
+
     for ex in exchanges:
-        keys = get_user_decrypted_keys(user_id, ex['exchange_name'])
-        if keys:
-            tasks.append(
-                fetch_exchange_balance_safe(
-                    ex['exchange_name'], 
-                    keys['apiKey'], 
-                    keys['secret'], 
-                    keys['password']
-                )
-            )
+        bal, updated_at, fresh = known.get(ex['exchange_name'], (None, None, False))
+        if updated_at is None:
+            status = "Syncing"  # баланс еще ни разу не получен - придет через /api/stream
         else:
-            tasks.append(asyncio.sleep(0, result=None)) # Dummy
-
-    # Run all fetches
-    if tasks:
-        results = await asyncio.gather(*tasks)
-    else:
-        results = []
-
-    for i, ex in enumerate(exchanges):
-        bal = results[i]
-        status = "Connected" if bal is not None else "Error"
+            status = "Connected" if bal is not None else "Error"
+            updated.append(updated_at)
         if not ex['is_active']: status = "Disconnected"
-        
+        stale = stale or not fresh
+
         real_bal = bal if bal is not None else 0.0
         if status == "Connected":
             total_balance += real_bal
-            
+
         ex_list.append({
             "name": ex['exchange_name'].capitalize(),
             "status": status,
             "balance": real_bal,
             "icon": get_icon(ex['exchange_name']),
             "strategy": ex['strategy'],
-            "reserve": ex['reserved_amount']
+            "reserve": ex['reserved_amount'],
+            "updatedAt": updated_at
         })
-        
+
     return {
         "totalBalance": total_balance,
-        "pnl": "+0.0%", # Todo: calculate PnL
         "exchanges": ex_list,
+        "updatedAt": min(updated) if updated else None,  # самый старый из показанных балансов
+        "stale": stale
+    }
+
+_revalidating = {}  # user_id -> asyncio.Task
+
+def _schedule_revalidation(user_id: int, exchanges: list):
+    """Fetches fresh balances in the background and pushes them to the user's open streams."""
+    task = _revalidating.get(user_id)
+    if task is None or task.done():
+        _revalidating[user_id] = asyncio.create_task(_revalidate(user_id, exchanges))
+
+async def _revalidate(user_id: int, exchanges: list):
+    try:
+        known = await balance_service.revalidate(user_id, exchanges)
+        live_events.publish(user_id, "balances", _balances_payload(exchanges, known))
+    except Exception as e:
+        print(f"⚠️ Balance revalidation failed for {user_id}: {e}")
+    finally:
+        if _revalidating.get(user_id) is asyncio.current_task():
+            del _revalidating[user_id]
+
+TRADE_EVENTS = ('entry', 'close')
+CREDIT_EVENTS = ('fee', 'referral')
+
+async def _relay_user_events():
+    """Forwards copier events (user_events journal) to open streams; trades also refresh balances."""
+    while True:
+        try:
+            async for batch in follow():
+                for user_id, event, data in batch:
+                    if event in CREDIT_EVENTS or event in TRADE_EVENTS:
+                        invalidate_user_view(user_id)  # токены / позиции изменил другой процесс
+                    if live_events.publish(user_id, event, data):
+                        await _push_followups(user_id, event)
+        except Exception as e:
+            print(f"⚠️ User events relay failed: {e}, restarting...")
+            await asyncio.sleep(5)
+
+async def _push_followups(user_id: int, event: str):
+    if event in TRADE_EVENTS:
+        balance_service.invalidate(user_id)
+        _schedule_revalidation(user_id, await run_db(get_user_exchanges, user_id))
+        live_events.publish(user_id, "pnl", _pnl_detail(await run_db(get_user_view, user_id)))
+    elif event in CREDIT_EVENTS:
+        view = await run_db(get_user_view, user_id)
+        live_events.publish(user_id, "credits", {"credits": view['balance'] if view else 0.0})
+
+def _pnl_detail(view) -> dict:
+    """WebApp PnL block: pre-aggregated realised PnL + mark-to-market of open positions."""
+    report = pnl_report(view)
+    total = report["all"]
+    return {
+        "realized": total["realized"],
+        "today": report["today"]["realized"],
+        "unrealized": report["unrealized"],
+        "fees": total["fees"],
+        "trades": total["trades"],
+        "winRate": total["wins"] / total["trades"] if total["trades"] else None,
+        "positions": report["positions"],
+        "priced": report["priced"],
+        "byExchange": report["by_exchange"],
+    }
+
+def _pnl_percent(detail: dict, total_balance: float) -> str:
+    """Today's realised + open PnL relative to the portfolio before it."""
+    change = detail["today"] + detail["unrealized"]
+    base = total_balance - change
+    return f"{(change / base * 100 if base > 0 else 0.0):+.1f}%"
+
+@app.get("/api/data")
+async def get_user_data(user_id: int):
+    """
+    Returns total balance, connected exchanges list, current language, and internal token balance.
+    Balances are the last known ones (with updatedAt); stale ones are refreshed in the background
+    and pushed through /api/stream.
+    """
+    # Все обращения к базе - одним заходом в пул потоков (run_db), event loop не блокируется
+    exchanges, language, view, stored = await run_db(_load_user_data, user_id)
+
+    # Internal token balance
+    token_balance = view['balance'] if view else 0.0
+
+    payload = _balances_payload(exchanges, balance_service.last_known(user_id, exchanges, stored))
+    if payload["stale"]:
+        _schedule_revalidation(user_id, exchanges)
+    pnl = _pnl_detail(view)
+
+    return {
+        **payload,
+        "pnl": _pnl_percent(pnl, payload["totalBalance"]),
+        "pnlDetail": pnl,
         "language": language,
         "credits": token_balance
     }
 
+@app.get("/api/stream")
+async def stream_updates(user_id: int):
+    """
+    Server-Sent Events: `balances` (same fields as /api/data) whenever fresh numbers arrive,
+    `credits` after fee / referral postings, `pnl` (as pnlDetail) after trades
+    and the copier's `entry` / `close` / `fee` / `referral`.
+    """
+    exchanges = await run_db(get_user_exchanges, user_id)
+    known = balance_service.last_known(user_id, exchanges)
+    payload = _balances_payload(exchanges, known)
+    if payload["stale"]:
+        _schedule_revalidation(user_id, exchanges)
+    # Первым сообщением - текущий снимок: ревалидация могла закончиться до подключения
+    first = sse("balances", payload) if not payload["stale"] else None
+    return StreamingResponse(
+        live_events.stream(user_id, first),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/topup")
 async def top_up(req: TopUpRequest):
-    success, result = verify_bsc_tx(req.tx_id, req.user_id)
+    success, result = await verify_bsc_tx(req.tx_id, req.user_id)
     if success:
         return {"status": "ok", "msg": f"Successfully credited {result} USDT", "amount": result}
     else:
@@ -121,17 +220,14 @@ async def top_up(req: TopUpRequest):
 
 @app.post("/api/language")
 async def set_language(req: LanguageRequest):
-    save_user_language(req.user_id, req.language)
+    await run_db(save_user_language, req.user_id, req.language)
     return {"status": "ok"}
 
 @app.post("/api/reserve")
 async def set_reserve(req: ReserveRequest):
     try:
-        execute_write_query("""
-            UPDATE user_exchanges 
-            SET reserved_amount = ? 
-            WHERE user_id = ? AND exchange_name = ?
-        """, (req.reserve, req.user_id, req.exchange.lower()))
+        # Через хелпер базы: он же сбрасывает кэши ключей и вида пользователя
+        await run_db(update_exchange_reserve, req.user_id, req.exchange.lower(), req.reserve)
         return {"status": "ok"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -151,29 +247,8 @@ async def connect_exchange(req: ConnectRequest):
     
     # 2. Save to DB
     try:
-        from database import encrypt_data
-        
-        enc_secret = encrypt_data(req.secret)
-        enc_pass = encrypt_data(req.password) if req.password else None
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Insert or Replace
-        cursor.execute("""
-            INSERT INTO user_exchanges (user_id, exchange_name, api_key, api_secret_encrypted, passphrase_encrypted, strategy, reserved_amount, is_active, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, 1, datetime('now'))
-            ON CONFLICT(user_id, exchange_name) DO UPDATE SET
-            api_key=excluded.api_key,
-            api_secret_encrypted=excluded.api_secret_encrypted,
-            passphrase_encrypted=excluded.passphrase_encrypted,
-            strategy=excluded.strategy,
-            reserved_amount=excluded.reserved_amount,
-            is_active=1
-        """, (req.user_id, req.exchange.lower(), req.api_key, enc_secret, enc_pass, req.strategy, req.reserve))
-        
-        conn.commit()
-        conn.close()
+        # Шифрование (Fernet) и запись - в пуле потоков базы
+        await run_db(upsert_user_exchange, req.user_id, req.exchange.lower(), req.api_key, req.secret, req.password, req.strategy, req.reserve)
         
         return {"status": "ok", "msg": "Exchange connected successfully"}
     except Exception as e:
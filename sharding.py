@@ -0,0 +1,41 @@
+# sharding.py
+"""
+Шардирование копировщика по подписчикам.
+
+COPY_SHARDS=K процессов воркера читают один и тот же журнал сигналов (signal_log),
+но каждый исполняет ордера только для своих user_exchanges: shard = crc32(user_id) % K.
+crc32, а не hash(): разбиение одинаковое во всех процессах и на всех хостах.
+
+У каждого шарда свой consumer offset (copier-<i>of<K>), поэтому lag считается по шардам,
+а медленная биржа одного подписчика тормозит только его шард.
+"""
+import os
+import zlib
+
+COPY_SHARDS = int(os.getenv("COPY_SHARDS", "1"))
+# Для запуска одного шарда на отдельном хосте: COPY_SHARD_INDEX=i (вместе с COPY_SHARDS=K)
+COPY_SHARD_INDEX = os.getenv("COPY_SHARD_INDEX")
+
+CONSUMER_PREFIX = "copier"
+
+
+def shard_of(user_id: int, shard_count: int) -> int:
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+
+def shard_consumer(index: int, shard_count: int) -> str:
+    """Signal-log consumer name of a shard (a single unsharded worker keeps the plain 'copier' offset)."""
+    if shard_count <= 1:
+        return CONSUMER_PREFIX
+    return f"{CONSUMER_PREFIX}-{index}of{shard_count}"
+
+
+def shard_consumers(shard_count: int) -> list:
+    return [shard_consumer(i, shard_count) for i in range(max(shard_count, 1))]
+
+
+def owns(shard, user_id: int) -> bool:
+    """shard is (index, count) or None (= every user)."""
+    if not shard or shard[1] <= 1:
+        return True
+    return shard_of(user_id, shard[1]) == shard[0]
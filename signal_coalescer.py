@@ -0,0 +1,104 @@
+# signal_coalescer.py
+"""
+Склейка частичных исполнений ордеров мастера.
+
+Bybit / BingX присылают апдейт на каждый кусок исполнения, и каждый раньше становился
+полным фан-аутом на всех подписчиков (10 кусков = 10x ордеров и комиссий).
+Здесь апдейты одного ордера мастера (ключ: биржа + order id) копятся SIGNAL_COALESCE_WINDOW
+секунд и уходят одним сигналом на прирост исполненного объема (cum qty - уже скопировано).
+FILLED закрывает ордер сразу: финальная сверка отправляет только оставшийся хвост.
+
+Сигналы без order id / cum qty (или закрытия SL/TP) проходят без задержки.
+"""
+import os
+import time
+import threading
+
+SIGNAL_COALESCE_WINDOW = float(os.getenv("SIGNAL_COALESCE_WINDOW", "1.0"))
+# Сколько помнить ордер после последнего апдейта (мастер мог не прислать FILLED)
+SIGNAL_COALESCE_TTL = 10 * 60
+
+CLOSE_ORDER_TYPES = ('STOP_MARKET', 'TAKE_PROFIT_MARKET')
+
+
+def _f(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SignalCoalescer:
+    def __init__(self, emit, window: float = SIGNAL_COALESCE_WINDOW):
+        self.emit = emit
+        self.window = window
+        self._orders = {}   # (exchange, order_id) -> {'copied': qty, 'pending': event|None, 'parts': n, 'deadline', 'seen'}
+        self._cond = threading.Condition()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def offer(self, event: dict):
+        order_id, cum_qty = event.get('i'), _f(event.get('z'))
+        key = (event.get('master_exchange', 'binance'), order_id)
+
+        if not order_id or cum_qty is None or self.window <= 0 or event.get('X') not in ('FILLED', 'PARTIALLY_FILLED'):
+            self.emit(event)
+            return
+
+        if event.get('ot') in CLOSE_ORDER_TYPES:
+            # Close-all по символу: первый же кусок закрывает всех, остальные куски - лишние
+            with self._cond:
+                first = key not in self._orders
+                self._orders[key] = {'copied': cum_qty, 'pending': None, 'parts': 0, 'deadline': None, 'seen': time.time()}
+            if first: self.emit(event)
+            return
+
+        ready = None
+        with self._cond:
+            state = self._orders.setdefault(key, {'copied': 0.0, 'pending': None, 'parts': 0, 'deadline': None, 'seen': 0})
+            state['seen'] = time.time()
+            state['pending'] = event
+            state['parts'] += 1
+            if event.get('X') == 'FILLED':
+                # Финальная сверка: отправляем хвост сразу; запись живет до TTL,
+                # чтобы повторная доставка FILLED не скопировала ордер второй раз
+                ready = self._take(key, state)
+            elif state['deadline'] is None:
+                state['deadline'] = time.monotonic() + self.window
+                self._cond.notify()
+        if ready: self.emit(ready)
+
+    def _take(self, key, state):
+        """Aggregated signal for everything filled since the last emit (None if nothing new)."""
+        event = state['pending']
+        state['pending'], state['deadline'] = None, None
+        if event is None:
+            return None
+        cum_qty = _f(event.get('z'))
+        delta = cum_qty - state['copied']
+        parts, state['parts'] = state['parts'], 0
+        if delta <= 0:
+            return None
+        state['copied'] = cum_qty
+        merged = dict(event, q=delta, coalesced=parts)
+        if parts > 1:
+            print(f"🧩 Coalesced {parts} fills of {key[0]} order {key[1]} ({merged.get('s')}): +{delta}")
+        return merged
+
+    def _flush_loop(self):
+        while True:
+            ready = []
+            with self._cond:
+                now = time.monotonic()
+                deadlines = [s['deadline'] for s in self._orders.values() if s['deadline']]
+                if not deadlines or min(deadlines) > now:
+                    self._cond.wait(timeout=(min(deadlines) - now) if deadlines else 30)
+                    now = time.monotonic()
+                for key, state in list(self._orders.items()):
+                    if state['deadline'] and state['deadline'] <= now:
+                        ready.append(self._take(key, state))
+                    elif not state['deadline'] and time.time() - state['seen'] > SIGNAL_COALESCE_TTL:
+                        self._orders.pop(key, None)
+            for event in ready:
+                if event:
+                    try: self.emit(event)
+                    except Exception as e: print(f"❌ Coalescer emit failed: {e}")
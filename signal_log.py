@@ -0,0 +1,236 @@
+# signal_log.py
+"""
+Долговечный журнал сигналов мастеров (SQLite WAL, append-only).
+
+Слушатели master_tracker пишут сигналы в журнал, воркер читает по своему offset.
+- Краш / редеплой не теряет сигналы: после рестарта воркер дочитывает с последнего offset.
+- idem_key (exchange:order_id:status:cum_qty) -> один и тот же апдейт ордера не попадет дважды
+  (повторная доставка по WebSocket, переподключение, опрос OKX).
+- Слушатели и копировщик могут работать отдельными процессами (TRACKER_ROLE в master_tracker.py).
+- lag(consumer) показывает, насколько воркер отстает.
+
+Доставка at-least-once: offset двигается только когда фан-аут сигнала по подписчикам
+завершен (futures, переданные в task_done), и строго по порядку - после падения
+недоисполненный сигнал и все следующие за ним будут обработаны повторно. Сигналы старше
+SIGNAL_REPLAY_MAX_AGE при повторе пропускаются - рынок уже ушел.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+import collections
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SIGNAL_LOG_PATH = os.path.join(os.getenv("RENDER_DISK_PATH") or BASE_DIR, "signal_log.db")
+SIGNAL_LOG_POLL_INTERVAL = float(os.getenv("SIGNAL_LOG_POLL_INTERVAL", "0.05"))
+SIGNAL_REPLAY_MAX_AGE = int(os.getenv("SIGNAL_REPLAY_MAX_AGE", "120"))
+SIGNAL_LOG_RETENTION_DAYS = int(os.getenv("SIGNAL_LOG_RETENTION_DAYS", "7"))
+
+
+def signal_key(event: dict):
+    """Idempotency key of one master order update, or None if the listener gave no order id."""
+    order_id = event.get('i')
+    if not order_id:
+        return None
+    return f"{event.get('master_exchange', 'binance')}:{order_id}:{event.get('X')}:{event.get('z', event.get('q'))}"
+
+
+class SignalLog:
+    def __init__(self, path: str = SIGNAL_LOG_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS signals (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                idem_key TEXT UNIQUE, -- NULL не конфликтует -> сигналы без order id пишутся всегда
+                master_exchange TEXT,
+                payload TEXT,
+                created_at REAL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS consumer_offsets (
+                consumer TEXT PRIMARY KEY,
+                seq INTEGER,
+                updated_at REAL
+            )
+        """)
+        conn.commit()
+
+    def _conn(self):
+        # Одно соединение на поток: слушатели пишут из своих потоков, воркер читает из своего
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+        return conn
+
+    # --- PRODUCER ---
+    def append(self, event: dict):
+        """Appends a signal; returns its seq, or None if this order update was already logged."""
+        conn = self._conn()
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO signals (idem_key, master_exchange, payload, created_at) VALUES (?, ?, ?, ?)",
+            (signal_key(event), event.get('master_exchange', 'binance'), json.dumps(event), time.time())
+        )
+        conn.commit()
+        return cur.lastrowid if cur.rowcount else None
+
+    # --- CONSUMER ---
+    def read(self, after_seq: int, limit: int = 100) -> list:
+        """[(seq, event, created_at)] strictly after after_seq, oldest first."""
+        rows = self._conn().execute(
+            "SELECT seq, payload, created_at FROM signals WHERE seq > ? ORDER BY seq LIMIT ?", (after_seq, limit)
+        ).fetchall()
+        return [(seq, json.loads(payload), created_at) for seq, payload, created_at in rows]
+
+    def offset(self, consumer: str) -> int:
+        row = self._conn().execute("SELECT seq FROM consumer_offsets WHERE consumer = ?", (consumer,)).fetchone()
+        if row:
+            return row[0]
+        # Новый потребитель начинает с конца журнала, а не с истории
+        return self.head()
+
+    def commit(self, consumer: str, seq: int):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO consumer_offsets (consumer, seq, updated_at) VALUES (?, ?, ?)",
+            (consumer, seq, time.time())
+        )
+        conn.commit()
+
+    def head(self) -> int:
+        row = self._conn().execute("SELECT MAX(seq) FROM signals").fetchone()
+        return row[0] or 0
+
+    def lag(self, consumer: str) -> dict:
+        """{'signals': N unconsumed, 'seconds': age of the oldest unconsumed signal}."""
+        offset = self.offset(consumer)
+        row = self._conn().execute(
+            "SELECT COUNT(*), MIN(created_at) FROM signals WHERE seq > ?", (offset,)
+        ).fetchone()
+        return {"signals": row[0], "seconds": time.time() - row[1] if row[1] else 0.0}
+
+    def lags(self, prefix: str) -> dict:
+        """{consumer: lag} for every consumer whose name starts with prefix (per-shard lag)."""
+        rows = self._conn().execute("SELECT consumer FROM consumer_offsets WHERE consumer LIKE ?", (f"{prefix}%",)).fetchall()
+        return {r[0]: self.lag(r[0]) for r in rows}
+
+    def rebalance(self, consumers: list, prefix: str) -> int:
+        """
+        Switches the consumer group `prefix` to a new set of names (e.g. after COPY_SHARDS changed).
+        New consumers start from the slowest old offset, so no signal is skipped during the
+        handover; old consumers are removed. Idempotent - every shard host may call it.
+        """
+        conn = self._conn()
+        with conn:
+            rows = dict(conn.execute("SELECT consumer, seq FROM consumer_offsets WHERE consumer LIKE ?", (f"{prefix}%",)).fetchall())
+            retired = {c: s for c, s in rows.items() if c not in consumers}
+            start = min(retired.values()) if retired else (min(rows.values()) if rows else self.head())
+            for c in consumers:
+                if c not in rows:
+                    conn.execute("INSERT INTO consumer_offsets (consumer, seq, updated_at) VALUES (?, ?, ?)", (c, start, time.time()))
+            for c in retired:
+                conn.execute("DELETE FROM consumer_offsets WHERE consumer = ?", (c,))
+        if retired:
+            print(f"🔀 Signal log: {sorted(retired)} -> {consumers} from #{start}")
+        return start
+
+    def trim(self, retention_days: int = SIGNAL_LOG_RETENTION_DAYS):
+        """Drops signals older than the retention window that every consumer has already passed."""
+        conn = self._conn()
+        min_offset = conn.execute("SELECT MIN(seq) FROM consumer_offsets").fetchone()[0] or 0
+        conn.execute("DELETE FROM signals WHERE seq <= ? AND created_at < ?",
+                     (min_offset, time.time() - retention_days * 86400))
+        conn.commit()
+
+
+class SignalQueue:
+    """
+    queue.Queue-compatible view of the log for TradeCopier.start_consuming:
+    put() appends, get() blocks for the next signal after the consumer's offset,
+    task_done(futures) marks the oldest handed-out signal processed. Its offset is
+    committed once those futures (the signal's fan-out) are done and every earlier
+    signal is committed too.
+    """
+
+    def __init__(self, log: SignalLog = None, consumer: str = 'copier', max_age: int = SIGNAL_REPLAY_MAX_AGE):
+        self.log = log or SignalLog()
+        self.consumer = consumer
+        self.max_age = max_age
+        self._cursor = None
+        self._buffer = []
+        self._pending = []
+        self._unsettled = collections.OrderedDict()   # seq -> незавершенных futures, по порядку seq
+        self._settle_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def put(self, event):
+        if event is None:
+            self._stopped.set()
+            return
+        self.log.append(event)
+
+    def get(self):
+        if self._cursor is None:
+            # Фиксируем стартовую позицию сразу, чтобы lag считался и до первого task_done
+            self._cursor = self.log.offset(self.consumer)
+            self.log.commit(self.consumer, self._cursor)
+        while True:
+            if self._stopped.is_set():
+                self._pending.append(None)
+                return None
+            if not self._buffer:
+                self._buffer = self.log.read(self._cursor)
+                if not self._buffer:
+                    time.sleep(SIGNAL_LOG_POLL_INTERVAL)
+                    continue
+
+            seq, event, created_at = self._buffer.pop(0)
+            self._cursor = seq
+            if time.time() - created_at > self.max_age:
+                print(f"⏭ Signal #{seq} {event.get('s')} is {time.time() - created_at:.0f}s old, skipping replay.")
+                # Не коммитим мимо еще исполняемых сигналов перед ним
+                with self._settle_lock:
+                    self._unsettled[seq] = 0
+                self._commit_settled()
+                continue
+            self._pending.append(seq)
+            return event
+
+    def task_done(self, futures=()):
+        seq = self._pending.pop(0) if self._pending else None
+        if seq is None:
+            return
+        futures = [f for f in futures or () if f is not None]
+        with self._settle_lock:
+            self._unsettled[seq] = len(futures)
+        for f in futures:
+            f.add_done_callback(lambda _, seq=seq: self._settle(seq))
+        self._commit_settled()
+
+    def _settle(self, seq):
+        # Вызывается из потоков пула / event loop, когда задача подписчика завершилась
+        with self._settle_lock:
+            self._unsettled[seq] -= 1
+        self._commit_settled()
+
+    def _commit_settled(self):
+        """Commits the offset up to the longest prefix of fully executed signals."""
+        with self._settle_lock:
+            last = None
+            while self._unsettled:
+                seq, left = next(iter(self._unsettled.items()))
+                if left:
+                    break
+                self._unsettled.popitem(last=False)
+                last = seq
+            if last is not None:
+                self.log.commit(self.consumer, last)
+
+    def lag(self) -> dict:
+        return self.log.lag(self.consumer)
@@ -0,0 +1,63 @@
+# startup_benchmark.py
+"""
+Замер времени старта процессов: импорт модуля в чистом интерпретаторе (как при деплое).
+
+    python startup_benchmark.py                 # bot, server, worker, master_tracker
+    python startup_benchmark.py bot -n 10       # только бот, 10 прогонов
+    python startup_benchmark.py worker --top 15 # + самые тяжелые импорты (python -X importtime)
+"""
+import sys
+import argparse
+import statistics
+import subprocess
+
+DEFAULT_MODULES = ["bot", "server", "worker", "master_tracker"]
+
+MEASURE = "import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+
+
+def measure(module: str, runs: int) -> list:
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", MEASURE.format(module=module)], capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{out.stderr.strip()[-2000:]}")
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def heaviest_imports(module: str, top: int) -> list:
+    """(cumulative seconds, package) from python -X importtime, heaviest first."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if "." not in name and name != module:  # только пакеты верхнего уровня, без дублей подмодулей
+            rows.append((int(parts[1]) / 1e6, name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the bot / server / worker processes")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="show the N heaviest top-level imports")
+    args = parser.parse_args()
+
+    print(f"{'module':<16}{'median':>10}{'min':>10}{'max':>10}")
+    for module in args.modules:
+        try:
+            samples = measure(module, args.runs)
+        except RuntimeError as e:
+            print(f"{module:<16}  ❌ {e}")
+            continue
+        print(f"{module:<16}{statistics.median(samples):>9.3f}s{min(samples):>9.3f}s{max(samples):>9.3f}s")
+        for seconds, name in heaviest_imports(module, args.top):
+            print(f"    {seconds:>7.3f}s  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# symbol_filters.py
+"""
+Локальный каталог фильтров символов бирж (stepSize, tickSize, minQty, minNotional, max leverage).
+
+Грузится один раз из Binance exchangeInfo / CCXT markets, сохраняется на диск
+(рядом с базой, переживает рестарт) и обновляется по расписанию в фоне.
+Поиск - O(1) по словарю, без REST-запросов на каждый ордер.
+
+Ключ: (exchange, market_type, символ без разделителей) -> BTCUSDT, BTC/USDT и BTC/USDT:USDT
+указывают на одну запись.
+"""
+import os
+import json
+import time
+import threading
+import ccxt
+from binance.um_futures import UMFutures
+
+from rate_limiter import limited, priority, READ
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SYMBOL_FILTERS_PATH = os.path.join(os.getenv("RENDER_DISK_PATH") or BASE_DIR, "symbol_filters.json")
+SYMBOL_FILTERS_REFRESH_SECONDS = int(os.getenv("SYMBOL_FILTERS_REFRESH_SECONDS", str(6 * 60 * 60)))
+# Не дергаем exchangeInfo чаще раза в минуту, даже если спрашивают неизвестный символ
+SYMBOL_FILTERS_MISS_COOLDOWN = 60
+
+BINANCE_FAPI_URL = "https://fapi.binance.com"
+
+
+def normalize_symbol(symbol: str) -> str:
+    """BTC/USDT:USDT, BTC/USDT, BTC-USDT -> BTCUSDT."""
+    return symbol.split(':')[0].replace('/', '').replace('-', '').upper()
+
+
+def _f(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _load_binance_futures():
+    """USDT-M filters straight from /fapi/v1/exchangeInfo."""
+    with priority(READ):
+        info = limited(UMFutures(base_url=BINANCE_FAPI_URL), 'binance').exchange_info()
+    filters = {}
+    for s in info.get('symbols', []):
+        if s.get('status') not in (None, 'TRADING'): continue
+        f = {x['filterType']: x for x in s.get('filters', [])}
+        lot = f.get('MARKET_LOT_SIZE') or f.get('LOT_SIZE') or {}
+        filters[normalize_symbol(s['symbol'])] = {
+            "step_size": _f(lot.get('stepSize')) or _f((f.get('LOT_SIZE') or {}).get('stepSize')),
+            "tick_size": _f((f.get('PRICE_FILTER') or {}).get('tickSize')),
+            "min_qty": _f(lot.get('minQty')) or 0.0,
+            "min_notional": _f((f.get('MIN_NOTIONAL') or {}).get('notional')) or 0.0,
+            "max_leverage": None,  # leverage brackets требуют подписанный запрос
+        }
+    return filters
+
+
+def _load_ccxt(exchange_id: str, market_type: str):
+    client = limited(getattr(ccxt, exchange_id)({'options': {'defaultType': market_type}}), exchange_id)
+    with priority(READ):
+        markets = client.load_markets(reload=True)
+    tick_mode = client.precisionMode == ccxt.TICK_SIZE
+
+    def step(p):
+        if p is None: return None
+        return float(p) if tick_mode else 10 ** -int(p)
+
+    want_spot = market_type == 'spot'
+    filters = {}
+    for m in markets.values():
+        if bool(m.get('spot')) != want_spot or not m.get('active', True): continue
+        # Только USDT-M бессрочные: у датированных фьючерсов (BTC/USDT:USDT-250627) тот же нормализованный ключ
+        if not want_spot and not (m.get('linear') and m.get('swap')): continue
+        limits = m.get('limits') or {}
+        filters[normalize_symbol(m['symbol'])] = {
+            "step_size": step(m['precision'].get('amount')),
+            "tick_size": step(m['precision'].get('price')),
+            "min_qty": (limits.get('amount') or {}).get('min') or 0.0,
+            "min_notional": (limits.get('cost') or {}).get('min') or 0.0,
+            "max_leverage": (limits.get('leverage') or {}).get('max'),
+        }
+    return filters
+
+
+class SymbolFiltersCatalogue:
+    def __init__(self, path: str = SYMBOL_FILTERS_PATH, refresh_seconds: int = SYMBOL_FILTERS_REFRESH_SECONDS):
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self._filters = {}        # (exchange, market_type) -> {SYMBOL: filters}
+        self._loaded_at = {}      # (exchange, market_type) -> unix time
+        self._last_miss = {}
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._load_from_disk()
+
+    # --- LOOKUP ---
+    def get(self, exchange_id: str, symbol: str, market_type: str = 'future'):
+        """O(1) lookup; on a miss refreshes that exchange (at most once per cooldown) and retries."""
+        book = (exchange_id.lower(), market_type)
+        key = normalize_symbol(symbol)
+        found = self._filters.get(book, {}).get(key)
+        if found is not None:
+            return found
+
+        now = time.time()
+        with self._lock:
+            if now - self._last_miss.get(book, 0) < SYMBOL_FILTERS_MISS_COOLDOWN:
+                return None
+            self._last_miss[book] = now
+        self.refresh(*book)
+        return self._filters.get(book, {}).get(key)
+
+    # --- LOADING ---
+    def refresh(self, exchange_id: str, market_type: str = 'future') -> bool:
+        try:
+            if exchange_id == 'binance' and market_type == 'future':
+                filters = _load_binance_futures()
+            else:
+                filters = _load_ccxt(exchange_id, market_type)
+        except Exception as e:
+            print(f"⚠️ Symbol filters refresh failed ({exchange_id}/{market_type}): {e}")
+            return False
+
+        with self._lock:
+            # Новый словарь целиком подменяется -> читатели без блокировок видят старый или новый
+            self._filters = {**self._filters, (exchange_id, market_type): filters}
+            self._loaded_at[(exchange_id, market_type)] = time.time()
+        self._save_to_disk()
+        print(f"📐 Symbol filters: {exchange_id}/{market_type} -> {len(filters)} symbols.")
+        return True
+
+    def refresh_stale(self):
+        now = time.time()
+        for book, loaded_at in list(self._loaded_at.items()):
+            if now - loaded_at >= self.refresh_seconds:
+                self.refresh(*book)
+
+    def start_auto_refresh(self):
+        """Background thread re-pulling every known exchange once per refresh interval."""
+        if self._refresher: return
+
+        def loop():
+            while True:
+                self.refresh_stale()
+                time.sleep(min(self.refresh_seconds, 15 * 60))
+
+        self._refresher = threading.Thread(target=loop, daemon=True)
+        self._refresher.start()
+
+    # --- PERSISTENCE ---
+    def _load_from_disk(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for book_key, entry in data.items():
+                exchange_id, market_type = book_key.split('|')
+                self._filters[(exchange_id, market_type)] = entry['filters']
+                self._loaded_at[(exchange_id, market_type)] = entry['loaded_at']
+        except Exception as e:
+            print(f"⚠️ Symbol filters cache unreadable, will refetch: {e}")
+
+    def _save_to_disk(self):
+        with self._lock:
+            data = {f"{ex}|{mt}": {"loaded_at": self._loaded_at.get((ex, mt), 0), "filters": filters}
+                    for (ex, mt), filters in self._filters.items()}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠️ Could not persist symbol filters: {e}")
+
+
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+
+def get_catalogue() -> SymbolFiltersCatalogue:
+    """Process-wide catalogue (loaded from disk on first use, refreshed in the background)."""
+    global _catalogue
+    with _catalogue_lock:
+        if _catalogue is None:
+            _catalogue = SymbolFiltersCatalogue()
+            _catalogue.start_auto_refresh()
+        return _catalogue
@@ -0,0 +1,11 @@
+# Модули репозитория лежат в корне; database.py при импорте требует FERNET_KEY и сразу
+# выбирает файл базы - задаем их до импорта тестов, база всегда во временной папке.
+import os
+import sys
+import tempfile
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("FERNET_KEY", Fernet.generate_key().decode())
+os.environ["RENDER_DISK_PATH"] = tempfile.mkdtemp(prefix="strategy-bot-tests-")
@@ -0,0 +1,26 @@
+import client_pool
+from client_pool import ExchangeClientPool
+
+
+def test_spot_and_future_clients_coexist(monkeypatch):
+    built = []
+    monkeypatch.setattr(client_pool, 'build_exchange_client', lambda ex, keys, market_type: built.append(market_type) or object())
+    pool = ExchangeClientPool()
+    keys = {'exchange': 'okx', 'apiKey': 'k', 'secret': 's', 'password': 'p'}
+
+    spot = pool._get_raw(1, 'okx', keys, 'spot')
+    future = pool._get_raw(1, 'okx', keys, 'future')
+    assert pool._get_raw(1, 'okx', keys, 'spot') is spot
+    assert pool._get_raw(1, 'okx', keys, 'future') is future
+    assert built == ['spot', 'future']
+
+
+def test_new_keys_evict_every_market_type(monkeypatch):
+    monkeypatch.setattr(client_pool, 'build_exchange_client', lambda ex, keys, market_type: object())
+    pool = ExchangeClientPool()
+    old = {'exchange': 'okx', 'apiKey': 'k', 'secret': 's'}
+    pool._get_raw(1, 'okx', old, 'spot')
+    pool._get_raw(1, 'okx', old, 'future')
+
+    pool._get_raw(1, 'okx', dict(old, apiKey='k2'), 'future')
+    assert len(pool) == 1
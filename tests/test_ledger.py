@@ -0,0 +1,80 @@
+import pytest
+
+import database
+
+
+def _balance(user_id):
+    return database.get_connection().execute("SELECT token_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+
+def _ledger_balance(user_id):
+    return database.get_connection().execute(
+        "SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE account = ?", (f"user:{user_id}",)
+    ).fetchone()[0]
+
+
+def test_fee_with_referral_split_is_balanced():
+    # 1003 <- 1002 <- 1001 <- 1000 (реферальная цепочка из трех уровней)
+    database.add_user(1000)
+    database.add_user(1001, referrer_id=1000)
+    database.add_user(1002, referrer_id=1001)
+    database.add_user(1003, referrer_id=1002)
+    database.credit_tokens_from_payment(1003, 100.0, ref='test')
+
+    new_balance, rewards = database.bill_performance_fee(1003, 10.0, ref='trade:1')
+
+    assert new_balance == pytest.approx(_balance(1003))
+    assert [(level, rid) for level, rid, _ in rewards] == [(1, 1002), (2, 1001), (3, 1000)]
+    assert [r for _, _, r in rewards] == pytest.approx([2.0, 0.7, 0.3])
+    unbalanced = database.get_connection().execute(
+        "SELECT txn_id FROM ledger GROUP BY txn_id HAVING ABS(SUM(amount)) > 1e-9"
+    ).fetchall()
+    assert unbalanced == []
+    # users.token_balance - материализация журнала
+    for uid in (1000, 1001, 1002, 1003):
+        assert _balance(uid) == pytest.approx(_ledger_balance(uid))
+    assert _balance(1003) == pytest.approx(90.0)
+
+
+def test_unbalanced_posting_is_rejected():
+    with pytest.raises(ValueError):
+        database.run_in_writer(lambda cursor: database._post_ledger(cursor, 'fee', [('user:1', 1, -1.0), (database.LEDGER_FEES, None, 0.5)]))
+
+
+def test_repeated_topup_is_credited_once():
+    database.add_user(1010)
+    assert database.record_topup('0xabc', 1010, 25.0, '0xfrom') is True
+    assert database.record_topup('0xabc', 1010, 25.0, '0xfrom') is False
+
+    assert _balance(1010) == pytest.approx(25.0)
+    deposits = database.get_connection().execute(
+        "SELECT COUNT(DISTINCT txn_id) FROM ledger WHERE kind = 'deposit' AND ref = 'bsc:0xabc'"
+    ).fetchone()[0]
+    assert deposits == 1
+
+
+def test_withdrawal_over_balance_changes_nothing():
+    database.add_user(1020)
+    database.credit_tokens_from_payment(1020, 5.0)
+    entries_before = len(database.get_ledger_entries(1020))
+
+    assert database.create_withdrawal_request(1020, 50.0, '0xwallet') is False
+
+    assert _balance(1020) == pytest.approx(5.0)
+    assert len(database.get_ledger_entries(1020)) == entries_before
+    assert database.get_connection().execute("SELECT COUNT(*) FROM withdrawals WHERE user_id = 1020").fetchone()[0] == 0
+
+
+def test_failed_posting_rolls_back_the_whole_job():
+    database.add_user(1030)
+    database.credit_tokens_from_payment(1030, 5.0)
+
+    def withdraw_then_fail(cursor):
+        cursor.execute("INSERT INTO withdrawals (user_id, amount, wallet_address, request_date) VALUES (1030, 5.0, '0xw', '2026-01-01')")
+        database._post_ledger(cursor, 'withdrawal', [('user:1030', 1030, -5.0)])
+
+    with pytest.raises(ValueError):
+        database.run_in_writer(withdraw_then_fail)
+
+    assert _balance(1030) == pytest.approx(5.0)
+    assert database.get_connection().execute("SELECT COUNT(*) FROM withdrawals WHERE user_id = 1030").fetchone()[0] == 0
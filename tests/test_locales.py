@@ -0,0 +1,14 @@
+import threading
+
+import database
+
+
+def test_unknown_language_falls_back_to_english():
+    database._catalogues.clear()
+    result = {}
+    t = threading.Thread(target=lambda: result.update(text=database.get_text(1, 'token_balance', lang='de')), daemon=True)
+    t.start()
+    t.join(3)
+    assert not t.is_alive(), "get_text() hung on a language without a locale file"
+    assert result['text'] == database.get_text(1, 'token_balance', lang='en')
+    assert database.get_catalogue('de') is database.get_catalogue('en')
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import pytest
+
+import database
+import pnl_engine
+
+
+def _rollups(user_id):
+    rows = database.get_connection().execute(
+        "SELECT period, realized_pnl, fees, volume, trades, wins FROM pnl_rollups WHERE user_id = ? ORDER BY period", (user_id,)
+    ).fetchall()
+    return {r[0]: r[1:] for r in rows}
+
+
+def _fills(user_id):
+    return database.get_connection().execute(
+        "SELECT kind, side, price, qty, realized_pnl FROM trade_fills WHERE user_id = ? ORDER BY fill_id", (user_id,)
+    ).fetchall()
+
+
+def test_dca_entry_then_close():
+    database.add_user(2000)
+    database.record_trade_entry(2000, 'BTCUSDT', 'buy', 100.0, 1.0, exchange='binance')
+    database.record_trade_entry(2000, 'BTCUSDT', 'buy', 110.0, 1.0, exchange='binance')
+    assert database.get_open_trade(2000, 'BTCUSDT') == {"side": 'buy', "entry_price": 105.0, "quantity": 2.0}
+
+    realized = database.close_trade_in_db(2000, 'BTCUSDT', exit_price=115.0, fee=1.5, exchange='binance')
+
+    assert realized == pytest.approx(20.0)
+    assert database.get_open_trade(2000, 'BTCUSDT') is None
+    assert [f[:2] for f in _fills(2000)] == [('open', 'buy'), ('add', 'buy'), ('close', 'sell')]
+    today = datetime.now().strftime("%Y-%m-%d")
+    rollups = _rollups(2000)
+    assert set(rollups) == {'all', today}
+    for period in ('all', today):
+        pnl, fees, volume, trades, wins = rollups[period]
+        assert (pnl, fees, volume, trades, wins) == pytest.approx((20.0, 1.5, 100.0 + 110.0 + 230.0, 1, 1))
+
+
+def test_close_without_exit_price_stays_out_of_rollups():
+    database.add_user(2010)
+    database.record_trade_entry(2010, 'ETHUSDT', 'sell', 2000.0, 0.5, exchange='bybit')
+
+    assert database.close_trade_in_db(2010, 'ETHUSDT') is None
+
+    assert _fills(2010)[-1] == ('close', 'buy', None, 0.5, None)
+    pnl, fees, volume, trades, wins = _rollups(2010)['all']
+    assert (pnl, trades, wins) == (0, 0, 0)
+    assert volume == pytest.approx(1000.0)  # только объем входа
+
+
+def test_view_keeps_all_time_and_today_only():
+    database.add_user(2020)
+    database.record_trade_entry(2020, 'BTCUSDT', 'buy', 100.0, 1.0, exchange='binance')
+    database.close_trade_in_db(2020, 'BTCUSDT', exit_price=90.0, exchange='binance')
+    # Строка прошлого дня не попадает в "сегодня"
+    database.execute_write_query(
+        "INSERT INTO pnl_rollups (user_id, exchange_name, strategy, period, realized_pnl, trades) VALUES (2020, 'binance', '', '2000-01-01', 50.0, 1)"
+    )
+    database.invalidate_user_view(2020)
+
+    summary = pnl_engine.summarize_rollups(database.get_user_view(2020)["pnl_rollups"])
+
+    assert summary["all"]["realized"] == pytest.approx(-10.0)
+    assert summary["today"]["realized"] == pytest.approx(-10.0)
+    assert summary["all"]["wins"] == 0 and summary["all"]["trades"] == 1
+    assert [(x["exchange"], x["realized"]) for x in summary["by_exchange"]] == [('binance', pytest.approx(-10.0))]
+
+
+def test_mark_positions_and_report(monkeypatch):
+    open_trades = [
+        {"symbol": 'BTCUSDT', "side": 'buy', "avg_entry_price": 100.0, "total_quantity": 2.0, "exchange_name": 'binance', "strategy": 'bro-bot'},
+        {"symbol": 'BTC/USDT', "side": 'sell', "avg_entry_price": 120.0, "total_quantity": 1.0, "exchange_name": 'okx', "strategy": 'cgt'},
+        {"symbol": 'XYZUSDT', "side": 'buy', "avg_entry_price": 1.0, "total_quantity": 10.0, "exchange_name": 'bingx', "strategy": 'bro-bot'},
+    ]
+    prices = {'BTCUSDT': 110.0}
+
+    positions = pnl_engine.mark_positions(open_trades, prices)
+    assert [p["unrealized"] for p in positions] == [pytest.approx(20.0), pytest.approx(10.0), None]
+
+    monkeypatch.setattr(pnl_engine.price_feed, 'prices', lambda wait=0: prices)
+    report = pnl_engine.pnl_report({"pnl_rollups": [], "open_trades": open_trades})
+    assert report["unrealized"] == pytest.approx(30.0)
+    assert report["priced"] == 2
+    assert pnl_engine.format_usd(report["unrealized"]) == '+$30.00'
@@ -0,0 +1,36 @@
+import concurrent.futures
+
+from signal_log import SignalLog, SignalQueue
+
+
+def _queue(tmp_path):
+    log = SignalLog(str(tmp_path / "signal_log.db"))
+    log.commit('test', 0)
+    q = SignalQueue(log, consumer='test')
+    for i in range(1, 4):
+        log.append({'i': i, 's': 'BTCUSDT', 'X': 'FILLED', 'q': '1'})
+    return log, q
+
+
+def test_offset_waits_for_fan_out_in_order(tmp_path):
+    log, q = _queue(tmp_path)
+    futures = [concurrent.futures.Future() for _ in range(3)]
+    for f in futures:
+        q.get()
+        q.task_done([f])
+    assert log.offset('test') == 0
+
+    # Второй и третий сигналы исполнились раньше первого - offset стоит на месте
+    futures[1].set_result(None)
+    futures[2].set_result(None)
+    assert log.offset('test') == 0
+
+    futures[0].set_result(None)
+    assert log.offset('test') == 3
+
+
+def test_signal_without_fan_out_is_committed_at_once(tmp_path):
+    log, q = _queue(tmp_path)
+    q.get()
+    q.task_done()
+    assert log.offset('test') == 1
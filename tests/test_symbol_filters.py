@@ -0,0 +1,32 @@
+import ccxt
+
+import symbol_filters
+
+
+def _market(symbol, step, swap=True, future=False):
+    return {
+        'symbol': symbol, 'spot': False, 'swap': swap, 'future': future, 'linear': True, 'active': True,
+        'precision': {'amount': step, 'price': 0.1},
+        'limits': {'amount': {'min': step}, 'cost': {'min': 5.0}, 'leverage': {'max': 100}},
+    }
+
+
+class FakeExchange:
+    precisionMode = ccxt.TICK_SIZE
+
+    def __init__(self, config):
+        pass
+
+    def load_markets(self, reload=False):
+        # Датированный фьючерс идет после бессрочного - раньше он перезаписывал его фильтры
+        return {
+            'BTC/USDT:USDT': _market('BTC/USDT:USDT', 0.001),
+            'BTC/USDT:USDT-250627': _market('BTC/USDT:USDT-250627', 0.0001, swap=False, future=True),
+        }
+
+
+def test_dated_futures_do_not_shadow_perpetual(monkeypatch):
+    monkeypatch.setattr(symbol_filters.ccxt, 'bybit', FakeExchange, raising=False)
+    filters = symbol_filters._load_ccxt('bybit', 'future')
+    assert list(filters) == ['BTCUSDT']
+    assert filters['BTCUSDT']['step_size'] == 0.001
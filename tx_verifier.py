@@ -1,18 +1,37 @@
-from web3 import Web3
 import json
-import sqlite3
-from database import DB_NAME, execute_write_query
-from datetime import datetime
+import functools
+from database import run_db, is_topup_recorded, record_topup
 
 # --- CONFIG ---
 BSC_RPC = "https://bsc-dataseed.binance.org/"
+BSC_RPC_TIMEOUT = 10
 TARGET_ADDRESS = "0x6c639cac616254232d9c4d51b1c3646132b46c4a".lower()
 USDT_CONTRACT = "0x55d398326f99059fF775485246999027B3197955".lower()
 USDT_ABI = json.loads('[{"anonymous":false,"inputs":[{"indexed":true,"internalType":"address","name":"from","type":"address"},{"indexed":true,"internalType":"address","name":"to","type":"address"},{"indexed":false,"internalType":"uint256","name":"value","type":"uint256"}],"name":"Transfer","type":"event"}]')
 
-w3 = Web3(Web3.HTTPProvider(BSC_RPC))
+@functools.lru_cache(maxsize=1)
+def get_w3():
+    # web3 тянет eth_account и пр. (~0.6s) -> только при первой проверке, а не при старте сервера.
+    # Асинхронный провайдер: ожидание RPC не блокирует event loop сервера.
+    from web3 import AsyncWeb3, AsyncHTTPProvider
+    return AsyncWeb3(AsyncHTTPProvider(BSC_RPC, request_kwargs={"timeout": BSC_RPC_TIMEOUT}))
 
-def verify_bsc_tx(tx_hash: str, user_id: int):
+def find_usdt_transfer(w3, receipt):
+    """(amount, from_address) of the USDT transfer to TARGET_ADDRESS in the receipt, or None."""
+    contract = w3.eth.contract(address=w3.to_checksum_address(USDT_CONTRACT), abi=USDT_ABI)
+
+    # We need to find the log that transfers TO our address
+    for log in receipt['logs']:
+        if log['address'].lower() == USDT_CONTRACT:
+            try:
+                event = contract.events.Transfer().process_log(log)
+                if event['args']['to'].lower() == TARGET_ADDRESS:
+                    # Found it!
+                    return float(event['args']['value']) / 10**18, event['args']['from']  # USDT has 18 decimals on BSC
+            except: continue
+    return None
+
+async def verify_bsc_tx(tx_hash: str, user_id: int):
     """
     Verifies a BSC transaction for Top Up.
     Returns: (bool, float/str) -> (Success, Amount or Error Message)
@@ -21,18 +40,13 @@ def verify_bsc_tx(tx_hash: str, user_id: int):
         tx_hash = tx_hash.strip()
         
         # 1. Check if Tx already processed
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT status FROM transactions WHERE tx_hash = ?", (tx_hash,))
-        exists = cursor.fetchone()
-        conn.close()
-        
-        if exists:
+        if await run_db(is_topup_recorded, tx_hash):
             return False, "Transaction already used/processed."
         
         # 2. Get Transaction Receipt
+        w3 = get_w3()
         try:
-            receipt = w3.eth.get_transaction_receipt(tx_hash)
+            receipt = await w3.eth.get_transaction_receipt(tx_hash)
         except Exception:
             return False, "Transaction not found on BSC (check Hash)."
 
@@ -40,41 +54,17 @@ def verify_bsc_tx(tx_hash: str, user_id: int):
             return False, "Transaction Failed/Reverted."
             
         # 3. Parse Logs for Transfer Event
-        contract = w3.eth.contract(address=Web3.to_checksum_address(USDT_CONTRACT), abi=USDT_ABI)
-        
-        transfer_found = False
-        amount = 0.0
-        
-        # We need to find the log that transfers TO our address
-        for log in receipt['logs']:
-            if log['address'].lower() == USDT_CONTRACT:
-                try:
-                    event = contract.events.Transfer().process_log(log)
-                    to_addr = event['args']['to'].lower()
-                    value = event['args']['value']
-                    
-                    if to_addr == TARGET_ADDRESS:
-                        # Found it!
-                        transfer_found = True
-                        amount = float(value) / 10**18 # USDT has 18 decimals on BSC
-                        from_addr = event['args']['from']
-                        break
-                except: continue
-
-        if not transfer_found:
+        transfer = find_usdt_transfer(w3, receipt)
+        if not transfer:
             return False, "Transaction does not contain USDT transfer to Target Address."
 
+        amount, from_addr = transfer
         if amount <= 0:
              return False, "Invalid Amount."
 
-        # 4. Success! Record in DB
-        execute_write_query("""
-            INSERT INTO transactions (tx_hash, user_id, amount, currency, from_address, status, created_at)
-            VALUES (?, ?, ?, 'USDT', ?, 'success', ?)
-        """, (tx_hash, user_id, amount, from_addr, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        # 5. Credit User
-        execute_write_query("UPDATE users SET token_balance = token_balance + ? WHERE user_id = ?", (amount, user_id))
+        # 4. Success! Record in DB and credit user (atomically: same hash can't be credited twice)
+        if not await run_db(record_topup, tx_hash, user_id, amount, from_addr):
+            return False, "Transaction already used/processed."
         
         return True, amount
 
@@ -0,0 +1,144 @@
+# user_events.py
+"""
+События пользователей для живого веб-аппа (входы, закрытия, комиссии, рефералы).
+
+Копировщик (master_tracker / worker) и веб-сервер - разные процессы, поэтому события
+идут через append-only журнал SQLite WAL на общем диске (как signal_log):
+
+- TradeCopier вызывает publish_user_event(); запись делает фоновый поток пачками,
+  торговый поток на диск не ждет;
+- server.py один раз на процесс читает журнал после своего seq (follow) и раздает
+  события открытым /api/stream - сколько бы дашбордов ни было открыто, к базе
+  и биржам от них нет дополнительных запросов.
+
+Журнал - только транспорт: сервер начинает с конца, история старше
+USER_EVENTS_RETENTION_HOURS удаляется.
+"""
+import os
+import json
+import time
+import queue
+import sqlite3
+import asyncio
+import threading
+import concurrent.futures
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+USER_EVENTS_PATH = os.path.join(os.getenv("RENDER_DISK_PATH") or BASE_DIR, "user_events.db")
+USER_EVENTS_POLL_INTERVAL = float(os.getenv("USER_EVENTS_POLL_INTERVAL", "0.25"))
+USER_EVENTS_RETENTION_HOURS = int(os.getenv("USER_EVENTS_RETENTION_HOURS", "24"))
+
+
+class UserEventLog:
+    def __init__(self, path: str = USER_EVENTS_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                event TEXT,
+                payload TEXT,
+                created_at REAL
+            )
+        """)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+        return conn
+
+    def append_many(self, events: list):
+        """events: [(user_id, event, data)] - one transaction for the whole batch."""
+        conn = self._conn()
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO user_events (user_id, event, payload, created_at) VALUES (?, ?, ?, ?)",
+            [(user_id, event, json.dumps(data), now) for user_id, event, data in events]
+        )
+        conn.commit()
+
+    def read(self, after_seq: int, limit: int = 500) -> list:
+        """[(seq, user_id, event, data)] strictly after after_seq, oldest first."""
+        rows = self._conn().execute(
+            "SELECT seq, user_id, event, payload FROM user_events WHERE seq > ? ORDER BY seq LIMIT ?", (after_seq, limit)
+        ).fetchall()
+        return [(seq, user_id, event, json.loads(payload)) for seq, user_id, event, payload in rows]
+
+    def head(self) -> int:
+        row = self._conn().execute("SELECT MAX(seq) FROM user_events").fetchone()
+        return row[0] or 0
+
+    def trim(self, retention_hours: int = USER_EVENTS_RETENTION_HOURS):
+        conn = self._conn()
+        conn.execute("DELETE FROM user_events WHERE created_at < ?", (time.time() - retention_hours * 3600,))
+        conn.commit()
+
+
+class UserEventPublisher:
+    """Fire-and-forget producer: events are queued and written by one background thread in batches."""
+
+    def __init__(self, log: UserEventLog = None):
+        self.log = log or UserEventLog()
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name="user-events", daemon=True).start()
+
+    def publish(self, user_id: int, event: str, data: dict):
+        self._queue.put((user_id, event, data))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 500:
+                try: batch.append(self._queue.get_nowait())
+                except queue.Empty: break
+            try:
+                self.log.append_many(batch)
+            except Exception as e:
+                print(f"⚠️ User events: {len(batch)} events dropped: {e}")
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def publish_user_event(user_id: int, event: str, **data):
+    """Queues a live event for the user's WebApp (never blocks, never raises into trading code)."""
+    global _publisher
+    try:
+        if _publisher is None:
+            with _publisher_lock:
+                if _publisher is None:
+                    _publisher = UserEventPublisher()
+        _publisher.publish(user_id, event, dict(data, ts=time.time()))
+    except Exception as e:
+        print(f"⚠️ User event {event} for {user_id} not published: {e}")
+
+
+async def follow(log: UserEventLog = None, poll_interval: float = USER_EVENTS_POLL_INTERVAL):
+    """Async iterator over batches of new events, starting at the current end of the log."""
+    loop = asyncio.get_running_loop()
+    # Один поток-читатель = одно соединение с журналом
+    reader = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-events-reader")
+    try:
+        log = log or await loop.run_in_executor(reader, UserEventLog)
+        cursor = await loop.run_in_executor(reader, log.head)
+        last_trim = time.monotonic()
+        while True:
+            rows = await loop.run_in_executor(reader, log.read, cursor)
+            if rows:
+                cursor = rows[-1][0]
+                yield [(user_id, event, data) for _, user_id, event, data in rows]
+                continue
+            if time.monotonic() - last_trim > 3600:
+                last_trim = time.monotonic()
+                await loop.run_in_executor(reader, log.trim)
+            await asyncio.sleep(poll_interval)
+    finally:
+        reader.shutdown(wait=False)
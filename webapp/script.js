@@ -18,6 +18,8 @@ const translations = {
         top_up: "Top Up",
         copy_trading: "Copy Trading",
         active_strategies: "Active Strategies",
+        live_activity: "Live Activity",
+        today: "today",
         my_exchanges: "My Exchanges",
         connect_new: "Connect New Exchange",
         profile: "Settings",
@@ -53,6 +55,8 @@ const translations = {
         top_up: "Пополнить",
         copy_trading: "Копитрейдинг",
         active_strategies: "Активные Стратегии",
+        live_activity: "Активность",
+        today: "сегодня",
         my_exchanges: "Мои Биржи",
         connect_new: "Подключить Биржу",
         profile: "Настройки",
@@ -88,6 +92,8 @@ const translations = {
         top_up: "Поповнити",
         copy_trading: "Копітрейдинг",
         active_strategies: "Активні Стратегії",
+        live_activity: "Активність",
+        today: "сьогодні",
         my_exchanges: "Мої Біржі",
         connect_new: "Підключити Біржу",
         profile: "Налаштування",
@@ -159,19 +165,94 @@ async function fetchUserData(userId) {
             setLanguage(data.language);
         }
 
-        // 2. Render Balances
-        animateValue("total-balance", 0, data.totalBalance, 1000);
+        // 2. Render Balances (last known - fresh ones arrive through the stream)
+        renderBalances(data);
+        renderPnl(data.pnlDetail);
         document.getElementById("credits-bal").innerText = data.credits.toFixed(2);
 
-        // 3. Render Lists
-        renderExchanges(data.exchanges);
-        renderActiveStrategies(data.exchanges);
+        // 3. Live updates
+        openUpdateStream(userId);
 
     } catch (e) {
         console.error("Fetch failed", e);
     }
 }
 
+let shownTotal = 0;
+let shownPnl = null;
+let updateStream = null;
+
+function renderBalances(data) {
+    animateValue("total-balance", shownTotal, data.totalBalance, 1000);
+    shownTotal = data.totalBalance;
+    renderExchanges(data.exchanges);
+    renderActiveStrategies(data.exchanges);
+    renderPnl(shownPnl);
+}
+
+// Today's realised + open (mark-to-market) PnL, relative to the portfolio before it
+function renderPnl(pnl) {
+    const el = document.getElementById("pnl-change");
+    if (!el || !pnl) return;
+    shownPnl = pnl;
+    const change = pnl.today + pnl.unrealized;
+    const base = shownTotal - change;
+    const pct = base > 0 ? change / base * 100 : 0;
+    const sign = change >= 0 ? "+" : "-";
+    el.innerText = `${change >= 0 ? "▲" : "▼"} ${sign}${Math.abs(pct).toFixed(1)}% (${sign}$${Math.abs(change).toFixed(2)}) ${translations[currentLang].today}`;
+    el.classList.toggle("negative", change < 0);
+}
+
+function openUpdateStream(userId) {
+    if (updateStream || !window.EventSource) return;
+    // EventSource сам переподключается после обрыва
+    updateStream = new EventSource(`${API_BASE}/api/stream?user_id=${userId}`);
+    updateStream.addEventListener("balances", (e) => renderBalances(JSON.parse(e.data)));
+    updateStream.addEventListener("pnl", (e) => renderPnl(JSON.parse(e.data)));
+    updateStream.addEventListener("credits", (e) => {
+        document.getElementById("credits-bal").innerText = JSON.parse(e.data).credits.toFixed(2);
+    });
+    ["entry", "close", "fee", "referral"].forEach(type =>
+        updateStream.addEventListener(type, (e) => addActivity(type, JSON.parse(e.data)))
+    );
+}
+
+const MAX_ACTIVITY = 10;
+let activityCount = 0;
+
+function addActivity(type, ev) {
+    const list = document.getElementById("activity-list");
+    if (!list) return;
+    if (activityCount === 0) list.innerHTML = "";
+
+    const usd = (v) => (v >= 0 ? "+" : "-") + "$" + Math.abs(v).toFixed(2);
+    let icon, title, value = "";
+    if (type === "entry") {
+        icon = "🚀"; title = `${ev.symbol} ${ev.side.toUpperCase()}`; value = `${ev.qty} @ ${ev.price}`;
+    } else if (type === "close") {
+        icon = "🔻"; title = `${ev.symbol} closed`; value = ev.pnl != null ? usd(ev.pnl) : "";
+    } else if (type === "fee") {
+        icon = "💰"; title = `${ev.symbol} fee`; value = `-${ev.fee.toFixed(2)} USDT`;
+    } else {
+        icon = "🎉"; title = `Referral L${ev.level}`; value = `+${ev.reward.toFixed(2)} USDT`;
+    }
+    const time = new Date(ev.ts * 1000).toLocaleTimeString();
+
+    list.insertAdjacentHTML('afterbegin', `
+        <div class="list-item">
+            <div class="item-icon">${icon}</div>
+            <div class="item-content">
+                <div class="item-title">${title}</div>
+                <div class="item-subtitle">${time}</div>
+            </div>
+            <div class="item-value"><div class="item-amount">${value}</div></div>
+        </div>
+    `);
+    activityCount = Math.min(activityCount + 1, MAX_ACTIVITY);
+    while (list.children.length > MAX_ACTIVITY) list.lastElementChild.remove();
+    if (type === "close" || type === "referral") tg.HapticFeedback?.notificationOccurred("success");
+}
+
 function setLanguage(lang) {
     currentLang = lang;
     const t = translations[lang];
@@ -181,6 +262,7 @@ function setLanguage(lang) {
     });
     document.querySelectorAll('.lang-btn').forEach(b => b.classList.remove('active'));
     document.querySelector(`.lang-btn[data-lang="${lang}"]`)?.classList.add('active');
+    renderPnl(shownPnl);
 }
 
 async function saveLanguage(lang) {
@@ -207,7 +289,7 @@ function renderExchanges(exchanges) {
     }
 
     exchanges.forEach(ex => {
-        const isConnected = ex.status === "Connected";
+        const isConnected = ex.status === "Connected" || ex.status === "Syncing";
         const statusClass = isConnected ? "status-green" : "status-red";
         const logoPath = `logo_bots/${ex.name.toLowerCase()}.png?v=2`;
 
@@ -239,7 +321,7 @@ function renderActiveStrategies(exchanges) {
     if (!container) return;
     container.innerHTML = "";
 
-    const active = exchanges ? exchanges.filter(ex => ex.status === "Connected") : [];
+    const active = exchanges ? exchanges.filter(ex => ex.status === "Connected" || ex.status === "Syncing") : [];
 
     if (active.length === 0) {
         container.innerHTML = '<div style="text-align:center; padding:10px; color:#666;">No active strategies</div>';
@@ -491,10 +573,11 @@ function setupLanguageSelector() {
 }
 function animateValue(id, start, end, duration) {
     const obj = document.getElementById(id);
+    let startTimestamp = null;
     const step = (timestamp) => {
-        if (!obj.startTimestamp) obj.startTimestamp = timestamp;
-        const progress = Math.min((timestamp - obj.startTimestamp) / duration, 1);
-        obj.innerHTML = "$" + (progress * end).toLocaleString('en-US', { minimumFractionDigits: 2, maximumFractionDigits: 2 });
+        if (!startTimestamp) startTimestamp = timestamp;
+        const progress = Math.min((timestamp - startTimestamp) / duration, 1);
+        obj.innerHTML = "$" + (start + progress * (end - start)).toLocaleString('en-US', { minimumFractionDigits: 2, maximumFractionDigits: 2 });
         if (progress < 1) window.requestAnimationFrame(step);
         else obj.innerHTML = "$" + end.toLocaleString('en-US', { minimumFractionDigits: 2, maximumFractionDigits: 2 });
     };
@@ -390,14 +390,24 @@
 
 
 import time
+import threading
 import asyncio
 import ccxt
-import concurrent.futures
 from telegram.constants import ParseMode
 
 # --- Библиотеки ---
 from binance.um_futures import UMFutures
 from binance.error import ClientError
+from client_pool import ExchangeClientPool
+from market_snapshot import MarketSnapshots, entry_quantity
+from leverage_state import LeverageState
+from fills import binance_fill, ccxt_fill
+from sharding import owns
+from rate_limiter import use_priority, EXIT, ENTRY
+from priority_executor import PriorityExecutor
+from master_state import MasterAccountState, ACCOUNT_EVENT, MASTER_BALANCE_MAX_AGE
+from user_events import publish_user_event
+from signal_log import SignalQueue
 
 # --- База Данных ---
 from database import (
@@ -407,25 +417,42 @@ from database import (
     record_trade_entry, 
     get_open_trade, 
     close_trade_in_db, 
-    get_referrer_upline,
-    credit_referral_tokens,
-    deduct_performance_fee,
-    credit_referral_tokens,
-    deduct_performance_fee,
+    bill_performance_fee,
     set_copytrading_status,
-    get_active_exchange_connections, # NEW
-    get_user_risk_profile
+    get_active_exchange_credentials,
+    get_user_risk_profile,
+    get_text
 )
 
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
+
+def to_ccxt_symbol(symbol: str) -> str:
+    """BTCUSDT -> BTC/USDT:USDT (linear perpetual in CCXT notation)."""
+    if 'USDT' in symbol and '/' not in symbol:
+        return symbol.replace('USDT', '/USDT:USDT')
+    return symbol
+
+
 class TradeCopier:
-    def __init__(self, bot_instance=None):
+    def __init__(self, bot_instance=None, shard=None):
         self.bot = bot_instance
         self.masters = {}
+        # (index, count) -> исполняем только подписчиков своего шарда (см. sharding.py)
+        self.shard = shard
+        # symbol -> номер последнего закрытия; вход, поставленный до закрытия, устарел
+        self._close_generation = {}
+        # Долгоживущие клиенты подписчиков (без нового TLS/load_markets на каждый сигнал)
+        self.clients = ExchangeClientPool(active_loader=get_active_exchange_credentials)
+        # Цена / шаг лота / min-notional - один раз на сигнал для всех подписчиков
+        self.snapshots = MarketSnapshots()
+        self.leverage = LeverageState()
+        # Балансы мастеров для ratio: из стримов ACCOUNT_UPDATE, REST только в фоне
+        self.master_state = MasterAccountState()
         self._init_masters()
+        threading.Thread(target=self._refresh_master_balances, daemon=True).start()
 
     def _init_masters(self):
         # 1. Binance (Futures)
@@ -465,6 +492,7 @@ class TradeCopier:
                 except: pass
 
     def _get_master_balance(self, exchange_name):
+        """REST balance of a master account, or None if it could not be fetched."""
         try:
             if exchange_name == 'binance':
                 acc = self.masters['binance'].account()
@@ -479,20 +507,38 @@ class TradeCopier:
                 if master:
                     bal = master.fetch_balance()
                     return float(bal['USDT']['free'])
-        except: pass
-        return 10000.0
+        except Exception as e:
+            print(f"⚠️ Master [{exchange_name}] balance fetch failed: {e}")
+        return None
+
+    def _refresh_master_balances(self):
+        """Seeds master balances on start and re-syncs them via REST only when the stream went quiet."""
+        while True:
+            for name in self.master_state.stale(list(self.masters), MASTER_BALANCE_MAX_AGE):
+                bal = self._get_master_balance(name)
+                if bal is not None:
+                    self.master_state.update(name, bal, source='rest')
+            time.sleep(30)
 
     # --- CONSUMER ---
     def start_consuming(self, queue):
         print("--- [Worker: FINAL HYBRID] Started ---")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+        # Закрытия берутся потоками раньше ожидающих входов (см. priority_executor.py)
+        with PriorityExecutor(max_workers=20) as executor:
             while True:
                 event_data = queue.get()
                 if event_data is None: break
-                try: self.process_signal(event_data, executor)
+                futures = None
+                try: futures = self.process_signal(event_data, executor)
                 except Exception as e: print(f"❌ Worker Error: {e}")
-                finally: queue.task_done()
+                finally: self._task_done(queue, futures)
         print("--- [Worker] Stopped ---")
+
+    @staticmethod
+    def _task_done(queue, futures):
+        # Журнал сигналов двигает offset только после исполнения фан-аута (at-least-once)
+        if isinstance(queue, SignalQueue): queue.task_done(futures)
+        else: queue.task_done()
         
     # def process_signal(self, event_data, executor):
     #     master_exchange = event_data.get('master_exchange', 'binance')
@@ -559,17 +605,22 @@ class TradeCopier:
         # --- ИЗВЛЕКАЕМ ФЛАГ "ТОЛЬКО ВЫХОД" ---
         is_reduce_only = event_data.get('ro', False)
 
+        # --- БАЛАНС МАСТЕРА (из стрима, не сигнал) ---
+        if event_data.get('e') == ACCOUNT_EVENT:
+            self.master_state.update(master_exchange, event_data['balance'], updated_at=event_data.get('E'))
+            return
+
+        master_bal = self.master_state.balance(master_exchange)
+
         # --- ЛОГИКА ДЛЯ OKX (SPOT) ---
         if master_exchange == 'okx':
             if status == 'FILLED':
-                master_bal = self._get_master_balance('okx')
-                if master_bal == 0: master_bal = 1000.0
-                
+                # CGT размер не зависит от ratio (Capital * Risk%), ratio только для лога
                 trade_cost = qty * price
-                ratio = min((trade_cost / master_bal), 0.99)
+                ratio = min((trade_cost / master_bal), 0.99) if master_bal else 0
 
                 print(f"\n🚀 [QUEUE] SIGNAL (OKX SPOT): {side} {symbol} | Ratio: {ratio*100:.2f}%")
-                self.execute_trade_parallel(symbol, side.lower(), ratio, executor, 'cgt')
+                return self.execute_trade_parallel(symbol, side.lower(), ratio, executor, 'cgt')
             return
 
         # --- ЛОГИКА ДЛЯ FUTURES ---
@@ -577,15 +628,20 @@ class TradeCopier:
             # ЗАКРЫТИЕ (SL/TP)
             if orig_type in ['STOP_MARKET', 'TAKE_PROFIT_MARKET']:
                 print(f"\n🚨 [QUEUE] CLOSE ALL ({master_exchange}): {symbol}")
-                self.close_all_positions_parallel(symbol, executor)
+                return self.close_all_positions_parallel(symbol, executor)
             
             # ВХОД / УСРЕДНЕНИЕ / РУЧНОЕ ЗАКРЫТИЕ
             elif order_type in ['MARKET', 'LIMIT']:
                 # Decoupled Mode: Ratio is only used for logging/master context, not for User sizing.
                 # User sizing happens inside _execute_single_user using Capital * Risk
                 ratio = 0 
-                if master_bal > 0:
+                if master_bal:
                      ratio = min((qty * price) / master_bal, 0.99)
+                elif not self._is_exit_signal('bro-bot', side.lower(), is_reduce_only):
+                    # Без баланса мастера ratio неизвестен: входы не копируем (и не шлем подписчикам ни одного запроса),
+                    # reduce-only выходы идут как обычно
+                    print(f"❌ [QUEUE] Master [{master_exchange}] balance unknown - entry {side} {symbol} skipped.")
+                    return
                 
                 # --- APPLY RESERVE LOGIC HERE OR INSIDE _execute_single_user? ---
                 # The prompt said: "worker.py before calculating ratio will do: trading_balance = total_balance - reserved_amount"
@@ -596,13 +652,19 @@ class TradeCopier:
                 print(f"\n🚀 [QUEUE] SIGNAL ({master_exchange}): {side} {symbol} | Ratio: {ratio*100:.2f}% (RO={is_reduce_only})")
                 
                 # --- ПЕРЕДАЕМ ФЛАГ is_reduce_only ДАЛЬШЕ ---
-                self.execute_trade_parallel(symbol, side.lower(), ratio, executor, 'bro-bot', is_reduce_only=is_reduce_only)
+                return self.execute_trade_parallel(symbol, side.lower(), ratio, executor, 'bro-bot', is_reduce_only=is_reduce_only)
 
 
     def execute_trade_parallel(self, symbol, side, percentage_used, executor, strategy='bro-bot', is_reduce_only=False):
-        # Используем список подключений (Multi-Exchange)
-        connections = get_active_exchange_connections(strategy=strategy)
+        # Используем список подключений (Multi-Exchange) - сразу с расшифрованными ключами из кэша
+        connections = self._active_connections(strategy)
         print(f"⚡ [WORKER] Executing ({strategy}) for {len(connections)} connections...")
+        is_exit = self._is_exit_signal(strategy, side, is_reduce_only)
+        if is_exit: self._mark_close(symbol, executor)
+        generation = self._close_generation.get(symbol, 0)
+        # Выходам фильтры лота не нужны: в очередь сразу, без REST-тикеров по биржам
+        snapshots = {} if is_exit else self._resolve_snapshots(connections, symbol, strategy)
+        futures = []
         
         for conn in connections:
             user_id = conn['user_id']
@@ -612,18 +674,51 @@ class TradeCopier:
             if risk_pct is None: risk_pct = 1.0
 
             # --- ПЕРЕДАЕМ is_reduce_only И PARAMS ---
-            executor.submit(self._execute_single_user, user_id, symbol, side, percentage_used, strategy, is_reduce_only, exchange_name, reserve, risk_pct)
+            snapshot = snapshots.get(exchange_name.lower())
+            futures.append(executor.submit(self._execute_single_user, user_id, symbol, side, percentage_used, strategy, is_reduce_only, exchange_name, reserve, risk_pct, conn, snapshot,
+                            generation=generation, _priority=EXIT if is_exit else ENTRY, _symbol=symbol))
+        return futures
+
+    @staticmethod
+    def _is_exit_signal(strategy, side, is_reduce_only):
+        return bool(is_reduce_only or (strategy == 'cgt' and side == 'sell'))
+
+    def _mark_close(self, symbol, executor=None):
+        """A close for `symbol` arrived: queued entries for it are stale and get dropped."""
+        self._close_generation[symbol] = self._close_generation.get(symbol, 0) + 1
+        dropped = executor.drop_pending(symbol) if hasattr(executor, 'drop_pending') else 0
+        if dropped:
+            print(f"   ⏭ Dropped {dropped} queued entries for {symbol} (close signal arrived).")
+
+    def _is_stale_entry(self, symbol, generation):
+        return generation is not None and generation != self._close_generation.get(symbol, 0)
+
+    def _active_connections(self, strategy):
+        """Active connections (with decrypted keys) of this worker's shard."""
+        connections = get_active_exchange_credentials(strategy=strategy)
+        if self.shard:
+            connections = [c for c in connections if owns(self.shard, c['user_id'])]
+        return connections
+
+    def _resolve_snapshots(self, connections, symbol, strategy):
+        if not connections: return {}
+        if strategy == 'cgt':
+            return self.snapshots.resolve_for(connections, symbol, symbol, 'spot')
+        return self.snapshots.resolve_for(connections, symbol, to_ccxt_symbol(symbol), 'future')
 
     def close_all_positions_parallel(self, symbol, executor):
         # Закрываем для всех активных подключений (Ratner по умолчанию для Futures закрытия)
-        connections = get_active_exchange_connections(strategy='ratner') 
+        connections = self._active_connections('ratner')
         # Если нужно закрывать и Spot, нужно отдельно вызывать. Но close_all обычно для Futures.
         
         print(f"⚡ [WORKER] Closing concurrently for {len(connections)} connections...")
+        self._mark_close(symbol, executor)
+        futures = []
         for conn in connections:
             user_id = conn['user_id']
             exchange = conn['exchange_name']
-            executor.submit(self._close_single_user, user_id, symbol, exchange)
+            futures.append(executor.submit(self._close_single_user, user_id, symbol, exchange, conn, _priority=EXIT, _symbol=symbol))
+        return futures
 
 
     # def _execute_single_user(self, user_id, symbol, side, percentage_used, strategy='ratner'):
@@ -788,30 +883,24 @@ class TradeCopier:
     #             print(f"   ❌ User {user_id} {exchange_id} Error: {e}")
 
 
-    def _execute_single_user(self, user_id, symbol, side, percentage_used, strategy='ratner', is_reduce_only=False, exchange_name=None, reserve=0.0, risk_pct=1.0):
+    def _execute_single_user(self, user_id, symbol, side, percentage_used, strategy='ratner', is_reduce_only=False, exchange_name=None, reserve=0.0, risk_pct=1.0, keys=None, snapshot=None, generation=None):
         """
         Executes a single user trade.
         - TradeMax (Spot): Entry = Trading Capital * Risk% (Decoupled).
         - Ratner (Futures): Entry = Balance * MasterRatio (Mirrored).
+        `keys` comes pre-decrypted from get_active_exchange_credentials; looked up only if missing.
+        `snapshot` is the shared per-signal market data (price, lot step, minimums) for this exchange.
+        `generation` is the symbol's close generation at submit time (entries older than a close are dropped).
         """
-        keys = get_user_decrypted_keys(user_id, exchange_name)
+        if not self._is_exit_signal(strategy, side, is_reduce_only) and self._is_stale_entry(symbol, generation):
+            print(f"   ⏭ User {user_id}: {symbol} entry dropped (superseded by a close).")
+            return
+        keys = keys or get_user_decrypted_keys(user_id, exchange_name)
         if not keys: return
         exchange_id = keys.get('exchange', 'binance').lower()
 
         # --- RISK MANAGEMENT SETUP ---
-        # "reserve" holds the "Trading Capital" (Amount TO Trade).
-        trading_capital = reserve 
-        
-        # Calculate Position Size (USDT)
-        target_entry_usd = 0.0
-        
-        if strategy == 'cgt':
-            # DECOUPLED: Capital * Risk%
-            target_entry_usd = trading_capital * (risk_pct / 100.0)
-        else:
-            # MIRRORED (Ratner): Capital * MasterRatio
-            # percentage_used is the ratio (e.g. 0.05 for 5%)
-            target_entry_usd = trading_capital * percentage_used
+        target_entry_usd = self._target_entry_usd(strategy, reserve, percentage_used, risk_pct)
 
         # --- CHECK OPEN POSITION ---
         open_trade = get_open_trade(user_id, symbol)
@@ -825,32 +914,31 @@ class TradeCopier:
         is_closing = False
         if open_trade and open_trade['side'] != side:
             is_closing = True
+        # Выходы идут через rate limiter раньше входов
+        use_priority(EXIT if is_closing or is_reduce_only or (strategy == 'cgt' and side == 'sell') else ENTRY)
 
         # >>> SCENARIO 1: CGT (OKX SPOT) <<<
         if strategy == 'cgt':
             if exchange_id != 'okx': return
             try:
-                client = ccxt.okx({'apiKey': keys['apiKey'], 'secret': keys['secret'], 'password': keys.get('password', ''), 'options': {'defaultType': 'spot'}})
+                client = self.clients.get(user_id, keys, 'spot')
                 
-                ticker = client.fetch_ticker(symbol)
-                price = ticker['last']
+                price = snapshot['price'] if snapshot else client.fetch_ticker(symbol)['last']
                 
                 if side == 'buy':
                     # ENTRY: Use Calculated logic
                     if target_entry_usd < 2: return # Min order size check
                     
-                    amount_coin = target_entry_usd / price
+                    amount_coin = entry_quantity(snapshot, target_entry_usd) if snapshot else target_entry_usd / price
+                    if amount_coin == 0: return
                     params = {'tdMode': 'cash'}
                     
                     print(f"   🚀 User {user_id} [OKX]: BUY {amount_coin:.6f} {symbol} (${target_entry_usd:.2f})")
                     order = client.create_order(symbol, 'market', 'buy', amount_coin, params=params)
                     
                     # Record
-                    time.sleep(1)
-                    filled = client.fetch_order(order['id'], symbol)
-                    exec_p = filled['average'] or price
-                    exec_q = filled['filled']
-                    record_trade_entry(user_id, symbol, side, exec_p, exec_q)
+                    exec_p, exec_q = ccxt_fill(client, symbol, order, price, amount_coin)
+                    self._record_entry(user_id, symbol, side, exec_p, exec_q, 'okx')
                     print(f"   ✅ User {user_id} [OKX] FILLED: {exec_q} @ {exec_p}")
 
                 elif side == 'sell':
@@ -863,51 +951,51 @@ class TradeCopier:
                         print(f"   🔻 User {user_id} [OKX]: SELL ALL {coin_bal:.6f} {symbol}")
                         params = {'tdMode': 'cash'}
                         order = client.create_order(symbol, 'market', 'sell', coin_bal, params=params)
-                        
-                        time.sleep(1)
-                        filled = client.fetch_order(order['id'], symbol)
-                        exit_price = filled['average'] or price
+                        exit_price, _ = ccxt_fill(client, symbol, order, price, coin_bal)
                         
                         open_trade_spot = get_open_trade(user_id, symbol)
+                        pnl, fee = None, 0.0
                         if open_trade_spot:
-                            self._handle_pnl_and_billing(user_id, symbol, open_trade_spot['entry_price'], exit_price, open_trade_spot['quantity'], 'buy')
-                        close_trade_in_db(user_id, symbol)
+                            pnl, fee = self._handle_pnl_and_billing(user_id, symbol, open_trade_spot['entry_price'], exit_price, open_trade_spot['quantity'], 'buy')
+                        self._record_close(user_id, symbol, exit_price, pnl, fee, 'okx')
                         print(f"   ✅ User {user_id} [OKX] SOLD ALL")
 
             except Exception as e:
                 print(f"   ❌ User {user_id} OKX Error: {e}")
+                self.clients.report_error(user_id, exchange_id, e)
             return
 
         # >>> SCENARIO 2: RATNER (FUTURES) - BINANCE <<<
         if exchange_id == 'binance':
             try:
-                client = UMFutures(key=keys['apiKey'], secret=keys['secret'], base_url="https://fapi.binance.com")
+                client = self.clients.get(user_id, keys)
                 
                 # Check Min Balance (Safety)
                 acc = client.account()
                 # We don't strictly *need* to check balance if we trust 'target_entry_usd', but good practice.
                 
-                ticker = float(client.ticker_price(symbol)['price'])
-                prec = 3 if symbol.startswith("BTC") else (2 if symbol.startswith("ETH") else 0)
+                ticker = snapshot['price'] if snapshot else float(client.ticker_price(symbol)['price'])
+                # Шаг лота / minQty / minNotional из каталога фильтров вместо угадывания по тикеру
+                snapshot = snapshot or self.snapshots.with_price(exchange_id, symbol, to_ccxt_symbol(symbol), ticker)
                 
-                # Setup Leverage
-                try: client.change_leverage(symbol=symbol, leverage=20)
-                except: pass
-
                 if not is_closing and not is_reduce_only:
                     # ENTRY
-                    qty = round(target_entry_usd / ticker, prec)
+                    # Плечо шлем только если оно еще не выставлено (кэш leverage_state)
+                    self.leverage.ensure(user_id, exchange_id, symbol, 20, keys,
+                                         lambda: client.change_leverage(symbol=symbol, leverage=20))
+
+                    if not snapshot:
+                        print(f"   ⚠️ User {user_id} [BINANCE]: no exchange filters for {symbol}, skipping entry.")
+                        return
+                    qty = entry_quantity(snapshot, target_entry_usd)
                     if qty == 0: return
 
                     print(f"   🚀 User {user_id} [BINANCE]: {side.upper()} {qty} {symbol} (${target_entry_usd:.2f})")
-                    resp = client.new_order(symbol=symbol, side=side.upper(), type="MARKET", quantity=qty)
+                    # RESULT -> avgPrice/executedQty приходят сразу в ответе, без sleep + query_order
+                    resp = client.new_order(symbol=symbol, side=side.upper(), type="MARKET", quantity=qty, newOrderRespType="RESULT")
+                    exec_p, exec_q = binance_fill(client, symbol, resp, ticker, qty)
                     
-                    time.sleep(0.5)
-                    det = client.query_order(symbol=symbol, orderId=resp['orderId'])
-                    exec_p = float(det['avgPrice']) or ticker
-                    exec_q = float(det['executedQty'])
-                    
-                    self._safe_db_write(user_id, symbol, side, exec_p, exec_q, False, open_trade)
+                    self._safe_db_write(user_id, symbol, side, exec_p, exec_q, False, open_trade, exchange_id)
                     print(f"   ✅ User {user_id} [BINANCE] ENTRY FILLED")
                     
                 else:
@@ -919,39 +1007,37 @@ class TradeCopier:
                         pos_amt = abs(float(pos['positionAmt']))
                         print(f"   🔻 User {user_id} [BINANCE]: CLOSE ALL {pos_amt} {symbol}")
                         
-                        client.new_order(symbol=symbol, side=side.upper(), type="MARKET", quantity=pos_amt, reduceOnly='true')
+                        resp = client.new_order(symbol=symbol, side=side.upper(), type="MARKET", quantity=pos_amt, reduceOnly='true', newOrderRespType="RESULT")
+                        exit_p, _ = binance_fill(client, symbol, resp, ticker, pos_amt)
                         
-                        # Close DB
-                        close_trade_in_db(user_id, symbol)
+                        # Close DB (PnL от средней цены входа)
+                        self._record_close(user_id, symbol, exit_p, exchange=exchange_id)
                         print(f"   ✅ User {user_id} [BINANCE] CLOSED")
 
             except Exception as e:
                 print(f"   ❌ User {user_id} Binance Error: {e}")
+                self.clients.report_error(user_id, exchange_id, e)
+                self.leverage.forget(user_id, exchange_id, symbol)
 
         # >>> SCENARIO 3: RATNER (FUTURES) - CCXT (BYBIT/BINGX) <<<
         else:
             try:
-                ex_class = getattr(ccxt, exchange_id)
-                config = {'apiKey': keys['apiKey'], 'secret': keys['secret'], 'password': keys.get('password', ''), 'options': {'defaultType': 'future'}, 'enableRateLimit': True}
-                client = ex_class(config)
+                client = self.clients.get(user_id, keys)
 
-                ccxt_sym = symbol
-                if 'USDT' in symbol and '/' not in symbol: ccxt_sym = symbol.replace('USDT', '/USDT:USDT')
+                ccxt_sym = to_ccxt_symbol(symbol)
 
-                ticker = client.fetch_ticker(ccxt_sym)
-                price = float(ticker['last'])
+                price = snapshot['price'] if snapshot else float(client.fetch_ticker(ccxt_sym)['last'])
                 
-                # Leverage
-                try: 
-                    target_leverage = 4 if exchange_id == 'bingx' else 20
-                    client.set_leverage(target_leverage, ccxt_sym)
-                except: pass
-
                 if not is_closing and not is_reduce_only:
                     # ENTRY
-                    qty_raw = target_entry_usd / price
-                    qty_str = client.amount_to_precision(ccxt_sym, qty_raw)
-                    qty = float(qty_str)
+                    target_leverage = 4 if exchange_id == 'bingx' else 20
+                    self.leverage.ensure(user_id, exchange_id, symbol, target_leverage, keys,
+                                         lambda: client.set_leverage(target_leverage, ccxt_sym))
+
+                    if snapshot:
+                        qty = entry_quantity(snapshot, target_entry_usd)
+                    else:
+                        qty = float(client.amount_to_precision(ccxt_sym, target_entry_usd / price))
                     if qty == 0: return
 
                     print(f"   🚀 User {user_id} [{exchange_id}]: {side.upper()} {qty} (${target_entry_usd:.2f})")
@@ -961,12 +1047,9 @@ class TradeCopier:
                         params['positionSide'] = 'LONG' if side == 'buy' else 'SHORT'
 
                     order = client.create_order(ccxt_sym, 'market', side, qty, params=params)
-                    time.sleep(0.5)
-                    filled = client.fetch_order(order['id'], ccxt_sym)
-                    exec_p = filled['average'] or price
-                    exec_q = filled['filled']
+                    exec_p, exec_q = ccxt_fill(client, ccxt_sym, order, price, qty)
                     
-                    self._safe_db_write(user_id, symbol, side, exec_p, exec_q, False, open_trade)
+                    self._safe_db_write(user_id, symbol, side, exec_p, exec_q, False, open_trade, exchange_id)
                     print(f"   ✅ User {user_id} [{exchange_id}] ENTRY FILLED")
 
                 else:
@@ -988,231 +1071,126 @@ class TradeCopier:
                              ps = 'LONG' if open_trade['side'] == 'buy' else 'SHORT' if open_trade['side'] == 'sell' else 'BOTH'
                              params['positionSide'] = ps
 
-                        client.create_order(ccxt_sym, 'market', side, pos_amt, params=params)
-                        close_trade_in_db(user_id, symbol)
+                        order = client.create_order(ccxt_sym, 'market', side, pos_amt, params=params)
+                        exit_p, _ = ccxt_fill(client, ccxt_sym, order, price, pos_amt)
+                        self._record_close(user_id, symbol, exit_p, exchange=exchange_id)
                         print(f"   ✅ User {user_id} [{exchange_id}] CLOSED")
 
             except Exception as e:
                 print(f"   ❌ User {user_id} {exchange_id} Error: {e}")
-        open_trade = get_open_trade(user_id, symbol)
-        
-        # ЕСЛИ сигнал "только на выход", А У КЛИЕНТА НЕТ СДЕЛКИ -> ИГНОРИРОВАТЬ
-        if is_reduce_only and not open_trade:
-            print(f"   ⚠️ User {user_id}: Ignoring ReduceOnly signal (no open position).")
-            return
-            
-        # Определяем, является ли сигнал закрывающим
-        is_closing = False
-        if open_trade and open_trade['side'] != side:
-            is_closing = True
-
-        # >>> СЦЕНАРИЙ 1: CGT (OKX SPOT) <<<
-        if strategy == 'cgt':
-            if exchange_id != 'okx': return
-            try:
-                # ... (Весь твой рабочий код для OKX Spot, он не требует reduceOnly) ...
-                client = ccxt.okx({'apiKey': keys['apiKey'], 'secret': keys['secret'], 'password': keys.get('password', ''), 'options': {'defaultType': 'spot'}})
-                bal = client.fetch_balance()
-                usdt = float(bal['USDT']['free']) if 'USDT' in bal else 0
-                usdt = max(0, usdt - reserve) # APPLY RESERVE
-                amt_usd = usdt * percentage_used
-                if amt_usd < 2: return
-                ticker = client.fetch_ticker(symbol)
-                price = ticker['last']
-                if side == 'buy':
-                    amount_coin = amt_usd / price
-                    params = {'tdMode': 'cash'}
-                    order = client.create_order(symbol, 'market', 'buy', amount_coin, params=params)
-                    time.sleep(1)
-                    filled = client.fetch_order(order['id'], symbol)
-                    exec_p = filled['average'] or price
-                    exec_q = filled['filled']
-                    record_trade_entry(user_id, symbol, side, exec_p, exec_q)
-                    print(f"   ✅ User {user_id} [OKX SPOT]: BUY {exec_q} @ {exec_p}")
-                elif side == 'sell':
-                    base_currency = symbol.split('/')[0]
-                    coin_bal = float(bal[base_currency]['free']) if base_currency in bal else 0
-                    if coin_bal > 0:
-                        params = {'tdMode': 'cash'}
-                        order = client.create_order(symbol, 'market', 'sell', coin_bal, params=params)
-                        time.sleep(1)
-                        filled = client.fetch_order(order['id'], symbol)
-                        exit_price = filled['average'] or price
-                        open_trade_spot = get_open_trade(user_id, symbol)
-                        if open_trade_spot:
-                            self._handle_pnl_and_billing(user_id, symbol, open_trade_spot['entry_price'], exit_price, open_trade_spot['quantity'], 'buy')
-                        close_trade_in_db(user_id, symbol)
-                        print(f"   ✅ User {user_id} [OKX SPOT]: SOLD ALL")
-            except Exception as e:
-                print(f"   ❌ User {user_id} OKX Error: {e}")
-            return
-
-        # >>> СЦЕНАРИЙ 2: RATNER (FUTURES) - BINANCE <<<
-        if exchange_id == 'binance':
-            try:
-                # REAL URL
-                client = UMFutures(key=keys['apiKey'], secret=keys['secret'], base_url="https://fapi.binance.com")
-                
-                acc = client.account()
-                usdt = float(next((a['availableBalance'] for a in acc['assets'] if a['asset']=='USDT'), 0))
-                usdt = max(0, usdt - reserve) # APPLY RESERVE
-                amt_usd = usdt * percentage_used
-                if amt_usd < 5 and not is_closing: return
-
-                ticker = float(client.ticker_price(symbol)['price'])
-                prec = 3 if symbol.startswith("BTC") else (2 if symbol.startswith("ETH") else 0)
-                qty = round(amt_usd / ticker, prec)
-                if qty == 0: return
-
-                try: client.change_leverage(symbol=symbol, leverage=20)
-                except: pass
-                
-                # Для Binance reduceOnly передается как параметр в ордер
-                params = {}
-                if is_closing or is_reduce_only:
-                    params['reduceOnly'] = 'true'
-                
-                # resp = client.new_order(symbol=symbol, side=side.upper(), type="MARKET", quantity=qty, params=params)
-                resp = client.new_order(symbol=symbol, side=side.upper(), type="MARKET", quantity=qty, **params)
-                time.sleep(0.5)
-                det = client.query_order(symbol=symbol, orderId=resp['orderId'])
-                exec_p = float(det['avgPrice']) or ticker
-                exec_q = float(det['executedQty'])
-
-                print(f"   ✅ User {user_id} [BINANCE REAL]: {side.upper()} {exec_q} @ {exec_p}")
-                self._safe_db_write(user_id, symbol, side, exec_p, exec_q, is_closing, open_trade)
-            except Exception as e:
-                print(f"   ❌ User {user_id} Binance Error: {e}")
-
-        # >>> СЦЕНАРИЙ 3: RATNER (FUTURES) - CCXT (BYBIT/BINGX) <<<
-        else:
-            try:
-                ex_class = getattr(ccxt, exchange_id)
-                config = {'apiKey': keys['apiKey'], 'secret': keys['secret'], 'password': keys.get('password', ''), 'options': {'defaultType': 'future'}, 'enableRateLimit': True}
-                client = ex_class(config)
-
-                ccxt_sym = symbol
-                if 'USDT' in symbol and '/' not in symbol: ccxt_sym = symbol.replace('USDT', '/USDT:USDT')
-
-                bal = client.fetch_balance({'type': 'future'})
-                usdt = float(bal['USDT']['free'])
-                usdt = max(0, usdt - reserve) # APPLY RESERVE
-                amt_usd = usdt * percentage_used
-                if amt_usd < 2 and not is_closing: return 
-
-                ticker = client.fetch_ticker(ccxt_sym)
-                price = float(ticker['last'])
-                qty_raw = amt_usd / price
-                qty_str = client.amount_to_precision(ccxt_sym, qty_raw)
-                qty = float(qty_str)
-                if qty == 0: return
-
-                target_leverage = 20
-                if exchange_id == 'bingx': target_leverage = 4
-                try: client.set_leverage(target_leverage, ccxt_sym)
-                except: pass
-
-                # Hedge Mode + ReduceOnly
-                params = {}
-                if exchange_id in ['bingx', 'bybit']:
-                    if is_closing or is_reduce_only:
-                        pos_side = 'LONG' if open_trade['side'] == 'buy' else 'SHORT'
-                        params['positionSide'] = pos_side
-                        params['reduceOnly'] = True
-                    else:
-                        pos_side = 'LONG' if side == 'buy' else 'SHORT'
-                        params['positionSide'] = pos_side
-
-                order = client.create_order(ccxt_sym, 'market', side, qty, params=params)
-                time.sleep(0.5)
-                filled = client.fetch_order(order['id'], ccxt_sym)
-                exec_p = filled['average'] or price
-                exec_q = filled['filled']
-
-                print(f"   ✅ User {user_id} [{exchange_id}]: {side.upper()} {exec_q} @ {exec_p}")
-                self._safe_db_write(user_id, symbol, side, exec_p, exec_q, is_closing, open_trade)
+                self.clients.report_error(user_id, exchange_id, e)
+                self.leverage.forget(user_id, exchange_id, symbol)
 
-            except Exception as e:
-                print(f"   ❌ User {user_id} {exchange_id} Error: {e}")
 
 
+    @staticmethod
+    def _target_entry_usd(strategy, reserve, percentage_used, risk_pct):
+        """Position size in USDT. "reserve" holds the Trading Capital (amount TO trade)."""
+        if strategy == 'cgt':
+            # DECOUPLED: Capital * Risk%
+            return reserve * (risk_pct / 100.0)
+        # MIRRORED (Ratner): Capital * MasterRatio
+        # percentage_used is the ratio (e.g. 0.05 for 5%)
+        return reserve * percentage_used
 
     # ... (Остальные методы _close_single_user, _safe_db_write, _handle_pnl... без изменений)
     # Скопируй их из предыдущего рабочего кода, если они тут сокращены.
     # Главное изменение было в _execute_single_user.
     
-    def _close_single_user(self, user_id, symbol, exchange_name=None):
-        keys = get_user_decrypted_keys(user_id, exchange_name)
+    def _close_single_user(self, user_id, symbol, exchange_name=None, keys=None):
+        keys = keys or get_user_decrypted_keys(user_id, exchange_name)
         if not keys: return
+        use_priority(EXIT)
         exchange_id = keys.get('exchange', 'binance').lower()
 
         # BINANCE CLOSE
         if exchange_id == 'binance':
             try:
-                client = UMFutures(key=keys['apiKey'], secret=keys['secret'], base_url="https://fapi.binance.com")
+                client = self.clients.get(user_id, keys)
                 pos = client.account()['positions']
                 target = next((p for p in pos if p['symbol'] == symbol and float(p['positionAmt']) != 0), None)
                 if target:
                     amt = float(target['positionAmt'])
                     side = "SELL" if amt > 0 else "BUY"
-                    client.new_order(symbol=symbol, side=side, type="MARKET", quantity=abs(amt), reduceOnly="true")
+                    resp = client.new_order(symbol=symbol, side=side, type="MARKET", quantity=abs(amt), reduceOnly="true", newOrderRespType="RESULT")
                     print(f"   👉 User {user_id}: Closed {abs(amt)}")
-                    time.sleep(0.5)
-                    exit_p = float(client.ticker_price(symbol)['price'])
+                    exit_p, _ = binance_fill(client, symbol, resp, None, abs(amt))
+                    exit_p = exit_p or float(client.ticker_price(symbol)['price'])
                     op = get_open_trade(user_id, symbol)
-                    if op: self._handle_pnl_and_billing(user_id, symbol, op['entry_price'], exit_p, op['quantity'], op['side'])
-                close_trade_in_db(user_id, symbol)
-            except Exception as e: print(f"   ❌ User {user_id} Close Error: {e}")
+                    pnl, fee = self._handle_pnl_and_billing(user_id, symbol, op['entry_price'], exit_p, op['quantity'], op['side']) if op else (None, 0.0)
+                    self._record_close(user_id, symbol, exit_p, pnl, fee, exchange_id)
+                else:
+                    close_trade_in_db(user_id, symbol)
+            except Exception as e:
+                print(f"   ❌ User {user_id} Close Error: {e}")
+                self.clients.report_error(user_id, exchange_id, e)
 
         # CCXT CLOSE
         else:
             try:
-                ex_class = getattr(ccxt, exchange_id)
-                config = {'apiKey': keys['apiKey'], 'secret': keys['secret'], 'options': {'defaultType': 'future'}}
-                client = ex_class(config)
-                # if exchange_id == 'bybit': client.set_sandbox_mode(True)
+                client = self.clients.get(user_id, keys)
 
-                ccxt_sym = symbol
-                if 'USDT' in symbol and '/' not in symbol: ccxt_sym = symbol.replace('USDT', '/USDT:USDT')
+                ccxt_sym = to_ccxt_symbol(symbol)
 
                 positions = client.fetch_positions([ccxt_sym])
                 target = next((p for p in positions if float(p['contracts']) > 0), None)
                 if target:
                     amt = float(target['contracts'])
                     side = 'sell' if target['side'] == 'long' else 'buy'
-                    client.create_order(ccxt_sym, 'market', side, amt, params={'reduceOnly': True})
+                    order = client.create_order(ccxt_sym, 'market', side, amt, params={'reduceOnly': True})
                     print(f"   👉 User {user_id}: Closed {amt}")
-                    time.sleep(0.5)
-                    ticker = client.fetch_ticker(ccxt_sym)
+                    exit_p, _ = ccxt_fill(client, ccxt_sym, order, None, amt)
+                    exit_p = exit_p or float(client.fetch_ticker(ccxt_sym)['last'])
                     op = get_open_trade(user_id, symbol)
-                    if op: self._handle_pnl_and_billing(user_id, symbol, op['entry_price'], ticker['last'], op['quantity'], op['side'])
-                close_trade_in_db(user_id, symbol)
-            except Exception as e: print(f"   ❌ User {user_id} Close Error: {e}")
+                    pnl, fee = self._handle_pnl_and_billing(user_id, symbol, op['entry_price'], exit_p, op['quantity'], op['side']) if op else (None, 0.0)
+                    self._record_close(user_id, symbol, exit_p, pnl, fee, exchange_id)
+                else:
+                    close_trade_in_db(user_id, symbol)
+            except Exception as e:
+                print(f"   ❌ User {user_id} Close Error: {e}")
+                self.clients.report_error(user_id, exchange_id, e)
 
-    def _safe_db_write(self, user_id, symbol, side, price, qty, is_closing, open_trade):
+    def _safe_db_write(self, user_id, symbol, side, price, qty, is_closing, open_trade, exchange=None):
         try:
             if is_closing:
-                self._handle_pnl_and_billing(user_id, symbol, open_trade['entry_price'], price, qty, open_trade['side'])
-                close_trade_in_db(user_id, symbol)
+                pnl, fee = self._handle_pnl_and_billing(user_id, symbol, open_trade['entry_price'], price, qty, open_trade['side'])
+                self._record_close(user_id, symbol, price, pnl, fee, exchange)
             else:
-                record_trade_entry(user_id, symbol, side, price, qty)
+                self._record_entry(user_id, symbol, side, price, qty, exchange)
         except Exception:
             if is_closing: 
-                try: close_trade_in_db(user_id, symbol)
+                try: self._record_close(user_id, symbol, price, exchange=exchange)
                 except: pass
             else: 
-                try: record_trade_entry(user_id, symbol, side, price, qty)
+                try: self._record_entry(user_id, symbol, side, price, qty, exchange)
                 except: pass
 
+    def _record_entry(self, user_id, symbol, side, price, qty, exchange=None):
+        """Stores a filled entry and pushes it to the user's open WebApp."""
+        record_trade_entry(user_id, symbol, side, price, qty, exchange)
+        publish_user_event(user_id, 'entry', symbol=symbol, side=side, price=price, qty=qty, exchange=exchange)
+
+    def _record_close(self, user_id, symbol, exit_price=None, pnl=None, fee=0.0, exchange=None):
+        """
+        Closes the trade with its exit price / PnL / fee (feeds the PnL rollups) and pushes
+        the close to the WebApp. Without an explicit pnl it is computed from the average entry.
+        """
+        pnl = close_trade_in_db(user_id, symbol, exit_price, pnl, fee, exchange)
+        publish_user_event(user_id, 'close', symbol=symbol, price=exit_price, pnl=pnl, exchange=exchange)
+
     def _handle_pnl_and_billing(self, user_id, symbol, entry, exit_p, qty, side):
         """
         Расчет PnL, списание комиссии 40% и распределение реферальных наград.
+        Возвращает (PnL сделки, списанная комиссия).
         """
         pnl = (exit_p - entry) * qty if side == 'buy' else (entry - exit_p) * qty
         
+        total_fee = 0.0
         if pnl > 0:
             total_fee = pnl * 0.40
-            new_bal = deduct_performance_fee(user_id, total_fee)
+            # Комиссия и реферальные награды - одна проводка в журнале
+            new_bal, rewards = bill_performance_fee(user_id, total_fee, ref=symbol)
+            publish_user_event(user_id, 'fee', symbol=symbol, pnl=pnl, fee=total_fee, credits=new_bal)
             
             print(f"   💰 User {user_id} Profit: ${pnl:.2f} | Total Fee: {total_fee:.2f}")
             
@@ -1233,30 +1211,22 @@ class TradeCopier:
                 except Exception as e:
                     print(f"   ⚠️ Failed to send user notification: {e}")
 
-            # MLM
-            try:
-                upline = get_referrer_upline(user_id, levels=3)
-                percentages = [0.20, 0.07, 0.03]
-                
-                for i, referrer_id in enumerate(upline):
-                    if i < len(percentages):
-                        reward = total_fee * percentages[i]
-                        credit_referral_tokens(referrer_id, reward)
-                        print(f"     -> MLM Level {i+1}: Sent {reward:.2f} to {referrer_id}")
-                        if self.bot:
-                            try:
-                                ref_msg = (
-                                    f"🎉 <b>Referral Bonus!</b>\n"
-                                    f"Level {i+1} referral closed a profitable trade.\n"
-                                    f"💵 You earned: <b>{reward:.2f} USDT</b>"
-                                )
-                                loop = asyncio.new_event_loop()
-                                asyncio.set_event_loop(loop)
-                                loop.run_until_complete(self.bot.send_message(referrer_id, ref_msg, parse_mode=ParseMode.HTML))
-                                loop.close()
-                            except: pass
-            except Exception as e:
-                print(f"   ❌ MLM Error: {e}")
+            # MLM (награды уже начислены в той же проводке, здесь только уведомления)
+            for level, referrer_id, reward in rewards:
+                print(f"     -> MLM Level {level}: Sent {reward:.2f} to {referrer_id}")
+                publish_user_event(referrer_id, 'referral', level=level, reward=reward)
+                if self.bot:
+                    try:
+                        ref_msg = (
+                            f"🎉 <b>Referral Bonus!</b>\n"
+                            f"Level {level} referral closed a profitable trade.\n"
+                            f"💵 You earned: <b>{reward:.2f} USDT</b>"
+                        )
+                        loop = asyncio.new_event_loop()
+                        asyncio.set_event_loop(loop)
+                        loop.run_until_complete(self.bot.send_message(referrer_id, ref_msg, parse_mode=ParseMode.HTML))
+                        loop.close()
+                    except: pass
 
             # Блокировка
             if new_bal <= 0:
@@ -1270,4 +1240,5 @@ class TradeCopier:
                         loop.close()
                     except: pass
         else:
-            print(f"   📉 User {user_id} Loss: ${pnl:.2f}")
\ No newline at end of file
+            print(f"   📉 User {user_id} Loss: ${pnl:.2f}")
+        return pnl, total_fee
\ No newline at end of file